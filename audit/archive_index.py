@@ -0,0 +1,95 @@
+"""
+Archive Index
+
+With ARCHIVE_INDEX on (the default), every member of an archive is compressed as a stream of its
+own (see StreamingTar), and a small json index of the archive is uploaded next to it, as an
+archive described as `<archive name>.index.json`:
+
+    {
+        "version": 1,
+        "archive_name": "<instance>-<timestamp>.tar.gz",
+        "archive_id": "...",
+        "archive_size": 4567,
+        "codec": "gzip",
+        "pgaudit_filter": {"drop_classes": ["MISC"], "drop_roles": [], "dictionary": false},
+        "members": [
+            {
+                "name": "postgresql.log.2018-05-16-22",
+                "log_file": "error/postgresql.log.2018-05-16-22",
+                "first_written": "2018-05-16T22:00:00Z",
+                "last_written": "2018-05-16T23:00:00Z",
+                "size": 1234,
+                "offset": 0,
+                "compressed_offset": 0,
+                "compressed_size": 321
+            },
+            ...
+        ]
+    }
+
+size is the log's uncompressed size, and offset where its tar header starts in the uncompressed
+tar. compressed_offset and compressed_size are the byte range of the archive it was compressed
+into, which decompresses to the member's tar header and contents on its own. So a restore only
+needs a ranged retrieval of the members it wants (see tools/restore_logs.py), not the whole
+archive. pgaudit_filter is how the logs were filtered (see pgaudit_filter.py), or null if they
+weren't. A filtered log may be archived in several members, all with the same log_file.
+
+first_written is when the log was started, going by its name (postgres logs are named after the
+hour, or minute, they start at), and last_written when it was last written to. A log archived from
+a marker (see ARCHIVE_ACTIVE_LOG) only has what was written after the marker, which is recorded
+too.
+"""
+import datetime
+import json
+import os
+import re
+
+INDEX_VERSION = 1
+
+# e.g. postgresql.log.2018-05-16-22 or postgresql.log.2018-05-16-2230
+LOG_START_PATTERN = re.compile(r'(\d{4})-(\d{2})-(\d{2})-(\d{2})(\d{2})?$')
+
+
+def get_index_name(archive_name):
+    return archive_name + '.index.json'
+
+
+def format_time(timestamp):
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def get_log_window(log_file):
+    """ returns when the log was started (or None, if its name doesn't say) and last written to. """
+    last_written = datetime.datetime.utcfromtimestamp(log_file['LastWritten'] // 1000)
+    match = LOG_START_PATTERN.search(os.path.basename(log_file['LogFileName']))
+    if match is None:
+        return None, format_time(last_written)
+    year, month, day, hour, minute = match.groups()
+    first_written = datetime.datetime(int(year), int(month), int(day), int(hour), int(minute or 0))
+    return format_time(first_written), format_time(last_written)
+
+
+def make_index_member(log_file, member):
+    """ the index entry of a log, given the member StreamingTar recorded for it. """
+    first_written, last_written = get_log_window(log_file)
+    entry = dict(member)
+    entry.update({
+        'log_file': log_file['LogFileName'],
+        'first_written': first_written,
+        'last_written': last_written,
+    })
+    if log_file.get('Marker', '0') != '0':
+        entry['marker'] = log_file['Marker']
+    return entry
+
+
+def make_archive_index(archive_name, archive_id, archive_size, codec_name, members, pgaudit_filter=None):
+    return json.dumps({
+        'version': INDEX_VERSION,
+        'archive_name': archive_name,
+        'archive_id': archive_id,
+        'archive_size': archive_size,
+        'codec': codec_name,
+        'pgaudit_filter': pgaudit_filter,
+        'members': members,
+    }, indent=2, sort_keys=True)
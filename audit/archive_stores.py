@@ -0,0 +1,81 @@
+"""
+Archive Stores
+
+Where archives are uploaded: a glacier vault (GLACIER_VAULT_NAME), or an s3 bucket
+(ARCHIVE_S3_URI=s3://bucket/prefix), where each archive is an object, <prefix>/<archive name>, in
+an archival storage class (ARCHIVE_STORAGE_CLASS, e.g. GLACIER or DEEP_ARCHIVE).
+
+Vaults need a retrieval job, and an inventory job to list them. S3 objects in those storage classes
+cost about the same to keep, but are listed like any other object, and once restored can be read
+with ranged GETs. Their parts are plain PUTs, with no tree hash to compute.
+
+Both stores have the same two methods:
+
+    sink = store.open(archive_name)     # a file object to stream the archive into, see streaming.py
+    archive_id = sink.close()
+    archive_id = store.put(archive_name, body)      # a small archive, uploaded whole
+
+In s3 the archive id is the object's s3:// uri. Archives uploaded whole with put() are archive
+indexes and fan-out manifests, which are kept in the STANDARD storage class, so they can be read
+straight away, to find what to restore.
+"""
+from s3_multipart import get_uri
+from streaming import GlacierArchiveSink, S3ArchiveSink
+
+INDEX_STORAGE_CLASS = 'STANDARD'
+
+
+class GlacierVault(object):
+
+    def __init__(self, glacier_client, vault_name, part_size, num_threads=4):
+        self.glacier_client = glacier_client
+        self.vault_name = vault_name
+        self.part_size = part_size
+        self.num_threads = num_threads
+
+    def open(self, archive_name):
+        return GlacierArchiveSink(self.glacier_client, self.vault_name, archive_name,
+                                  part_size=self.part_size, num_threads=self.num_threads)
+
+    def put(self, archive_name, body):
+        response = self.glacier_client.upload_archive(
+            vaultName=self.vault_name,
+            archiveDescription=archive_name,
+            body=body,
+        )
+        return response['archiveId']
+
+
+class S3Bucket(object):
+
+    def __init__(self, s3_client, bucket, prefix, storage_class, part_size, num_threads=4):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.storage_class = storage_class
+        self.part_size = part_size
+        self.num_threads = num_threads
+
+    def get_key(self, archive_name):
+        if not self.prefix:
+            return archive_name
+        return self.prefix.rstrip('/') + '/' + archive_name
+
+    def open(self, archive_name):
+        return S3ArchiveSink(self.s3_client, self.bucket, self.get_key(archive_name), part_size=self.part_size,
+                             num_threads=self.num_threads, storage_class=self.storage_class)
+
+    def put(self, archive_name, body):
+        key = self.get_key(archive_name)
+        self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=body, StorageClass=INDEX_STORAGE_CLASS)
+        return get_uri(self.bucket, key)
+
+
+def parse_s3_uri(uri):
+    """ the (bucket, prefix) of an ARCHIVE_S3_URI, s3://bucket or s3://bucket/prefix """
+    if not uri.startswith('s3://'):
+        raise ValueError('ARCHIVE_S3_URI must look like s3://bucket/prefix, got: %s' % uri)
+    bucket, _, prefix = uri[len('s3://'):].partition('/')
+    if not bucket:
+        raise ValueError('ARCHIVE_S3_URI must look like s3://bucket/prefix, got: %s' % uri)
+    return bucket, prefix
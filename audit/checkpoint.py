@@ -0,0 +1,236 @@
+"""
+Archive Checkpoints
+
+Records which log files have already been archived, so each run only archives what is new.
+
+For every archived log file the checkpoint keeps its 'LastWritten' and 'Size', as reported by
+describe_db_log_files. A log file is archived again only if either of those has changed.
+Logs that were archived while still being written also keep the DownloadDBLogFilePortion
+'Marker' they were read up to, so the next run only archives what was written after it.
+
+The checkpoint is a small json document, kept either in s3 (CHECKPOINT_URI=s3://bucket/key) or
+in a local file (CHECKPOINT_URI=/path/to/checkpoint.json), which is handy when running locally.
+
+Shards of a fanned out run (see fanout.py) are archived by asynchronous worker invocations, which
+may still fail after lambda's own retries. So the coordinator only records them as pending, before
+dispatching them, and each worker leaves a marker next to the checkpoint once its archive is
+uploaded (<checkpoint>.shards/<archive name>.done). Each run reconciles the pending shards with
+the markers: a shard with a marker is archived. One without a marker SHARD_TIMEOUT_MS after it was
+dispatched has failed for good, and its logs are archived again. Until then they are left alone.
+
+In multi-instance mode (see instances.py) each instance has a checkpoint of its own, at CHECKPOINT_URI
+with {instance} replaced by the instance's identifier, or with -<instance> added before the
+extension if it has no {instance}: s3://bucket/pg-audit/checkpoint-db1.json.
+"""
+import json
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+# entries for log files last written this long before the newest checkpointed file are dropped,
+# RDS will have deleted those logs by then.
+RETENTION_MS = 1000 * 60 * 60 * 24 * 30
+# how long after a shard was dispatched it is given up on: lambda retries an asynchronous
+# invocation for up to 6 hours, and each attempt can take up to 15 minutes.
+SHARD_TIMEOUT_MS = 1000 * 60 * 60 * 7
+MARKERS_SUFFIX = '.shards'
+DONE_SUFFIX = '.done'
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class Checkpoint(object):
+
+    def __init__(self, files=None, shards=None):
+        # log file name -> {'LastWritten': ms since epoch, 'Size': bytes}
+        self.files = files or {}
+        # archive name -> {'dispatched': ms since epoch, 'log_files': [{'LogFileName', 'LastWritten', 'Size'}]}
+        # of the shards dispatched to workers that haven't been seen to finish
+        self.shards = shards or {}
+
+    @property
+    def last_written(self):
+        """ the time to list log files written after: the newest 'LastWritten' of any archived file,
+        or just before the oldest of a pending shard's, which may have to be archived again.
+        None if nothing has been archived. """
+        if not self.files and not self.shards:
+            return None
+        last_written = max(f['LastWritten'] for f in self.files.values()) if self.files else None
+        pending = [log_file['LastWritten'] - 1 for shard in self.shards.values() for log_file in shard['log_files']]
+        return min([last_written] + pending if last_written is not None else pending)
+
+    def is_archived(self, log_file):
+        archived = self.files.get(log_file['LogFileName'])
+        return archived is not None and \
+            archived['LastWritten'] == log_file['LastWritten'] and archived['Size'] == log_file['Size']
+
+    def resume_marker(self, log_file):
+        """ the portion marker to continue a partly archived log file from, if there is one. """
+        archived = self.files.get(log_file['LogFileName'])
+        if archived is None:
+            return None
+        return archived.get('Marker')
+
+    def is_pending(self, log_file, now=None):
+        """ whether log_file is in a shard that is still being archived by a worker. """
+        threshold = (now or now_ms()) - SHARD_TIMEOUT_MS
+        return any(
+            shard['dispatched'] >= threshold and any(
+                pending['LogFileName'] == log_file['LogFileName'] and pending['LastWritten'] == log_file['LastWritten']
+                and pending['Size'] == log_file['Size'] for pending in shard['log_files'])
+            for shard in self.shards.values()
+        )
+
+    def add_shards(self, worker_events, now=None):
+        """ records the shards of worker_events as pending. """
+        for event in worker_events:
+            self.shards[event['archive_name']] = {
+                'dispatched': now or now_ms(),
+                'log_files': [
+                    dict((key, log_file[key]) for key in ('LogFileName', 'LastWritten', 'Size'))
+                    for log_file in event['log_files']
+                ],
+            }
+
+    def reconcile(self, store):
+        """ records the pending shards whose workers have left a marker in store as archived.
+        returns their names: their markers can go once the checkpoint is saved. """
+        done = [archive_name for archive_name in sorted(self.shards) if store.is_done(archive_name)]
+        for archive_name in done:
+            self.record(self.shards[archive_name]['log_files'])
+        return done
+
+    def timed_out_shards(self, now=None):
+        """ the pending shards that were dispatched too long ago to still be archived. """
+        threshold = (now or now_ms()) - SHARD_TIMEOUT_MS
+        return sorted(archive_name for archive_name, shard in self.shards.items() if shard['dispatched'] < threshold)
+
+    def record(self, log_files):
+        for log_file in log_files:
+            archived = {
+                'LastWritten': log_file['LastWritten'],
+                'Size': log_file['Size'],
+            }
+            if 'EndMarker' in log_file:
+                archived['Marker'] = log_file['EndMarker']
+            self.files[log_file['LogFileName']] = archived
+        # a pending shard is done with once all of its logs are archived, by its worker or by a later run.
+        for archive_name, shard in list(self.shards.items()):
+            shard['log_files'] = [pending for pending in shard['log_files'] if not self.is_archived(pending)]
+            if not shard['log_files']:
+                del self.shards[archive_name]
+        if not self.files:
+            return
+        threshold = max(f['LastWritten'] for f in self.files.values()) - RETENTION_MS
+        for name in [name for name, f in self.files.items() if f['LastWritten'] < threshold]:
+            del self.files[name]
+        for archive_name in [name for name, shard in self.shards.items() if shard['dispatched'] < threshold]:
+            del self.shards[archive_name]
+
+    def dumps(self):
+        return json.dumps({'version': 1, 'files': self.files, 'shards': self.shards}, indent=2, sort_keys=True)
+
+    @classmethod
+    def loads(cls, contents):
+        checkpoint = json.loads(contents)
+        return cls(checkpoint['files'], checkpoint.get('shards'))
+
+
+class LocalCheckpointStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.markers = path + MARKERS_SUFFIX
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return Checkpoint()
+        with open(self.path) as f:
+            return Checkpoint.loads(f.read())
+
+    def save(self, checkpoint):
+        # write then rename, so a failed run can never leave a half written checkpoint.
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(checkpoint.dumps())
+        os.rename(tmp_path, self.path)
+
+    def mark_done(self, archive_name):
+        if not os.path.isdir(self.markers):
+            os.makedirs(self.markers)
+        with open(os.path.join(self.markers, archive_name + DONE_SUFFIX), 'w'):
+            pass
+
+    def is_done(self, archive_name):
+        return os.path.exists(os.path.join(self.markers, archive_name + DONE_SUFFIX))
+
+    def clear_done(self, archive_name):
+        os.remove(os.path.join(self.markers, archive_name + DONE_SUFFIX))
+
+
+class S3CheckpointStore(object):
+
+    def __init__(self, s3_client, bucket, key):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.markers = key + MARKERS_SUFFIX + '/'
+
+    def load(self):
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key)
+        except self.s3_client.exceptions.NoSuchKey:
+            return Checkpoint()
+        return Checkpoint.loads(response['Body'].read())
+
+    def save(self, checkpoint):
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=self.key,
+            Body=checkpoint.dumps(),
+            ContentType='application/json',
+        )
+
+    def mark_done(self, archive_name):
+        self.s3_client.put_object(Bucket=self.bucket, Key=self.markers + archive_name + DONE_SUFFIX, Body=b'')
+
+    def is_done(self, archive_name):
+        # with s3:ListBucket, a missing object is a 404 rather than a 403.
+        try:
+            self.s3_client.head_object(Bucket=self.bucket, Key=self.markers + archive_name + DONE_SUFFIX)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def clear_done(self, archive_name):
+        self.s3_client.delete_object(Bucket=self.bucket, Key=self.markers + archive_name + DONE_SUFFIX)
+
+
+def get_instance_checkpoint_uri(uri, db_instance):
+    """ the CHECKPOINT_URI of one instance of several, or None if checkpointing is turned off. """
+    if not uri:
+        return None
+    if '{instance}' in uri:
+        return uri.replace('{instance}', db_instance)
+    root, extension = os.path.splitext(uri)
+    return '%s-%s%s' % (root, db_instance, extension)
+
+
+def get_checkpoint_store(uri, s3_client=None):
+    """ returns the store for a CHECKPOINT_URI, or None if checkpointing is turned off. """
+    if not uri:
+        return None
+    if uri.startswith('s3://'):
+        bucket, _, key = uri[len('s3://'):].partition('/')
+        if not bucket or not key:
+            raise ValueError('CHECKPOINT_URI must look like s3://bucket/key, got: %s' % uri)
+        if s3_client is None:
+            import boto3
+            s3_client = boto3.client('s3')
+        return S3CheckpointStore(s3_client, bucket, key)
+    return LocalCheckpointStore(uri)
@@ -0,0 +1,222 @@
+"""
+Archive Compression Codecs
+
+The archive is written as a plain tar stream, and compressed by one of these codecs on its way
+to the uploader. Pick one with COMPRESSION_CODEC, and its level with COMPRESSION_LEVEL.
+
+| codec  | extension | levels | notes |
+| ---    | ---       | ---    | ---   |
+| `gzip` | .tar.gz   | 1-9    | the default, at level 6. compresses with COMPRESSION_THREADS threads. |
+| `bz2`  | .tar.bz2  | 1-9    | |
+| `xz`   | .tar.xz   | 0-9    | needs `backports.lzma` on python 2. |
+| `zstd` | .tar.zst  | 1-22   | needs `zstandard`. compresses with COMPRESSION_THREADS threads. |
+| `none` | .tar      |        | |
+
+With more than one thread, gzip works like pigz: the stream is cut into blocks, each block is
+compressed into its own gzip member in a thread pool, and the members are written out in order.
+Concatenated gzip members are a valid gzip file, which gunzip, tar and python's gzip all read.
+
+CompressingWriter.restart ends the compressed stream and starts another, so that what follows
+can be decompressed without what came before (see StreamingTar). Concatenated streams are still
+one valid file for gzip, bzip2, xz and zstd, though python 2's bz2 module only reads the first.
+"""
+import bz2
+import collections
+import concurrent.futures
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class NullCompressor(object):
+    """ the none codec's compressor, and its decompressor too. """
+
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+def gzip_member(data, level):
+    """ compress data into a complete, standalone gzip member. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipCompressor(object):
+    """ compresses block_size blocks into separate gzip members, on a pool of threads.
+
+    zlib releases the GIL while it compresses, so threads do use several cores. At most
+    2 * threads blocks are waiting or being compressed at any time.
+    """
+
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, level, threads, block_size=BLOCK_SIZE):
+        self.level = level
+        self.threads = threads
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+    def compress(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.block_size:
+            self.pending.append(self.executor.submit(gzip_member, bytes(self.buffer[:self.block_size]), self.level))
+            del self.buffer[:self.block_size]
+        return self._collect(limit=2 * self.threads)
+
+    def _collect(self, limit):
+        """ returns the compressed output of finished blocks at the front of the queue, in order.
+        waits for blocks to finish while more than limit are pending.
+        """
+        output = []
+        while self.pending and (self.pending[0].done() or len(self.pending) > limit):
+            output.append(self.pending.popleft().result())
+        return b''.join(output)
+
+    def flush(self):
+        if self.buffer:
+            self.pending.append(self.executor.submit(gzip_member, bytes(self.buffer), self.level))
+            del self.buffer[:]
+        output = self._collect(limit=0)
+        self.executor.shutdown()
+        return output
+
+
+class Codec(object):
+
+    def __init__(self, name, extension, default_level, make_compressor, make_decompressor, available=True):
+        self.name = name
+        self.extension = extension
+        self.default_level = default_level
+        self.make_compressor = make_compressor
+        self.make_decompressor = make_decompressor
+        self.available = available
+
+    def compressor(self, level=None, threads=0):
+        """ a new compressor object, with compress(data) and flush() methods. """
+        if not self.available:
+            raise ValueError('the %s codec needs a module that is not installed' % self.name)
+        if level is None:
+            level = self.default_level
+        return self.make_compressor(level, threads)
+
+    def decompressor(self):
+        """ a new decompressor object, with a decompress(data) method, for one stream. """
+        if not self.available:
+            raise ValueError('the %s codec needs a module that is not installed' % self.name)
+        return self.make_decompressor()
+
+
+def make_gzip_compressor(level, threads):
+    if threads > 1:
+        return ParallelGzipCompressor(level, threads)
+    # wbits of 16 + MAX_WBITS writes a gzip header and trailer around the deflate stream.
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+def make_bz2_compressor(level, threads):
+    return bz2.BZ2Compressor(level)
+
+def make_xz_compressor(level, threads):
+    return lzma.LZMACompressor(preset=level)
+
+def make_zstd_compressor(level, threads):
+    return zstandard.ZstdCompressor(level=level, threads=threads).compressobj()
+
+def make_null_compressor(level, threads):
+    return NullCompressor()
+
+def make_gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def make_zstd_decompressor():
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+CODECS = dict((codec.name, codec) for codec in [
+    Codec('gzip', '.tar.gz', 6, make_gzip_compressor, make_gzip_decompressor),
+    Codec('bz2', '.tar.bz2', 9, make_bz2_compressor, lambda: bz2.BZ2Decompressor()),
+    Codec('xz', '.tar.xz', 6, make_xz_compressor, lambda: lzma.LZMADecompressor(), available=lzma is not None),
+    Codec('zstd', '.tar.zst', 3, make_zstd_compressor, make_zstd_decompressor, available=zstandard is not None),
+    Codec('none', '.tar', None, make_null_compressor, NullCompressor),
+])
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError('unknown compression codec %r, expected one of: %s' % (name, ', '.join(sorted(CODECS))))
+
+
+def iter_decompress(codec, chunks):
+    """ decompresses an iterator of compressed chunks, which may hold several concatenated streams
+    (e.g. parallel gzip's members), yielding the decompressed data as it goes. zstd frames don't
+    say where they end, so a zstd input must be a single frame. """
+    decompressor = codec.decompressor()
+    for chunk in chunks:
+        while chunk:
+            try:
+                data = decompressor.decompress(chunk)
+            except EOFError:
+                # bz2 and xz decompressors refuse input past the end of their stream
+                decompressor = codec.decompressor()
+                continue
+            if data:
+                yield data
+            # zlib keeps whatever comes after the end of its stream in unused_data
+            chunk = getattr(decompressor, 'unused_data', b'')
+            if chunk:
+                decompressor = codec.decompressor()
+
+
+class CompressingWriter(object):
+    """ write-only file object that compresses everything written to it into fileobj. """
+
+    def __init__(self, fileobj, compressor):
+        self.fileobj = fileobj
+        self.compressor = compressor
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        self._write_out(self.compressor.compress(data))
+
+    def _write_out(self, data):
+        if data:
+            self.bytes_out += len(data)
+            self.fileobj.write(data)
+
+    def tell(self):
+        """ how much has been written, before compression. """
+        return self.bytes_in
+
+    def flush(self):
+        pass
+
+    def restart(self, compressor):
+        """ ends the compressed stream, and carries on with a new one from compressor. """
+        self._write_out(self.compressor.flush())
+        self.compressor = compressor
+
+    def close(self):
+        """ writes the end of the compressed stream. does not close fileobj. """
+        self._write_out(self.compressor.flush())
@@ -1,121 +1,592 @@
 """
 Audit Lambda Handler
 
-It will look for all log files for a given RDS instance, that have been updated in the last n minutes, compresses them and uploads them to glacier.
+It will look for all log files for a given RDS instance, that have been updated in the last n minutes, compresses them and uploads them to glacier (or s3, see archive_stores.py).
+
+With DB_INSTANCE_IDENTIFIERS or DB_INSTANCE_TAG set instead, it does the same for several instances at once, see instances.py.
 
 """
 import arrow
 import boto3
 import os
-import shutil
-import StringIO
-import tarfile
-import tempfile
+import time
+from botocore.config import Config
 
-from rds_download_log import get_log_file_contents_via_rest
+from archive_index import get_index_name, make_archive_index, make_index_member
+from archive_stores import GlacierVault, S3Bucket, parse_s3_uri
+from checkpoint import get_checkpoint_store, get_instance_checkpoint_uri
+from compression import get_codec
+from downloader import download_with_retries, iter_downloads, must_prefetch, spool_download
+from fanout import (InProcessDispatcher, LambdaDispatcher, get_shard_archive_name, is_worker_event,
+                    make_manifest, make_shards, make_worker_event)
+from instances import FAILED, DownloadLimits, RateLimiter, archive_instances, format_result, get_db_instances
+from metrics import BYTES, COUNT, MILLISECONDS, NULL_METRICS, Metrics
+from pgaudit_columns import EXTENSION as COLUMNS_EXTENSION, PgAuditColumnWriter, get_columns_name
+from pgaudit_filter import PgAuditFilter, parse_list
+from rds_download_log import RDS_ENDPOINT_URL, get_log_file_contents_via_rest, get_log_file_portions
+from streaming import StreamingTar
 
 DB_INSTANCE_IDENTIFIER = os.getenv('DB_INSTANCE_IDENTIFIER')
 GLACIER_VAULT_NAME = os.getenv('GLACIER_VAULT_NAME')
+# upload archives to s3 instead of GLACIER_VAULT_NAME, as objects s3://bucket/prefix/<archive name>
+# in ARCHIVE_STORAGE_CLASS. see archive_stores.py.
+ARCHIVE_S3_URI = os.getenv('ARCHIVE_S3_URI')
+ARCHIVE_STORAGE_CLASS = os.getenv('ARCHIVE_STORAGE_CLASS', 'GLACIER')
+# only needed to point glacier uploads at something other than aws, e.g. glacier-upload's glacier_stub.py.
+GLACIER_ENDPOINT_URL = os.getenv('GLACIER_ENDPOINT_URL')
+# archive several instances instead: those listed, comma separated, and those with the tag, key=value.
+# see instances.py.
+DB_INSTANCE_IDENTIFIERS = os.getenv('DB_INSTANCE_IDENTIFIERS')
+DB_INSTANCE_TAG = os.getenv('DB_INSTANCE_TAG')
+MULTI_INSTANCE = bool(DB_INSTANCE_IDENTIFIERS or DB_INSTANCE_TAG)
+# how many instances are archived at once, in multi-instance mode.
+INSTANCE_THREADS = int(os.getenv('INSTANCE_THREADS', '4'))
+
+# logs are downloaded and compressed in pieces of this size.
+BUFFER_SIZE = int(os.getenv('BUFFER_SIZE_MB', '1')) * 1024 * 1024
+# the archive is uploaded in parts of this size, UPLOAD_THREADS parts at a time, so peak memory
+# use is about PART_SIZE * (UPLOAD_THREADS + 1). for glacier it must be a power of 2 (1, 2, 4, 8 ... MB),
+# and for s3 at least 5MB.
+PART_SIZE = int(os.getenv('PART_SIZE_MB', '8')) * 1024 * 1024
+UPLOAD_THREADS = int(os.getenv('UPLOAD_THREADS', '4'))
+# log files are downloaded DOWNLOAD_THREADS at a time, and held in memory until they are added
+# to the archive. at most DOWNLOAD_BUDGET_MB of logs are held at once; larger logs are spooled
+# to a temporary file (in lambda's /tmp), one at a time, so /tmp must be able to hold the largest.
+DOWNLOAD_THREADS = int(os.getenv('DOWNLOAD_THREADS', '4'))
+DOWNLOAD_BUDGET = int(os.getenv('DOWNLOAD_BUDGET_MB', '128')) * 1024 * 1024
+# in multi-instance mode, DOWNLOAD_THREADS and DOWNLOAD_BUDGET_MB are shared by every instance.
+INSTANCE_DOWNLOAD_BUDGET = DOWNLOAD_BUDGET // INSTANCE_THREADS if MULTI_INSTANCE else DOWNLOAD_BUDGET
+# the most MB a second downloaded, by all downloads together. 0 is no limit.
+MAX_DOWNLOAD_MBPS = float(os.getenv('MAX_DOWNLOAD_MBPS', '0'))
+# the most DescribeDBLogFiles calls a second, by all instances together. calls that are throttled
+# anyway are retried, up to RDS_API_RETRIES times.
+RDS_API_RATE = float(os.getenv('RDS_API_RATE', '5'))
+RDS_API_RETRIES = int(os.getenv('RDS_API_RETRIES', '8'))
+# where to record which logs have been archived, either s3://bucket/key or a local path.
+# when it is not set, every run archives the logs written in the last 24 hours.
+CHECKPOINT_URI = os.getenv('CHECKPOINT_URI')
+# also archive what has been written so far to the log that is still being written, using
+# DownloadDBLogFilePortion. later runs pick up from where the last one left off, so this
+# requires CHECKPOINT_URI.
+ARCHIVE_ACTIVE_LOG = os.getenv('ARCHIVE_ACTIVE_LOG', 'false').lower() == 'true'
+# how the archive is compressed, see compression.py for the codecs and their levels.
+CODEC = get_codec(os.getenv('COMPRESSION_CODEC', 'gzip'))
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL')) if os.getenv('COMPRESSION_LEVEL') else None
+# gzip and zstd can compress on several cores; 0 or 1 compresses in the main thread.
+COMPRESSION_THREADS = int(os.getenv('COMPRESSION_THREADS', '0'))
+# runs with more than this many MB of logs are split into shards, and each shard is archived by
+# its own invocation of this lambda. when it is not set, everything is archived in one invocation.
+FANOUT_SHARD_SIZE = int(os.getenv('FANOUT_SHARD_MB', '0')) * 1024 * 1024
+# compress each log on its own, and upload an index of where each one is in the archive, so a
+# restore can retrieve just the logs it needs. see archive_index.py.
+ARCHIVE_INDEX = os.getenv('ARCHIVE_INDEX', 'true').lower() == 'true'
+# drop pgaudit records of these classes or users, and dictionary encode repeated statements in the
+# rest, before they are compressed. see pgaudit_filter.py.
+PGAUDIT_DROP_CLASSES = parse_list(os.getenv('PGAUDIT_DROP_CLASSES'))
+PGAUDIT_DROP_ROLES = parse_list(os.getenv('PGAUDIT_DROP_ROLES'))
+PGAUDIT_DICTIONARY = os.getenv('PGAUDIT_DICTIONARY', 'false').lower() == 'true'
+# a filtered log's size isn't known until it has been filtered, and tar headers need it up front,
+# so filtered logs are held in memory and archived in pieces of at most this size.
+PGAUDIT_FILTER_PART_SIZE = int(os.getenv('PGAUDIT_FILTER_PART_MB', '16')) * 1024 * 1024
+# parse the pgaudit records into a columns archive, <archive name>.columns, which can be queried
+# without restoring the logs: 'alongside' the archive, 'instead' of it, or 'off'. see pgaudit_columns.py.
+PGAUDIT_COLUMNS = os.getenv('PGAUDIT_COLUMNS', 'off').lower()
+if PGAUDIT_COLUMNS not in ('off', 'alongside', 'instead'):
+    raise ValueError('PGAUDIT_COLUMNS must be off, alongside or instead, got: %s' % PGAUDIT_COLUMNS)
+# log how long each stage of a run takes, and how many bytes go through it, as cloudwatch
+# embedded metric format json. see metrics.py.
+METRICS = os.getenv('METRICS', 'false').lower() == 'true'
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'PgAudit')
+
+_rds_client = None
+_archive_store = None
+_rds_api_limiter = RateLimiter(RDS_API_RATE)
+_download_limits = DownloadLimits(DOWNLOAD_THREADS, MAX_DOWNLOAD_MBPS * 1024 * 1024)
 
-PERSIST_TO_DISC_AFTER = False
+def get_rds_client():
+    global _rds_client
+    if _rds_client is None:
+        _rds_client = boto3.client('rds', endpoint_url=RDS_ENDPOINT_URL,
+                                   config=Config(retries={'max_attempts': RDS_API_RETRIES}))
+    return _rds_client
 
-TEMP_DIR = tempfile.mktemp()
+def get_archive_store():
+    '''the glacier vault or s3 bucket archives are uploaded to'''
+    global _archive_store
+    if _archive_store is None:
+        if ARCHIVE_S3_URI:
+            bucket, prefix = parse_s3_uri(ARCHIVE_S3_URI)
+            _archive_store = S3Bucket(boto3.client('s3'), bucket, prefix, ARCHIVE_STORAGE_CLASS,
+                                      part_size=PART_SIZE, num_threads=UPLOAD_THREADS)
+        else:
+            glacier_client = boto3.client('glacier', endpoint_url=GLACIER_ENDPOINT_URL)
+            _archive_store = GlacierVault(glacier_client, GLACIER_VAULT_NAME,
+                                          part_size=PART_SIZE, num_threads=UPLOAD_THREADS)
+    return _archive_store
 
-def get_parent_path(path):
-    return os.path.abspath(os.path.join(path, os.pardir))
+def get_metrics(db_instance):
+    if not METRICS:
+        return NULL_METRICS
+    return Metrics(METRICS_NAMESPACE, {'DBInstanceIdentifier': db_instance or 'unknown'})
 
-def list_files(rds_client):
-    # files last modified before this time will not be listed.
-    threshold_timestamp = 1000 * arrow.now().shift(hours=-24).timestamp
+def describe_log_files(rds_client, threshold_timestamp, db_instance=DB_INSTANCE_IDENTIFIER):
+    _rds_api_limiter.wait()
     response = rds_client.describe_db_log_files(
-        DBInstanceIdentifier=DB_INSTANCE_IDENTIFIER,
+        DBInstanceIdentifier=db_instance,
         FileLastWritten=threshold_timestamp,
     )
+    log_files = response['DescribeDBLogFiles']
+    while response.get('Marker'):
+        _rds_api_limiter.wait()
+        response = rds_client.describe_db_log_files(
+            DBInstanceIdentifier=db_instance,
+            FileLastWritten=threshold_timestamp,
+            Marker=response['Marker'],
+        )
+        log_files.extend(response['DescribeDBLogFiles'])
+    return log_files
 
-    logs_to_download = response['DescribeDBLogFiles']
-    # remove the most recently written log from the list; its not being done written.
-    logs_to_download.remove(max(logs_to_download, key=lambda x: x['LastWritten']))
+def list_files(rds_client, checkpoint=None, db_instance=DB_INSTANCE_IDENTIFIER):
+    if checkpoint is not None and checkpoint.last_written is not None:
+        # anything not yet archived was written after the newest archived file.
+        threshold_timestamp = checkpoint.last_written
+    else:
+        # files last modified before this time will not be listed.
+        threshold_timestamp = 1000 * arrow.now().shift(hours=-24).timestamp
+
+    logs_to_download = describe_log_files(rds_client, threshold_timestamp, db_instance)
+    if not logs_to_download:
+        return []
+    for log in logs_to_download:
+        log['DBInstanceIdentifier'] = db_instance
+    active_log = max(logs_to_download, key=lambda x: x['LastWritten'])
+    if ARCHIVE_ACTIVE_LOG and checkpoint is not None:
+        # the active log is read in portions, so that the next run can continue from the last one.
+        active_log['Marker'] = '0'
+    else:
+        # remove the most recently written log from the list; its not being done written.
+        logs_to_download.remove(active_log)
     # remove the the 'error/postgres.log' log if it exists - this is the bootup log and not necessary.
     try:
         logs_to_download.remove(next(log for log in logs_to_download if log['LogFileName'] == 'error/postgres.log'))
     except StopIteration:
         pass
 
-    return [ f['LogFileName'] for f in logs_to_download ]
-
-def download(rds_client, filename):
-    '''downloads file and loads it into memory'''
-    tmp_file = open(filename, 'w+')
-    contents = get_log_file_contents_via_rest(filename)
-    tmp_file.write(contents)
-    return tmp_file
-
-def make_tar(files, archive_name):
-    """ given a list of (filename, filecontents), return a tar) """
-    delete_after = not PERSIST_TO_DISC_AFTER
-    tmp_file = open(archive_name, 'w+')
-    tar = tarfile.open(fileobj=tmp_file, mode="w:gz")
-    for filename, file in files:
-        file.seek(0)
-        info = tar.gettarinfo(fileobj=file, arcname=os.path.basename(filename))
-        tar.addfile(tarinfo=info, fileobj=file)
+    if checkpoint is not None:
+        # logs in shards that fan-out workers may still be archiving are left to them.
+        logs_to_download = [log for log in logs_to_download
+                            if not checkpoint.is_archived(log) and not checkpoint.is_pending(log)]
+        for log in logs_to_download:
+            # logs that were partly archived while they were active continue from where they left off.
+            marker = checkpoint.resume_marker(log)
+            if marker is not None:
+                log['Marker'] = marker
+
+    # each entry has 'DBInstanceIdentifier', 'LogFileName', 'LastWritten' (ms since epoch) and 'Size' (bytes)
+    return logs_to_download
+
+def download_portions(log_file):
+    '''reads the file from its 'Marker' onwards, recording where it ended up in 'EndMarker'.'''
+    rds_client = get_rds_client()
+    for data, marker in get_log_file_portions(rds_client, log_file['LogFileName'], log_file['Marker'],
+                                              db_instance=log_file.get('DBInstanceIdentifier')):
+        log_file['EndMarker'] = marker
+        yield data
+
+def download_log(log_file):
+    '''streams the file's contents in chunks, without loading it all into memory'''
+    if 'Marker' in log_file:
+        return download_portions(log_file)
+    return get_log_file_contents_via_rest(log_file['LogFileName'], chunk_size=BUFFER_SIZE,
+                                          db_instance=log_file.get('DBInstanceIdentifier'))
+
+# at most DOWNLOAD_THREADS reads at once, and MAX_DOWNLOAD_MBPS, across every instance.
+download = _download_limits.limit(download_log)
+
+def iter_log_contents(log_files, metrics=NULL_METRICS):
+    """ yields (log_file, size, chunks) for each log file, in order """
+    measured_download = metrics.wrap_download(download)
+    if DOWNLOAD_THREADS > 1:
+        for item in iter_downloads(log_files, measured_download, DOWNLOAD_THREADS, INSTANCE_DOWNLOAD_BUDGET):
+            yield item
+        return
+    for log_file in log_files:
+        if must_prefetch(log_file) or log_file['Size'] <= INSTANCE_DOWNLOAD_BUDGET:
+            chunks = download_with_retries(measured_download, log_file)
+            yield log_file, sum(len(chunk) for chunk in chunks), chunks
+        else:
+            # spooled to disk, since the tar header needs the exact size, which Size may not be.
+            size, chunks = spool_download(measured_download, log_file)
+            yield log_file, size, chunks
+
+def get_arcname(log_file):
+    """ logs archived in several pieces get the marker each piece starts at added to its name """
+    arcname = os.path.basename(log_file['LogFileName'])
+    if log_file.get('Marker', '0') != '0':
+        arcname += '.from-' + log_file['Marker'].replace(':', '-')
+    return arcname
+
+def get_log_filter():
+    if not (PGAUDIT_DROP_CLASSES or PGAUDIT_DROP_ROLES or PGAUDIT_DICTIONARY):
+        return None
+    return PgAuditFilter(PGAUDIT_DROP_CLASSES, PGAUDIT_DROP_ROLES, PGAUDIT_DICTIONARY)
+
+def iter_parts(chunks, part_size):
+    """ collects chunks into parts of part_size bytes, and a last, smaller one if there is anything
+    left. there is always at least one part, empty if the chunks are. """
+    buffer = bytearray()
+    parts = 0
+    for chunk in chunks:
+        buffer.extend(chunk)
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+            parts += 1
+    if buffer or not parts:
+        yield bytes(buffer)
+
+def iter_members(log_files, log_filter, metrics=NULL_METRICS, columns=None):
+    """ yields (log_file, arcname, size, chunks) for each tar member, in order.
+    filtered logs larger than PGAUDIT_FILTER_PART_SIZE are split into several members,
+    named <log name>.part-001 and so on. with columns, a PgAuditColumnWriter, the logs are
+    also converted as they are archived, before they are filtered. """
+    for log_file, size, chunks in iter_log_contents(log_files, metrics):
+        arcname = get_arcname(log_file)
+        if columns is not None:
+            chunks = columns.tee(log_file['LogFileName'], chunks)
+        if log_filter is None:
+            yield log_file, arcname, size, chunks
+            continue
+        for i, part in enumerate(iter_parts(log_filter.filter(chunks), PGAUDIT_FILTER_PART_SIZE)):
+            if i or len(part) == PGAUDIT_FILTER_PART_SIZE:
+                yield log_file, '%s.part-%03d' % (arcname, i + 1), len(part), [part]
+            else:
+                yield log_file, arcname, len(part), [part]
+
+def make_compressor():
+    return CODEC.compressor(COMPRESSION_LEVEL, threads=COMPRESSION_THREADS)
+
+def log_member_metrics(metrics, tar, archived, timings, count):
+    """ logs the metrics of the first count members not logged yet. a member's compressed size is
+    only known once the next one has started, or the tar is closed. """
+    for i in range(len(archived) - len(timings), len(archived) - len(timings) + count):
+        arcname, seconds, size = timings.pop(0)
+        compressed_size = tar.members[i].get('compressed_size') if tar.members else None
+        metrics.log_file(archived[i], arcname, seconds, size, compressed_size)
+
+def make_tar(log_files, archive_file, metrics=NULL_METRICS, columns=None):
+    """ given a list of log file descriptions, stream them into a compressed tar written to archive_file.
+    returns the archive index's members, when ARCHIVE_INDEX is on, and the bytes of log archived.
+    """
+    def new_compressor():
+        return metrics.wrap_compressor(make_compressor())
+
+    tar = StreamingTar(metrics.wrap_writer(archive_file, 'UploadWait'), bufsize=BUFFER_SIZE,
+                       compressor=new_compressor(), make_compressor=new_compressor if ARCHIVE_INDEX else None)
+    log_filter = get_log_filter()
+    archived = []
+    archived_bytes = 0
+    # (arcname, seconds, size) of the members whose metrics haven't been logged yet
+    timings = []
+    for log_file, arcname, size, chunks in iter_members(log_files, log_filter, metrics, columns):
+        start = time.time()
+        tar.add_stream(
+            arcname=arcname,
+            size=size,
+            chunks=chunks,
+            mtime=log_file['LastWritten'] // 1000,
+        )
+        archived.append(log_file)
+        archived_bytes += size
+        if metrics.enabled:
+            timings.append((arcname, time.time() - start, size))
+            log_member_metrics(metrics, tar, archived, timings, len(timings) - 1 if ARCHIVE_INDEX else len(timings))
     tar.close()
+    if metrics.enabled:
+        log_member_metrics(metrics, tar, archived, timings, len(timings))
+        metrics.add('TarBytes', tar.writer.bytes_in, BYTES)
+        metrics.add('ArchiveBytes', tar.writer.bytes_out, BYTES)
+        if log_filter is not None:
+            metrics.add('FilterTime', log_filter.seconds * 1000, MILLISECONDS)
+    if log_filter is not None:
+        print 'pgaudit filter kept %s of %s lines (%s of %s bytes)' % (
+            log_filter.lines_out, log_filter.lines_in, log_filter.bytes_out, log_filter.bytes_in)
+    return [make_index_member(log_file, member) for log_file, member in zip(archived, tar.members)], archived_bytes
 
-    if PERSIST_TO_DISC_AFTER:
-        print tmp_file.name
-    return tmp_file
+def upload_index(archive_store, archive_name, archive_id, archive_size, members):
+    index_name = get_index_name(archive_name)
+    log_filter = get_log_filter()
+    try:
+        index_id = archive_store.put(
+            index_name,
+            make_archive_index(archive_name, archive_id, archive_size, CODEC.name, members,
+                               log_filter and log_filter.settings()),
+        )
+    except Exception as e:
+        # the archive itself is uploaded, and can still be restored whole; failing the run now
+        # would only archive the same logs again next time.
+        print 'Failed to upload archive index %s: %r' % (index_name, e)
+        return
+    print 'Uploaded archive index: %s (%s)' % (index_name, index_id)
 
-def upload(filepath, archive_file):
-    glacier_client = boto3.client('glacier')
+def get_archive_extension():
+    if PGAUDIT_COLUMNS == 'instead':
+        return COLUMNS_EXTENSION
+    return CODEC.extension
 
-    # 4GB max file size
-    response = glacier_client.upload_archive(
-        archiveDescription=filepath,
-        body=archive_file.getvalue(),
-        vaultName=GLACIER_VAULT_NAME,
-    )
-    if 'archiveId' not in response:
-        raise Exception('failed to upload filepath: %s' % filepath)
-
-def make_dirs_for_path(path):
-    parent = get_parent_path(path)
-    if not os.path.exists(parent):
-        os.makedirs(parent)
-        make_dirs_for_path(parent)
-    return
-
-def main():
-    '''This function will always replace any existing files that exist that have the same names,
-    but this is okay since we only upload files that have changed.
+def make_column_writer(archive_file, metrics=NULL_METRICS):
+    return PgAuditColumnWriter(metrics.wrap_writer(archive_file, 'UploadWait'), PGAUDIT_DROP_CLASSES,
+                               PGAUDIT_DROP_ROLES)
+
+def add_upload_metrics(metrics, sink):
+    metrics.add('UploadBytes', sink.size, BYTES)
+    metrics.add('UploadTime', sink.uploader.seconds * 1000, MILLISECONDS)
+    metrics.add('UploadRetries', sink.uploader.retries, COUNT)
+
+def add_column_metrics(metrics, columns):
+    metrics.add('ColumnsTime', columns.seconds * 1000, MILLISECONDS)
+    metrics.add('ColumnRows', columns.rows, COUNT)
+    print 'pgaudit columns have %s rows (%s records dropped) in %s row groups' % (
+        columns.rows, columns.dropped, len(columns.row_groups))
+
+def upload_columns(archive_name, log_files, metrics=NULL_METRICS):
+    """ parses log_files' pgaudit records into a columns archive, uploading it as it is created.
+    returns the archive id, and the bytes of log archived. """
+    sink = get_archive_store().open(archive_name)
+    archived_bytes = 0
+    try:
+        columns = make_column_writer(sink, metrics)
+        for log_file, size, chunks in iter_log_contents(log_files, metrics):
+            start = time.time()
+            columns.add(log_file['LogFileName'], chunks)
+            archived_bytes += size
+            metrics.log_file(log_file, get_arcname(log_file), time.time() - start, size)
+        columns.close()
+        with metrics.timer('UploadWait'):
+            archive_id = sink.close()
+    except Exception:
+        sink.abort()
+        raise
+    add_upload_metrics(metrics, sink)
+    add_column_metrics(metrics, columns)
+    return archive_id, archived_bytes
+
+def upload(archive_name, log_files, metrics=NULL_METRICS):
+    """ compresses log_files into an archive, uploading it as it is created.
+    with PGAUDIT_COLUMNS=alongside, a columns archive is uploaded with it, and with
+    PGAUDIT_COLUMNS=instead, only a columns archive is.
+    returns the archive id, and the bytes of log archived: what was read of each log, after filtering. """
+    if PGAUDIT_COLUMNS == 'instead':
+        return upload_columns(archive_name, log_files, metrics)
+    archive_store = get_archive_store()
+    sink = archive_store.open(archive_name)
+    columns_sink = columns = None
+    if PGAUDIT_COLUMNS == 'alongside':
+        columns_name = get_columns_name(archive_name, CODEC.extension)
+        columns_sink = archive_store.open(columns_name)
+    try:
+        if columns_sink is not None:
+            columns = make_column_writer(columns_sink, metrics)
+        members, archived_bytes = make_tar(log_files, sink, metrics, columns)
+        if columns is not None:
+            columns.close()
+        with metrics.timer('UploadWait'):
+            if columns_sink is not None:
+                columns_id = columns_sink.close()
+            archive_id = sink.close()
+    except Exception:
+        sink.abort()
+        if columns_sink is not None:
+            columns_sink.abort()
+        raise
+    add_upload_metrics(metrics, sink)
+    if columns is not None:
+        add_upload_metrics(metrics, columns_sink)
+        add_column_metrics(metrics, columns)
+        print 'Uploaded pgaudit columns: %s (%s)' % (columns_name, columns_id)
+    if ARCHIVE_INDEX:
+        upload_index(archive_store, archive_name, archive_id, sink.size, members)
+    return archive_id, archived_bytes
+
+def archive_shard(event, metrics=None):
+    '''fan-out worker: archives the log files listed in a worker event.
+    a worker logs its own metrics; otherwise they are added to the run's.'''
+    archive_name = event['archive_name']
+    log_files = event['log_files']
+    worker_metrics = None
+    if metrics is None:
+        metrics = worker_metrics = get_metrics(log_files[0].get('DBInstanceIdentifier', DB_INSTANCE_IDENTIFIER))
+    print 'Archive has: %s files' % len(log_files)
+    archive_id, archived_bytes = upload(archive_name, log_files, metrics)
+    print 'Successfully uploaded archive: %s' % archive_name
+    print 'Archive ID: %s' % archive_id
+    if event.get('checkpoint_uri'):
+        # the coordinator checkpointed this shard as pending; the next run records it as archived.
+        get_checkpoint_store(event['checkpoint_uri']).mark_done(archive_name)
+    if worker_metrics is not None:
+        worker_metrics.emit(ArchiveName=archive_name)
+    return {'archive_name': archive_name, 'archive_id': archive_id, 'bytes': archived_bytes}
+
+def fan_out(archive_base_name, log_files, dispatcher, metrics=NULL_METRICS, checkpoint=None,
+            checkpoint_store=None, checkpoint_uri=None):
+    '''fan-out coordinator: splits log_files into shards, and dispatches one worker per shard.
+    with a checkpoint, the shards are checkpointed as pending before they are dispatched, and the
+    logs archived here as archived. returns the archive names, and the bytes of log archived: by
+    this invocation and workers that ran in process, and the listed size of shards sent elsewhere.'''
+    # logs read from a portion marker are checkpointed with the marker they end at, which only
+    # the invocation reading them sees, so they are archived here rather than by a worker.
+    local_files = [log_file for log_file in log_files if 'Marker' in log_file]
+    shards = make_shards([log_file for log_file in log_files if 'Marker' not in log_file], FANOUT_SHARD_SIZE)
+    events = [
+        make_worker_event(get_shard_archive_name(archive_base_name, i, len(shards), get_archive_extension()), shard,
+                          checkpoint_uri)
+        for i, shard in enumerate(shards)
+    ]
+    local_archive_name = archive_base_name + get_archive_extension()
+    if local_files:
+        local_event = make_worker_event(local_archive_name, local_files)
+        manifest = make_manifest(archive_base_name, events + [local_event])
+    else:
+        manifest = make_manifest(archive_base_name, events)
+
+    manifest_name = archive_base_name + '-manifest.json'
+    manifest_id = get_archive_store().put(manifest_name, manifest)
+    print 'Uploaded manifest: %s (%s)' % (manifest_name, manifest_id)
+
+    if checkpoint_store:
+        checkpoint.add_shards(events)
+        checkpoint_store.save(checkpoint)
+    archived_bytes = 0
+    for event in events:
+        result = dispatcher.dispatch(event)
+        if result is not None:
+            archived_bytes += result['bytes']
+        else:
+            # an asynchronous worker reports what it archived in its own metrics.
+            archived_bytes += sum(log_file['Size'] for log_file in event['log_files'])
+    print 'Dispatched %s shards' % len(events)
+
+    archive_names = [event['archive_name'] for event in events]
+    if local_files:
+        _, local_bytes = upload(local_archive_name, local_files, metrics)
+        archived_bytes += local_bytes
+        if checkpoint_store:
+            checkpoint.record(local_files)
+        archive_names.append(local_archive_name)
+    return archive_names, archived_bytes
+
+def get_dispatcher(context):
+    '''fan-out workers are invocations of this same lambda, or just run in process when running locally'''
+    if context is None:
+        return InProcessDispatcher(lambda_handler)
+    return LambdaDispatcher(boto3.client('lambda'), context.invoked_function_arn)
+
+def get_checkpoint_uri(db_instance):
+    return get_instance_checkpoint_uri(CHECKPOINT_URI, db_instance) if MULTI_INSTANCE else CHECKPOINT_URI
+
+def reconcile_shards(checkpoint, checkpoint_store):
+    '''records the pending shards whose fan-out workers have finished, and reports those that never will'''
+    done = checkpoint.reconcile(checkpoint_store)
+    if done:
+        checkpoint_store.save(checkpoint)
+        for archive_name in done:
+            checkpoint_store.clear_done(archive_name)
+        print 'Fan-out workers archived: %s' % ', '.join(done)
+    for archive_name in checkpoint.timed_out_shards():
+        print 'Shard %s was never archived, its logs will be archived again' % archive_name
+
+def archive_instance(db_instance, dispatcher=None, checkpoint_store=None):
+    '''Downloads, compresses and uploads an instance's logs in a single pass.
+    Nothing is written to disk, and only a few parts' worth of data are held in memory at a time.
+    With FANOUT_SHARD_MB set, large runs are split across several invocations by dispatcher.
+    Returns the number of 'log_files' and 'bytes' archived, and the 'archive_names' they went to.
+    'bytes' is what was actually archived, which for logs archived from a portion marker on is less
+    than their 'Size'.
     '''
-    rds_client = boto3.client('rds')
+    rds_client = get_rds_client()
+    metrics = get_metrics(db_instance)
 
-    filenames = list_files(rds_client)
-    files = []
+    checkpoint = checkpoint_store.load() if checkpoint_store else None
+    if checkpoint is not None:
+        reconcile_shards(checkpoint, checkpoint_store)
 
-    for filename in filenames:
-        filename = TEMP_DIR + '/' + filename
-        make_dirs_for_path(filename)
-        file = download(rds_client, filename)
-        files.append((filename, file))
+    try:
+        with metrics.timer('ListTime'):
+            log_files = list_files(rds_client, checkpoint, db_instance)
+    except Exception as e:
+        metrics.emit(Error=repr(e))
+        raise
+    if not log_files:
+        print 'No new log files to archive for %s' % db_instance
+        metrics.emit()
+        return {'log_files': 0, 'bytes': 0, 'archive_names': []}
 
     archive_timestamp = arrow.utcnow().format('YYYY-MM-DD__HH-mm-ss__UTC')
-    archive_base_name = "{0}-{1}.tar".format(DB_INSTANCE_IDENTIFIER, archive_timestamp)
-    archive_name = os.path.join(TEMP_DIR, archive_base_name)
-    make_dirs_for_path(archive_name)
-    archive = make_tar(files, archive_name)
+    archive_base_name = "{0}-{1}".format(db_instance, archive_timestamp)
+
+    size = sum(log_file['Size'] for log_file in log_files)
+    fanned_out = FANOUT_SHARD_SIZE and size > FANOUT_SHARD_SIZE
+    try:
+        if fanned_out:
+            archive_names, archived_bytes = fan_out(archive_base_name, log_files, dispatcher or get_dispatcher(None), metrics,
+                                    checkpoint, checkpoint_store, get_checkpoint_uri(db_instance))
+        else:
+            archive_name = archive_base_name + get_archive_extension()
+            result = archive_shard({'archive_name': archive_name, 'log_files': log_files}, metrics)
+            archive_names = [result['archive_name']]
+            archived_bytes = result['bytes']
+    except Exception as e:
+        metrics.emit(Error=repr(e))
+        raise
+    metrics.emit(ArchiveNames=archive_names)
 
-    print 'Archive Created'
-    print 'Archive has: %s files' % len(filenames)
+    # fanned out shards were checkpointed as pending when they were dispatched, and the logs archived
+    # here as archived. workers that have already finished (in process, say) are recorded now, and
+    # lambda workers by a later run.
+    if checkpoint_store:
+        if not fanned_out:
+            checkpoint.record(log_files)
+        checkpoint_store.save(checkpoint)
+        if fanned_out:
+            reconcile_shards(checkpoint, checkpoint_store)
+    return {'log_files': len(log_files), 'bytes': archived_bytes, 'archive_names': archive_names}
 
-    upload(archive_name, archive)
-    print 'Successfully uploaded archive: %s' % archive_name
-    print 'Deleting temporary directory'
-    shutil.rmtree(TEMP_DIR)
+def archive_fleet(dispatcher=None):
+    '''archives every instance of DB_INSTANCE_IDENTIFIERS and DB_INSTANCE_TAG, INSTANCE_THREADS at a time'''
+    db_instances = get_db_instances(get_rds_client(), DB_INSTANCE_IDENTIFIERS, DB_INSTANCE_TAG, _rds_api_limiter)
+    print 'Archiving %s instances: %s' % (len(db_instances), ', '.join(db_instances))
+
+    # boto3 clients can be shared by threads, but not safely created by several at once.
+    get_archive_store()
+    s3_client = boto3.client('s3') if CHECKPOINT_URI and CHECKPOINT_URI.startswith('s3://') else None
+    checkpoint_stores = dict(
+        (db_instance, get_checkpoint_store(get_checkpoint_uri(db_instance), s3_client))
+        for db_instance in db_instances
+    )
+
+    def archive(db_instance):
+        return archive_instance(db_instance, dispatcher, checkpoint_stores[db_instance])
+
+    results = archive_instances(db_instances, archive, INSTANCE_THREADS)
+    for result in results:
+        print format_result(result)
+    failed = [result['db_instance'] for result in results if result['status'] == FAILED]
+    if failed:
+        # the instances that were archived are checkpointed, so with CHECKPOINT_URI set, a retry
+        # archives the failed instances' logs and not the others' again.
+        raise Exception('Failed to archive %s of %s instances: %s' % (len(failed), len(results), ', '.join(failed)))
+    return results
+
+def main(dispatcher=None):
+    if MULTI_INSTANCE:
+        return archive_fleet(dispatcher)
+    return archive_instance(DB_INSTANCE_IDENTIFIER, dispatcher, get_checkpoint_store(CHECKPOINT_URI))
 
 
 def lambda_handler(event, context):
-    main()
+    if is_worker_event(event):
+        return archive_shard(event)
+    main(get_dispatcher(context))
 
 if __name__ == "__main__":
     main()
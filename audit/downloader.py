@@ -0,0 +1,143 @@
+"""
+Concurrent Log Downloader
+
+Downloads log files with a pool of worker threads, while still handing them to the archive
+one at a time, in their original order.
+
+Prefetched files are held in memory until the archive is ready for them, so the total size of
+prefetched files is capped by a byte budget. A file larger than the whole budget is never
+prefetched into memory; it is spooled to a temporary file instead, one at a time. Either way the
+archive is only handed a file once all of it has been read, so its size is exact: the tar header
+needs it up front, and describe_db_log_files' Size may not be.
+
+Downloads that fail part way through are resumed rather than restarted, so chunks that have
+already been handed on are never repeated.
+"""
+import collections
+import concurrent.futures
+import tempfile
+import threading
+import time
+
+DOWNLOAD_ATTEMPTS = 3
+# spooled files are read back in pieces of this size.
+SPOOL_READ_SIZE = 1024 * 1024
+
+
+def resumable_download(download, log_file, attempts=DOWNLOAD_ATTEMPTS):
+    """ stream a log file, retrying with a backoff on errors.
+
+    a retry continues from the last good byte offset: the bytes before it are read again but
+    dropped, since the REST endpoint has no range requests.
+    """
+    offset = 0
+    for attempt in range(attempts):
+        skip = offset
+        try:
+            for chunk in download(log_file):
+                if skip:
+                    if len(chunk) <= skip:
+                        skip -= len(chunk)
+                        continue
+                    chunk = chunk[skip:]
+                    skip = 0
+                offset += len(chunk)
+                yield chunk
+            return
+        except Exception as e:
+            if attempt == attempts - 1:
+                raise
+            print 'Failed to download %s at byte %s (%r), resuming.' % (log_file['LogFileName'], offset, e)
+            time.sleep(2 ** attempt)
+
+
+def download_with_retries(download, log_file, attempts=DOWNLOAD_ATTEMPTS):
+    """ download a whole log file into a list of chunks. """
+    return list(resumable_download(download, log_file, attempts))
+
+
+def spool_download(download, log_file, attempts=DOWNLOAD_ATTEMPTS):
+    """ download a whole log file into a temporary file. returns (size, chunks): the chunks read
+    it back, and delete it once they have all been read. """
+    spool = tempfile.TemporaryFile()
+    try:
+        for chunk in resumable_download(download, log_file, attempts):
+            spool.write(chunk)
+        size = spool.tell()
+        spool.seek(0)
+    except Exception:
+        spool.close()
+        raise
+    return size, iter_spooled(spool)
+
+
+def iter_spooled(spool):
+    try:
+        for chunk in iter(lambda: spool.read(SPOOL_READ_SIZE), b''):
+            yield chunk
+    finally:
+        spool.close()
+
+
+def must_prefetch(log_file):
+    """ files read from a portion marker have no known size up front, so they are never spooled. """
+    return 'Marker' in log_file
+
+
+def iter_downloads(log_files, download, num_workers, budget, attempts=DOWNLOAD_ATTEMPTS):
+    """ download log_files concurrently, yielding (log_file, size, chunks) in the original order.
+
+    download(log_file) must return an iterator of byte chunks. Once the caller asks for the next
+    file it is done with the previous one, and that file's share of the budget is released. A file
+    reserves its Size (or the whole budget, if that's less) until it has been downloaded, and then
+    what was actually read.
+    """
+    log_files = list(log_files)
+    # (log_file, future, spooled) of the files started, in order. each future returns (size, chunks).
+    window = collections.deque()
+    state = {'next': 0, 'reserved': 0, 'spooled': 0}
+    lock = threading.Lock()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_workers)
+
+    def prefetch(log_file, reserved):
+        chunks = download_with_retries(download, log_file, attempts)
+        size = sum(len(chunk) for chunk in chunks)
+        with lock:
+            state['reserved'] += size - reserved
+        return size, chunks
+
+    def fill_window():
+        while state['next'] < len(log_files):
+            log_file = log_files[state['next']]
+            size = min(log_file['Size'], budget)
+            if log_file['Size'] > budget and not must_prefetch(log_file):
+                # too big to ever prefetch into memory: spooled to disk, one file at a time.
+                if state['spooled']:
+                    return
+                state['spooled'] += 1
+                window.append((log_file, executor.submit(spool_download, download, log_file, attempts), True))
+            else:
+                with lock:
+                    if state['reserved'] + size > budget:
+                        return
+                    state['reserved'] += size
+                window.append((log_file, executor.submit(prefetch, log_file, size), False))
+            state['next'] += 1
+
+    try:
+        fill_window()
+        while window:
+            log_file, future, spooled = window.popleft()
+            size, chunks = future.result()
+            yield log_file, size, chunks
+            del chunks, future
+            if spooled:
+                state['spooled'] -= 1
+            else:
+                with lock:
+                    state['reserved'] -= size
+            fill_window()
+    finally:
+        for log_file, future, spooled in window:
+            future.cancel()
+        executor.shutdown(wait=False)
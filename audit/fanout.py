@@ -0,0 +1,127 @@
+"""
+Fan-out
+
+Splits a run that is too big for one lambda invocation into shards, each archived by its own
+worker invocation of the same lambda.
+
+The coordinator lists the log files, groups them (in order) into shards of at most
+FANOUT_SHARD_MB of logs each, and sends every shard to a worker. Each worker downloads,
+compresses and uploads its shard as its own archive. The coordinator also uploads a small
+json manifest archive listing every shard's archive and log files.
+
+Worker event payload:
+
+    {
+        "mode": "worker",
+        "archive_name": "<instance>-<timestamp>-shard-001-of-004.tar.gz",
+        "log_files": [
+            {"DBInstanceIdentifier": "<instance>", "LogFileName": "error/postgresql.log.2018-05-16-22",
+             "LastWritten": 1526511600000, "Size": 1234},
+            ...
+        ],
+        "checkpoint_uri": "s3://bucket/checkpoint.json"
+    }
+
+Workers are dispatched with a dispatcher: LambdaDispatcher invokes the lambda asynchronously,
+and InProcessDispatcher just calls the worker handler, for running and testing locally.
+
+With checkpoints on, the coordinator checkpoints the shards as pending before dispatching them,
+and a worker marks its shard done next to the checkpoint (checkpoint_uri) once its archive is
+uploaded. Nothing waits for the workers: the next run records the shards that are done, and
+archives the logs of those that never will be again. See checkpoint.py.
+"""
+import json
+
+WORKER_MODE = 'worker'
+# what a worker needs to know about each log file
+LOG_FILE_KEYS = ('DBInstanceIdentifier', 'LogFileName', 'LastWritten', 'Size', 'Marker')
+
+
+def make_shards(log_files, max_shard_size):
+    """ split log_files into consecutive groups of at most max_shard_size bytes.
+
+    a single log larger than max_shard_size gets a shard of its own.
+    """
+    shards = []
+    shard = []
+    shard_size = 0
+    for log_file in log_files:
+        if shard and shard_size + log_file['Size'] > max_shard_size:
+            shards.append(shard)
+            shard = []
+            shard_size = 0
+        shard.append(log_file)
+        shard_size += log_file['Size']
+    if shard:
+        shards.append(shard)
+    return shards
+
+
+def get_shard_archive_name(archive_base_name, index, count, extension):
+    return '{0}-shard-{1:03d}-of-{2:03d}{3}'.format(archive_base_name, index + 1, count, extension)
+
+
+def make_worker_event(archive_name, log_files, checkpoint_uri=None):
+    event = {
+        'mode': WORKER_MODE,
+        'archive_name': archive_name,
+        'log_files': [
+            dict((key, log_file[key]) for key in LOG_FILE_KEYS if key in log_file)
+            for log_file in log_files
+        ],
+    }
+    if checkpoint_uri:
+        event['checkpoint_uri'] = checkpoint_uri
+    return event
+
+
+def is_worker_event(event):
+    return isinstance(event, dict) and event.get('mode') == WORKER_MODE
+
+
+def make_manifest(archive_base_name, worker_events):
+    return json.dumps({
+        'version': 1,
+        'run': archive_base_name,
+        'shards': [
+            {
+                'archive_name': event['archive_name'],
+                'log_files': [log_file['LogFileName'] for log_file in event['log_files']],
+                'size': sum(log_file['Size'] for log_file in event['log_files']),
+            }
+            for event in worker_events
+        ],
+    }, indent=2, sort_keys=True)
+
+
+class LambdaDispatcher(object):
+    """ sends each shard to an asynchronous invocation of a lambda function. """
+
+    def __init__(self, lambda_client, function_name):
+        self.lambda_client = lambda_client
+        self.function_name = function_name
+
+    def dispatch(self, event):
+        """ returns nothing, the invocation's result isn't known until it has run. """
+        response = self.lambda_client.invoke(
+            FunctionName=self.function_name,
+            InvocationType='Event',
+            Payload=json.dumps(event),
+        )
+        if response['StatusCode'] != 202:
+            raise Exception('failed to dispatch %s: %s' % (event['archive_name'], response))
+
+
+class InProcessDispatcher(object):
+    """ archives each shard right away, in this process. handler is the lambda handler. """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.results = []
+
+    def dispatch(self, event):
+        """ returns the handler's result, where LambdaDispatcher can't know it. """
+        # round trip through json, so events behave exactly as they would when sent to a lambda.
+        result = self.handler(json.loads(json.dumps(event)), None)
+        self.results.append(result)
+        return result
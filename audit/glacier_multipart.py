@@ -0,0 +1,108 @@
+"""
+Glacier Multipart Upload
+
+A reusable version of the thread pooled multipart uploader from glacier-upload/src/upload.py.
+Parts are handed to the uploader as they are produced, and uploaded concurrently while the
+caller keeps producing the rest of the archive. See multipart.py for what it has in common with
+the s3 uploader.
+"""
+import binascii
+import hashlib
+
+from multipart import MAX_ATTEMPTS, BaseMultipartUploader
+from retries import ChecksumMismatch
+
+ONE_MB = 1024 * 1024
+# an upload can have at most 10,000 parts, so an archive at most 10,000 * part_size bytes.
+MAX_PARTS = 10000
+
+
+def calculate_tree_hash(part):
+    """ glacier SHA256 tree hash of part, returned as a hex string. """
+    return binascii.hexlify(_tree_hash(part))
+
+
+def calculate_total_tree_hash(list_of_checksums):
+    """ combine the hex tree hashes of consecutive parts into the tree hash of the whole archive. """
+    return binascii.hexlify(_combine_tree_hashes([binascii.unhexlify(c) for c in list_of_checksums]))
+
+
+def _tree_hash(data):
+    view = memoryview(data)
+    leaves = [hashlib.sha256(view[pos:pos + ONE_MB]).digest() for pos in range(0, len(data), ONE_MB)]
+    return _combine_tree_hashes(leaves or [hashlib.sha256(b'').digest()])
+
+
+def _combine_tree_hashes(hashes):
+    tree = list(hashes)
+    while len(tree) > 1:
+        parent = []
+        for i in range(0, len(tree) - 1, 2):
+            parent.append(hashlib.sha256(tree[i] + tree[i + 1]).digest())
+        if len(tree) % 2:
+            parent.append(tree[-1])
+        tree = parent
+    return tree[0]
+
+
+class MultipartUploader(BaseMultipartUploader):
+    """ uploads an archive to glacier as a series of parts, num_threads at a time.
+
+    usage:
+        uploader = MultipartUploader(glacier_client, vault_name, description, part_size)
+        for part in parts:
+            uploader.submit(part)
+        archive_id = uploader.complete()
+
+    every part except the last must be exactly part_size bytes.
+    """
+
+    max_parts = MAX_PARTS
+
+    def __init__(self, glacier_client, vault_name, description, part_size, num_threads=4,
+                 max_attempts=MAX_ATTEMPTS):
+        if part_size < ONE_MB or part_size > 4096 * ONE_MB or part_size & (part_size - 1):
+            raise ValueError('part_size must be a power of 2, between 1MB and 4096MB')
+        super(MultipartUploader, self).__init__(part_size, num_threads, max_attempts)
+        self.glacier_client = glacier_client
+        self.vault_name = vault_name
+        self.description = description
+
+    def initiate(self):
+        response = self.glacier_client.initiate_multipart_upload(
+            vaultName=self.vault_name,
+            archiveDescription=self.description,
+            partSize=str(self.part_size),
+        )
+        return response['uploadId']
+
+    def upload_part(self, part_number, byte_pos, part):
+        """ glacier checks the part against its tree hash; we check glacier got the same one. """
+        checksum = calculate_tree_hash(part)
+        response = self.glacier_client.upload_multipart_part(
+            vaultName=self.vault_name,
+            uploadId=self.upload_id,
+            range='bytes {0}-{1}/*'.format(byte_pos, byte_pos + len(part) - 1),
+            checksum=checksum,
+            body=part,
+        )
+        if response['checksum'] != checksum:
+            raise ChecksumMismatch('checksums do not match for part at byte %s' % byte_pos)
+        return checksum
+
+    def complete_upload(self, checksums):
+        response = self.glacier_client.complete_multipart_upload(
+            vaultName=self.vault_name,
+            uploadId=self.upload_id,
+            archiveSize=str(self.bytes_submitted),
+            checksum=calculate_total_tree_hash(checksums),
+        )
+        if 'archiveId' not in response:
+            raise Exception('failed to complete upload: %s' % self.description)
+        return response['archiveId']
+
+    def abort_upload(self):
+        self.glacier_client.abort_multipart_upload(
+            vaultName=self.vault_name,
+            uploadId=self.upload_id,
+        )
@@ -0,0 +1,160 @@
+"""
+Multi-instance Mode
+
+Archives the logs of a whole fleet of RDS instances from one lambda, instead of a stack per
+instance. The instances are either listed, DB_INSTANCE_IDENTIFIERS=db1,db2,db3, or found by a tag,
+DB_INSTANCE_TAG=key=value, in which case every instance with that tag is archived.
+
+INSTANCE_THREADS instances are archived at once. Each gets its own archives (named after it, like a
+single instance's) and its own checkpoint, but the instances share:
+
+- DOWNLOAD_THREADS: the most log reads at once, by all instances together, so a few small
+  instances don't each hold a full set of download workers. See DownloadLimits.
+- DOWNLOAD_BUDGET_MB: split evenly between the instances archived at once.
+- MAX_DOWNLOAD_MBPS: the most MB a second downloaded, by all instances together.
+- RDS_API_RATE: the most DescribeDBLogFiles (and DescribeDBInstances) calls a second, by all
+  instances together, so listing many instances at once doesn't get them all throttled.
+
+An instance that fails doesn't stop the others. Once every instance is done, a line is printed for
+each one, and the run fails if any of them did.
+"""
+import concurrent.futures
+import threading
+import time
+import traceback
+
+ARCHIVED = 'archived'
+NOTHING_NEW = 'nothing new'
+FAILED = 'failed'
+
+
+class RateLimiter(object):
+    """ spaces calls out, across threads, to at most rate a second.
+
+    wait(cost) counts as cost calls, so a limiter of bytes a second can pace downloads by the size
+    of each chunk. a rate of 0 is no limit.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next_at = 0
+        self._lock = threading.Lock()
+
+    def wait(self, cost=1):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            start_at = max(now, self._next_at)
+            self._next_at = start_at + cost * self.interval
+        if start_at > now:
+            time.sleep(start_at - now)
+
+
+class DownloadLimits(object):
+    """ caps the downloads of every instance together, to max_downloads reads at once and
+    bytes_per_second (or no limit, if it is 0).
+
+    a slot is only held while a chunk is read (a response read, or a portion requested), not while
+    the chunk is archived: a log streamed into a tar is read as fast as it is compressed, and
+    holding a slot for all of it would keep the other instances waiting on that. """
+
+    def __init__(self, max_downloads, bytes_per_second=0):
+        self.slots = threading.BoundedSemaphore(max_downloads)
+        self.bandwidth = RateLimiter(bytes_per_second)
+
+    def limit(self, download):
+        """ wraps download(log_file), which returns an iterator of chunks, in the limits. """
+        def limited_download(log_file):
+            chunks = iter(download(log_file))
+            while True:
+                with self.slots:
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    return
+                self.bandwidth.wait(len(chunk))
+                yield chunk
+        return limited_download
+
+
+def parse_tag(value):
+    """ the (key, value) of a DB_INSTANCE_TAG, key=value """
+    key, sep, tag_value = value.partition('=')
+    if not sep or not key:
+        raise ValueError('DB_INSTANCE_TAG must look like key=value, got: %s' % value)
+    return key, tag_value
+
+
+def get_tags(rds_client, instance, limiter):
+    # newer apis list the tags with the instance; older ones need a call of their own.
+    if 'TagList' in instance:
+        return instance['TagList']
+    limiter.wait()
+    return rds_client.list_tags_for_resource(ResourceName=instance['DBInstanceArn'])['TagList']
+
+
+def find_tagged_instances(rds_client, tag, limiter):
+    """ the identifiers of every instance with the tag, key=value """
+    key, value = parse_tag(tag)
+    identifiers = []
+    marker = None
+    while True:
+        limiter.wait()
+        if marker:
+            response = rds_client.describe_db_instances(Marker=marker)
+        else:
+            response = rds_client.describe_db_instances()
+        for instance in response['DBInstances']:
+            tags = get_tags(rds_client, instance, limiter)
+            if any(t['Key'] == key and t['Value'] == value for t in tags):
+                identifiers.append(instance['DBInstanceIdentifier'])
+        marker = response.get('Marker')
+        if not marker:
+            return identifiers
+
+
+def get_db_instances(rds_client, identifiers, tag, limiter):
+    """ the instances to archive: those listed in identifiers, and those with the tag. """
+    db_instances = [identifier.strip() for identifier in (identifiers or '').split(',') if identifier.strip()]
+    if tag:
+        db_instances.extend(find_tagged_instances(rds_client, tag, limiter))
+    # in order, without duplicates
+    seen = set()
+    return [db_instance for db_instance in db_instances if not (db_instance in seen or seen.add(db_instance))]
+
+
+def archive_instances(db_instances, archive_instance, num_threads):
+    """ calls archive_instance(db_instance) for each instance, num_threads at a time.
+
+    archive_instance returns a dict describing what it archived. returns one for each instance,
+    in order, with the instance's 'db_instance', 'status' and 'seconds' added, and the 'error' it
+    failed with, if it did.
+    """
+    def run(db_instance):
+        start = time.time()
+        try:
+            result = archive_instance(db_instance)
+            result['status'] = ARCHIVED if result.get('log_files') else NOTHING_NEW
+        except Exception as e:
+            print 'Failed to archive %s:' % db_instance
+            traceback.print_exc()
+            result = {'status': FAILED, 'error': repr(e)}
+        result['db_instance'] = db_instance
+        result['seconds'] = round(time.time() - start, 1)
+        return result
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, num_threads))
+    try:
+        return list(executor.map(run, db_instances))
+    finally:
+        executor.shutdown(wait=True)
+
+
+def format_result(result):
+    if result['status'] == FAILED:
+        return '%s: failed after %ss: %s' % (result['db_instance'], result['seconds'], result['error'])
+    if result['status'] == NOTHING_NEW:
+        return '%s: no new log files' % result['db_instance']
+    return '%s: archived %s log files (%.1f MB) in %ss, to %s' % (
+        result['db_instance'], result['log_files'], result['bytes'] / 1024.0 / 1024,
+        result['seconds'], ', '.join(result['archive_names']))
@@ -0,0 +1,225 @@
+"""
+Run Metrics
+
+With METRICS=true, each run records how long each stage took and how many bytes went through it,
+and logs them as json lines in CloudWatch's Embedded Metric Format, which CloudWatch turns into
+metrics in the METRICS_NAMESPACE namespace, by DBInstanceIdentifier:
+
+- a line for each log archived, when it has been added to the archive: its DownloadBytes,
+  DownloadTime and DownloadRetries, its ArchiveTime (from starting to add it, to having added it)
+  and the Bytes it was archived as before compression, and after (CompressedBytes, with
+  ARCHIVE_INDEX on). Its name is in LogFileName, and its tar member's in Member: a filtered log
+  can be split into several members, each with a line of its own.
+- a line for the run, once it is done: the totals of those, and ListTime, FilterTime,
+  CompressTime, UploadWait (the archive waiting for a part to upload), UploadTime and
+  UploadRetries, CompressionRatio, RunTime and the process's PeakMemory so far. With PGAUDIT_COLUMNS
+  on, also ColumnsTime (parsing the pgaudit records into columns) and ColumnRows.
+
+Downloads and uploads run on several threads, so their times add up to more than the RunTime.
+The archive is written on one thread, in a pipeline, so its slowest stage is the one taking most
+of the ArchiveTime: downloading (what none of FilterTime, CompressTime and UploadWait account for),
+filtering, compressing, or waiting for uploads.
+
+With METRICS off, get_metrics() returns NULL_METRICS, whose methods do nothing and whose wrappers
+return what they wrap, so the archive is written exactly as it would be without metrics.
+"""
+import contextlib
+import json
+import resource
+import threading
+import time
+
+BYTES = 'Bytes'
+COUNT = 'Count'
+MILLISECONDS = 'Milliseconds'
+MEGABYTES = 'Megabytes'
+NONE = 'None'
+
+
+def get_peak_memory():
+    """ the peak resident memory of the process, in MB. linux reports ru_maxrss in KB. """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class TimedCompressor(object):
+    """ a compressor that adds the time spent in it to metrics' CompressTime. """
+
+    def __init__(self, compressor, metrics):
+        self.compressor = compressor
+        self.metrics = metrics
+
+    def compress(self, data):
+        start = time.time()
+        try:
+            return self.compressor.compress(data)
+        finally:
+            self.metrics.add('CompressTime', (time.time() - start) * 1000, MILLISECONDS)
+
+    def flush(self):
+        start = time.time()
+        try:
+            return self.compressor.flush()
+        finally:
+            self.metrics.add('CompressTime', (time.time() - start) * 1000, MILLISECONDS)
+
+
+class TimedWriter(object):
+    """ a file object that adds the time spent writing to (and closing) fileobj to metrics' name. """
+
+    def __init__(self, fileobj, metrics, name):
+        self.fileobj = fileobj
+        self.metrics = metrics
+        self.name = name
+
+    def write(self, data):
+        start = time.time()
+        try:
+            self.fileobj.write(data)
+        finally:
+            self.metrics.add(self.name, (time.time() - start) * 1000, MILLISECONDS)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+class Metrics(object):
+    """ the metrics of one run, for one instance. can be added to from any thread. """
+
+    enabled = True
+
+    def __init__(self, namespace, dimensions):
+        self.namespace = namespace
+        self.dimensions = dimensions
+        self.start = time.time()
+        # name -> [value, unit], in the order they were first added
+        self.values = {}
+        self.names = []
+        # log file name -> its download metrics, until it is archived
+        self.downloads = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, value, unit=COUNT):
+        with self._lock:
+            if name not in self.values:
+                self.values[name] = [0, unit]
+                self.names.append(name)
+            self.values[name][0] += value
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, (time.time() - start) * 1000, MILLISECONDS)
+
+    def wrap_download(self, download):
+        """ wraps download(log_file), recording each log's size, download time and retries. """
+        def measured_download(log_file):
+            with self._lock:
+                stats = self.downloads.setdefault(log_file['LogFileName'], {'attempts': 0, 'bytes': 0, 'seconds': 0})
+                stats['attempts'] += 1
+            start = time.time()
+            try:
+                for chunk in download(log_file):
+                    stats['bytes'] += len(chunk)
+                    yield chunk
+            finally:
+                stats['seconds'] += time.time() - start
+        return measured_download
+
+    def wrap_compressor(self, compressor):
+        return TimedCompressor(compressor, self)
+
+    def wrap_writer(self, fileobj, name):
+        return TimedWriter(fileobj, self, name)
+
+    def record(self, values, **properties):
+        """ an embedded metric format record of values, a dict of name -> (value, unit). """
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [sorted(self.dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in values],
+                }],
+            },
+        }
+        record.update(self.dimensions)
+        record.update(properties)
+        for name, (value, unit) in values:
+            record[name] = round(value, 3) if isinstance(value, float) else value
+        return json.dumps(record, sort_keys=True)
+
+    def log_file(self, log_file, member, archive_seconds, size, compressed_size=None):
+        """ logs the metrics of a tar member that has just been archived, and adds them to the run's.
+        a log's download metrics go with its first member. """
+        with self._lock:
+            stats = self.downloads.pop(log_file['LogFileName'], None)
+        values = [('ArchiveTime', (archive_seconds * 1000, MILLISECONDS)), ('Bytes', (size, BYTES))]
+        if compressed_size is not None:
+            values.append(('CompressedBytes', (compressed_size, BYTES)))
+        if stats is not None:
+            values.extend([
+                ('DownloadBytes', (stats['bytes'], BYTES)),
+                ('DownloadTime', (stats['seconds'] * 1000, MILLISECONDS)),
+                ('DownloadRetries', (stats['attempts'] - 1, COUNT)),
+            ])
+        self.add('LogFiles', 1)
+        for name, (value, unit) in values:
+            self.add(name, value, unit)
+        print self.record(values, LogFileName=log_file['LogFileName'], Member=member)
+
+    def emit(self, **properties):
+        """ logs the run's metrics. """
+        with self._lock:
+            tar_bytes = self.values.get('TarBytes', [0])[0]
+            archive_bytes = self.values.get('ArchiveBytes', [0])[0]
+        if archive_bytes:
+            self.add('CompressionRatio', float(tar_bytes) / archive_bytes, NONE)
+        self.add('RunTime', (time.time() - self.start) * 1000, MILLISECONDS)
+        self.add('PeakMemory', get_peak_memory(), MEGABYTES)
+        with self._lock:
+            values = [(name, tuple(self.values[name])) for name in self.names]
+        print self.record(values, **properties)
+
+
+class NullMetrics(object):
+    """ metrics that are turned off. """
+
+    enabled = False
+
+    def add(self, name, value, unit=COUNT):
+        pass
+
+    def timer(self, name):
+        return NULL_TIMER
+
+    def wrap_download(self, download):
+        return download
+
+    def wrap_compressor(self, compressor):
+        return compressor
+
+    def wrap_writer(self, fileobj, name):
+        return fileobj
+
+    def log_file(self, log_file, member, archive_seconds, size, compressed_size=None):
+        pass
+
+    def emit(self, **properties):
+        pass
+
+
+class NullTimer(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = NullTimer()
+NULL_METRICS = NullMetrics()
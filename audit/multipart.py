@@ -0,0 +1,156 @@
+"""
+Multipart Upload
+
+What the glacier and s3 multipart uploaders (glacier_multipart.py, s3_multipart.py) have in common:
+parts are handed to the uploader as they are produced, and uploaded num_threads at a time while
+the caller keeps producing the rest of the archive. a part that fails is retried, after a backoff
+(see retries.py), unless retrying can't help.
+
+Memory use is bounded: at most num_threads parts are queued or in flight at any time, and
+submit() blocks until a slot frees up.
+"""
+import concurrent.futures
+import threading
+import time
+
+from retries import FATAL, backoff_delay, classify_error
+
+MAX_ATTEMPTS = 10
+
+
+def upload_with_retries(upload, description, max_attempts=MAX_ATTEMPTS, on_retry=None):
+    """ calls upload() until it returns, at most max_attempts times, and returns what it returned.
+    throttling and transient errors are retried after a backoff, fatal ones are not.
+    on_retry(error) is called before each retry. """
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return upload()
+        except Exception as e:
+            kind = classify_error(e)
+            if kind == FATAL:
+                raise Exception('failed to upload %s: %r' % (description, e))
+            if attempt == max_attempts:
+                raise Exception('failed to upload %s after %s attempts: %r' % (description, max_attempts, e))
+            if on_retry is not None:
+                on_retry(e)
+            time.sleep(backoff_delay(attempt, kind))
+
+
+class BaseMultipartUploader(object):
+    """ uploads an archive as a series of parts, num_threads at a time.
+
+    usage:
+        uploader = SomeMultipartUploader(..., part_size)
+        for part in parts:
+            uploader.submit(part)
+        archive_id = uploader.complete()
+
+    every part except the last must be exactly part_size bytes. subclasses implement initiate(),
+    upload_part(part_number, byte_pos, part), complete_upload(results) and abort_upload().
+    """
+
+    # the most parts an upload can have, if there is a limit
+    max_parts = None
+
+    def __init__(self, part_size, num_threads=4, max_attempts=MAX_ATTEMPTS):
+        if num_threads < 1:
+            raise ValueError('num_threads must be at least 1')
+        self.part_size = part_size
+        self.num_threads = num_threads
+        self.max_attempts = max_attempts
+
+        self.upload_id = None
+        self.archive_id = None
+        self.bytes_submitted = 0
+        # the time spent uploading parts, on all threads, and how many part uploads were retried
+        self.seconds = 0
+        self.retries = 0
+        self._stats_lock = threading.Lock()
+        # the first part upload that failed, set by _part_done
+        self.error = None
+        self.futures = []
+        self.slots = threading.BoundedSemaphore(num_threads)
+        self.executor = None
+
+    def initiate(self):
+        """ starts the upload, returning its id """
+        raise NotImplementedError
+
+    def upload_part(self, part_number, byte_pos, part):
+        """ uploads one part, once, raising if it fails. returns what complete_upload needs of it. """
+        raise NotImplementedError
+
+    def complete_upload(self, results):
+        """ completes the upload, given each part's upload_part result, in order. returns the archive id. """
+        raise NotImplementedError
+
+    def abort_upload(self):
+        raise NotImplementedError
+
+    def start(self):
+        self.upload_id = self.initiate()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.num_threads)
+
+    def submit(self, part):
+        """ queue part for upload. blocks while num_threads parts are already in flight. """
+        if self.upload_id is None:
+            self.start()
+        if self.bytes_submitted % self.part_size:
+            raise ValueError('only the last part may be smaller than part_size')
+        if self.max_parts is not None and len(self.futures) >= self.max_parts:
+            raise ValueError('an upload can have at most %s parts, raise part_size' % self.max_parts)
+        self._raise_failed_parts()
+
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self._upload_part, len(self.futures) + 1, self.bytes_submitted, part)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(self._part_done)
+        self.futures.append(future)
+        self.bytes_submitted += len(part)
+
+    def _upload_part(self, part_number, byte_pos, part):
+        start = time.time()
+        try:
+            return upload_with_retries(lambda: self.upload_part(part_number, byte_pos, part),
+                                       'part %s (at byte %s)' % (part_number, byte_pos),
+                                       self.max_attempts, on_retry=self._count_retry)
+        finally:
+            with self._stats_lock:
+                self.seconds += time.time() - start
+
+    def _count_retry(self, error):
+        with self._stats_lock:
+            self.retries += 1
+
+    def _part_done(self, future):
+        self.slots.release()
+        if not future.cancelled() and future.exception() is not None:
+            with self._stats_lock:
+                if self.error is None:
+                    self.error = future.exception()
+
+    def _raise_failed_parts(self):
+        if self.error is not None:
+            raise self.error
+
+    def complete(self):
+        """ wait for every part to finish, then complete the upload. returns the archive id. """
+        if self.archive_id is not None:
+            return self.archive_id
+        results = [future.result() for future in self.futures]
+        self.executor.shutdown()
+        self.archive_id = self.complete_upload(results)
+        return self.archive_id
+
+    def abort(self):
+        """ cancel any queued parts, and abort the upload so the store discards the uploaded ones. """
+        if self.executor is not None:
+            for future in self.futures:
+                future.cancel()
+            self.executor.shutdown()
+        if self.upload_id is not None and self.archive_id is None:
+            self.abort_upload()
+            self.upload_id = None
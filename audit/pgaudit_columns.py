@@ -0,0 +1,342 @@
+"""
+PG Audit Columns
+
+An optional output stage that parses the pgaudit records of the downloaded logs into a columnar
+file, so that an audit question (who ran what, against which table, between two times) can be
+answered by reading a few columns of the row groups that can hold the answer, instead of restoring,
+decompressing and grepping every line of the logs.
+
+Each pgaudit record becomes a row of these columns:
+
+    timestamp    seconds since the epoch, from the log_line_prefix's %t (assumed to be UTC, as on RDS)
+    log_file     the RDS log file the record came from
+    user, database
+    class        READ, WRITE, FUNCTION, ROLE, DDL, MISC or MISC_SET
+    command      SELECT, INSERT, CREATE INDEX, ...
+    object_type, object
+    statement
+    parameter    the statement's parameters, when pgaudit.log_parameter is on
+
+Lines that aren't pgaudit records (connections, errors, ...) aren't converted: they are only in
+the raw logs. Records are dropped by PGAUDIT_DROP_CLASSES and PGAUDIT_DROP_ROLES, like the raw logs.
+
+The file is written in a single pass, as a series of row groups of at most row_group_rows rows,
+or of records of about row_group_size bytes:
+
+    MAGIC
+    row group 0: one zlib compressed chunk per column
+    row group 1: ...
+    footer: json, see below
+    the footer's length: 4 bytes, little endian
+    MAGIC
+
+Columns other than timestamp are dictionary encoded within each row group: the chunk has the row
+group's distinct values, and for each row the index of its value, in 1, 2 or 4 bytes, whichever
+fits. The footer has each row group's offset, size and number of rows, and each column chunk's
+offset, size, number of distinct values and min and max (except the statement's and parameter's,
+which can be arbitrarily long), so a reader can skip the row groups that can't match a query. See ColumnFile.
+
+Memory use is bounded by the row group being built, and the record being parsed.
+"""
+import array
+import calendar
+import json
+import re
+import struct
+import sys
+import time
+import zlib
+
+from pgaudit_filter import FIELD
+
+MAGIC = b'PGAUDCOL'
+VERSION = 1
+EXTENSION = '.columns'
+COLUMNS = ['timestamp', 'log_file', 'user', 'database', 'class', 'command', 'object_type', 'object', 'statement',
+           'parameter']
+STRING_COLUMNS = COLUMNS[1:]
+# columns that are csv fields of the record, quoted when they have commas or quotes
+QUOTED_COLUMNS = ['command', 'object_type', 'object', 'statement', 'parameter']
+# columns without min and max statistics
+UNBOUNDED_COLUMNS = ['statement', 'parameter']
+ROW_GROUP_ROWS = 128 * 1024
+ROW_GROUP_SIZE = 16 * 1024 * 1024
+COMPRESSION_LEVEL = 6
+
+# a 4 byte unsigned array typecode, for offsets, lengths and timestamps
+UINT32 = 'I' if array.array('I').itemsize == 4 else 'L'
+# the typecode of dictionary indices of each width, in bytes
+INDEX_TYPECODES = {1: 'B', 2: 'H', 4: UINT32}
+
+# every record starts with a timestamp; lines that don't go on with the record before.
+RECORD_START_PATTERN = re.compile(br'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d ')
+# the default RDS log_line_prefix ('%t:%r:%u@%d:[%p]:'), then pgaudit's audit type, statement id,
+# substatement id, class, command, object type, object name, statement and parameters.
+AUDIT_RECORD_PATTERN = re.compile(
+    br'(?P<timestamp>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d) .*?:(?P<user>[^:@\n]*)@(?P<database>[^:@\n]*):\[\d+\]:'
+    br'LOG:  AUDIT: [^,]*,[^,]*,[^,]*,(?P<class>[^,]*),(?P<command>' + FIELD + br'),(?P<object_type>' + FIELD +
+    br'),(?P<object>' + FIELD + br'),(?P<statement>' + FIELD + br'),(?P<parameter>' + FIELD + br')')
+
+
+def get_columns_name(archive_name, extension):
+    """ the name of the columns archive made alongside the archive archive_name, e.g. <archive name>.columns """
+    if archive_name.endswith(extension):
+        archive_name = archive_name[:-len(extension)]
+    return archive_name + EXTENSION
+
+
+def to_little_endian(values):
+    if sys.byteorder == 'big':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+
+def from_little_endian(typecode, data):
+    values = array.array(typecode)
+    values.fromstring(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class TimestampParser(object):
+    """ seconds since the epoch of 'YYYY-MM-DD HH:MM:SS' timestamps, caching each hour's. """
+
+    def __init__(self):
+        self.hours = {}
+
+    def parse(self, timestamp):
+        hour = timestamp[:13]
+        start = self.hours.get(hour)
+        if start is None:
+            start = self.hours[hour] = calendar.timegm(time.strptime(hour, '%Y-%m-%d %H'))
+        return start + int(timestamp[14:16]) * 60 + int(timestamp[17:19])
+
+
+def unquote(field):
+    """ a csv field's value """
+    return field[1:-1].replace(b'""', b'"') if field[:1] == b'"' else field
+
+
+class RowGroupBuilder(object):
+    """ the rows of the row group being built.
+
+    the audited statements of a log repeat: a row's columns other than its timestamp and parameter
+    are added as one tuple, dictionary encoded as a whole, and split into each column's dictionary
+    once the row group is done. so a row costs one dictionary lookup, and only distinct values are unquoted.
+    """
+
+    def __init__(self):
+        self.timestamps = array.array(UINT32)
+        # the distinct (log_file, ..., statement) tuples, and parameters, by their index
+        self.keys = {}
+        self.key_indices = array.array(UINT32)
+        self.parameters = {}
+        self.parameter_indices = array.array(UINT32)
+        # bytes of the records the rows were parsed from, which the distinct values are at most
+        self.size = 0
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def add(self, timestamp, key, parameter, size):
+        self.timestamps.append(timestamp)
+        self.key_indices.append(self.keys.setdefault(key, len(self.keys)))
+        self.parameter_indices.append(self.parameters.setdefault(parameter, len(self.parameters)))
+        self.size += size
+
+    def encode(self):
+        """ (name, chunk, stats) of each column """
+        columns = [('timestamp', to_little_endian(self.timestamps),
+                    {'distinct': len(set(self.timestamps)), 'min': min(self.timestamps), 'max': max(self.timestamps)})]
+        keys = sorted(self.keys, key=self.keys.get)
+        for i, name in enumerate(STRING_COLUMNS[:-1]):
+            dictionary = {}
+            # the index of each key's value in this column's dictionary
+            key_values = [dictionary.setdefault(key[i], len(dictionary)) for key in keys]
+            indices = [key_values[index] for index in self.key_indices]
+            columns.append(encode_column(name, dictionary, indices))
+        columns.append(encode_column('parameter', self.parameters, self.parameter_indices))
+        return columns
+
+
+def encode_column(name, dictionary, indices):
+    """ (name, chunk, stats) of a string column, from its dictionary of value -> index """
+    values = sorted(dictionary, key=dictionary.get)
+    if name in QUOTED_COLUMNS:
+        values = [unquote(value) for value in values]
+    stats = {'distinct': len(values)}
+    if name not in UNBOUNDED_COLUMNS:
+        stats['min'] = min(values).decode('utf-8', 'replace')
+        stats['max'] = max(values).decode('utf-8', 'replace')
+    return name, encode_strings(values, indices), stats
+
+
+def encode_strings(values, indices):
+    """ a dictionary encoded column: the number of distinct values and the width of the indices,
+    each value's length, the values, then each row's index. """
+    width = 1 if len(values) <= 0x100 else 2 if len(values) <= 0x10000 else 4
+    typecode = INDEX_TYPECODES[width]
+    return b''.join([
+        struct.pack('<IB', len(values), width),
+        to_little_endian(array.array(UINT32, [len(value) for value in values])),
+        b''.join(values),
+        to_little_endian(array.array(typecode, indices)),
+    ])
+
+
+def decode_strings(data):
+    count, width = struct.unpack_from('<IB', data)
+    pos = struct.calcsize('<IB')
+    lengths = from_little_endian(UINT32, data[pos:pos + 4 * count])
+    pos += 4 * count
+    values = []
+    for length in lengths:
+        values.append(data[pos:pos + length])
+        pos += length
+    indices = from_little_endian(INDEX_TYPECODES[width], data[pos:])
+    return [values[index] for index in indices]
+
+
+class PgAuditColumnWriter(object):
+    """ parses logs' pgaudit records into a columns file written to fileobj.
+
+    usage:
+        writer = PgAuditColumnWriter(fileobj)
+        writer.add(log_file_name, chunks)
+        # or, to convert chunks while they are passed on somewhere else:
+        for chunk in writer.tee(log_file_name, chunks): ...
+        writer.close()
+    """
+
+    def __init__(self, fileobj, drop_classes=(), drop_roles=(), row_group_rows=ROW_GROUP_ROWS,
+                 row_group_size=ROW_GROUP_SIZE):
+        self.fileobj = fileobj
+        self.drop_classes = set(drop_classes)
+        self.drop_roles = set(drop_roles)
+        self.row_group_rows = row_group_rows
+        self.row_group_size = row_group_size
+        self.timestamps = TimestampParser()
+        self.row_group = RowGroupBuilder()
+        self.row_groups = []
+        self.rows = 0
+        self.dropped = 0
+        self.seconds = 0
+        self.fileobj.write(MAGIC)
+        self.offset = len(MAGIC)
+
+    def tee(self, log_file_name, chunks):
+        """ yields chunks, converting them on the way """
+        # the lines of the record being parsed, and a line split between chunks
+        record = []
+        rest = b''
+        for chunk in chunks:
+            start = time.time()
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+            self._add_lines(log_file_name, record, lines)
+            self.seconds += time.time() - start
+            yield chunk
+        start = time.time()
+        self._add_lines(log_file_name, record, [rest] if rest else [])
+        if record:
+            self._add_record(log_file_name, record)
+        self.seconds += time.time() - start
+
+    def add(self, log_file_name, chunks):
+        for _ in self.tee(log_file_name, chunks):
+            pass
+
+    def _add_lines(self, log_file_name, record, lines):
+        """ adds the records that lines end, leaving the lines of the last one, which may go on, in record """
+        for line in lines:
+            if RECORD_START_PATTERN.match(line):
+                if record:
+                    self._add_record(log_file_name, record)
+                    del record[:]
+                record.append(line)
+            elif record:
+                record.append(line)
+
+    def _add_record(self, log_file_name, lines):
+        record = lines[0] if len(lines) == 1 else b'\n'.join(lines)
+        match = AUDIT_RECORD_PATTERN.match(record)
+        if match is None:
+            return
+        fields = match.groups()
+        timestamp, user, audit_class = fields[0], fields[1], fields[3]
+        if audit_class in self.drop_classes or user in self.drop_roles:
+            self.dropped += 1
+            return
+        key = (log_file_name, user) + fields[2:-1]
+        self.row_group.add(self.timestamps.parse(timestamp), key, fields[-1], len(record))
+        if len(self.row_group) >= self.row_group_rows or self.row_group.size >= self.row_group_size:
+            self._write_row_group()
+
+    def _write_row_group(self):
+        row_group = {'offset': self.offset, 'rows': len(self.row_group), 'columns': {}}
+        for name, chunk, stats in self.row_group.encode():
+            data = zlib.compress(chunk, COMPRESSION_LEVEL)
+            stats.update({'offset': self.offset, 'size': len(data)})
+            row_group['columns'][name] = stats
+            self.fileobj.write(data)
+            self.offset += len(data)
+        row_group['size'] = self.offset - row_group['offset']
+        self.row_groups.append(row_group)
+        self.rows += len(self.row_group)
+        self.row_group = RowGroupBuilder()
+
+    def close(self):
+        """ writes the last row group, and the footer. does not close fileobj. """
+        start = time.time()
+        if len(self.row_group):
+            self._write_row_group()
+        footer = json.dumps({
+            'version': VERSION,
+            'columns': COLUMNS,
+            'rows': self.rows,
+            'row_groups': self.row_groups,
+        }, sort_keys=True).encode('utf-8')
+        self.fileobj.write(footer + struct.pack('<I', len(footer)) + MAGIC)
+        self.seconds += time.time() - start
+
+
+def may_contain(row_group, column, low=None, high=None):
+    """ whether row_group can have rows with a column value between low and high, going by its stats """
+    stats = row_group['columns'][column]
+    if 'min' not in stats:
+        return True
+    return (low is None or stats['max'] >= low) and (high is None or stats['min'] <= high)
+
+
+class ColumnFile(object):
+    """ reads a columns file from a seekable fileobj, e.g. a downloaded columns archive. """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        fileobj.seek(-4 - len(MAGIC), 2)
+        footer_end = fileobj.tell()
+        length, magic = struct.unpack('<I%ss' % len(MAGIC), fileobj.read(4 + len(MAGIC)))
+        if magic != MAGIC:
+            raise ValueError('not a pgaudit columns file')
+        fileobj.seek(footer_end - length)
+        self.footer = json.loads(fileobj.read(length).decode('utf-8'))
+        if self.footer['version'] > VERSION:
+            raise ValueError('pgaudit columns file version %s is newer than this reader' % self.footer['version'])
+        self.row_groups = self.footer['row_groups']
+
+    def read_column(self, row_group, name):
+        """ the values of one column of a row group """
+        stats = row_group['columns'][name]
+        self.fileobj.seek(stats['offset'])
+        data = zlib.decompress(self.fileobj.read(stats['size']))
+        if name == 'timestamp':
+            return from_little_endian(UINT32, data).tolist()
+        return decode_strings(data)
+
+    def iter_rows(self, columns=COLUMNS, row_groups=None):
+        """ yields each row of row_groups (every row group, by default) as a tuple of columns """
+        for row_group in self.row_groups if row_groups is None else row_groups:
+            for row in zip(*[self.read_column(row_group, name) for name in columns]):
+                yield row
@@ -0,0 +1,173 @@
+"""
+PG Audit Log Filter
+
+An optional stage between downloading a log and compressing it. It drops the pgaudit records
+nobody will look at, like a connection pooler's DISCARD ALL or a health check's SELECT 1, and can
+shorten the rest by dictionary encoding the statements that repeat.
+
+Records are found by the default RDS log_line_prefix ('%t:%r:%u@%d:[%p]:'), followed by pgaudit's
+csv fields:
+
+    2018-05-16 00:00:00 UTC:10.0.1.5(40000):app@appdb:[1234]:LOG:  AUDIT: SESSION,1,1,READ,SELECT,TABLE,public.users,"SELECT ...",<none>
+
+PGAUDIT_DROP_CLASSES drops the records of those audit classes (READ, WRITE, FUNCTION, ROLE, DDL,
+MISC or MISC_SET), and PGAUDIT_DROP_ROLES the records of statements run by those users. Lines that
+aren't pgaudit records are kept. The lines a multi-line statement continues on go wherever the
+line it starts on does.
+
+With PGAUDIT_DICTIONARY, a statement that was already seen in the same log is written as @<n>
+instead: a reference to the n-th distinct statement of the log, counting from 0. Each log has a
+dictionary of its own, so it can be decoded without the others. decode_lines decodes a log, and
+tools/restore_logs.py does it when it extracts one.
+
+Logs are filtered in a single pass, a chunk at a time. Besides the current chunk, only a line
+split between chunks, and the dictionary (at most DICTIONARY_SIZE statements, of at most
+MAX_STATEMENT_SIZE bytes each), are held in memory.
+"""
+import re
+import time
+
+DICTIONARY_SIZE = 4096
+MAX_STATEMENT_SIZE = 1024
+REFERENCE_MARK = b'@'
+
+# a csv field: quoted, with "" for a quote inside it, or not
+FIELD = br'(?:"[^"]*(?:""[^"]*)*"|[^,"]*)'
+# every record starts with a timestamp. if it is a pgaudit record, the prefix ends with
+# :<user>@<database>:[<pid>], and then come the audit type, statement id, substatement id and class
+RECORD_PATTERN = re.compile(
+    br'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d (?:.*?:(?P<user>[^:@]*)@[^:@]*:\[\d+\]:LOG:  AUDIT: '
+    br'[^,]*,[^,]*,[^,]*,(?P<class>[^,]*),)?')
+# the command, object type and object name come before the statement. a statement that goes on
+# over several lines doesn't match.
+STATEMENT_PATTERN = re.compile(FIELD + b',' + FIELD + b',' + FIELD + b',(' + FIELD + b'),')
+
+
+def parse_list(value):
+    """ a set of the comma separated names in value, e.g. from an environment variable """
+    return set(name.strip().encode('utf-8') for name in (value or '').split(',') if name.strip())
+
+
+class Dictionary(object):
+    """ the statements of a log seen so far, numbered in the order they were first seen. """
+
+    def __init__(self):
+        self.statements = []
+        self.references = {}
+
+    def add(self, statement):
+        # the encoder and decoder must agree on what is added, so this only depends on statement
+        if (statement not in self.references and len(statement) <= MAX_STATEMENT_SIZE
+                and len(self.statements) < DICTIONARY_SIZE):
+            self.references[statement] = REFERENCE_MARK + str(len(self.statements)).encode('ascii')
+            self.statements.append(statement)
+
+    def encode(self, line, pos):
+        match = STATEMENT_PATTERN.match(line, pos)
+        if match is None:
+            return line
+        start, end = match.span(1)
+        statement = line[start:end]
+        reference = self.references.get(statement)
+        if reference is not None and len(reference) < len(statement):
+            return line[:start] + reference + line[end:]
+        self.add(statement)
+        if statement[:1] == REFERENCE_MARK:
+            # @@ is a statement that starts with @, rather than a reference
+            return line[:start] + REFERENCE_MARK + line[start:]
+        return line
+
+    def decode(self, line, pos):
+        match = STATEMENT_PATTERN.match(line, pos)
+        if match is None:
+            return line
+        start, end = match.span(1)
+        field = line[start:end]
+        if field[:1] != REFERENCE_MARK:
+            self.add(field)
+            return line
+        if field[1:2] == REFERENCE_MARK:
+            self.add(field[1:])
+            return line[:start] + field[1:] + line[end:]
+        return line[:start] + self.statements[int(field[1:])] + line[end:]
+
+
+class PgAuditFilter(object):
+    """ filters logs, counting what went in and what came out, and the seconds spent filtering. """
+
+    def __init__(self, drop_classes=(), drop_roles=(), dictionary=False):
+        self.drop_classes = set(drop_classes)
+        self.drop_roles = set(drop_roles)
+        self.dictionary = dictionary
+        self.lines_in = 0
+        self.lines_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0
+        self.keep = True
+
+    def settings(self):
+        return {
+            'drop_classes': sorted(name.decode('utf-8') for name in self.drop_classes),
+            'drop_roles': sorted(name.decode('utf-8') for name in self.drop_roles),
+            'dictionary': self.dictionary,
+        }
+
+    def filter_lines(self, lines, dictionary):
+        """ the lines to keep, encoded. keep is whether the last record's lines were kept. """
+        kept = []
+        keep = self.keep
+        for line in lines:
+            match = RECORD_PATTERN.match(line)
+            if match is not None:
+                # a new record. lines that don't match carry on the one before
+                audit_class = match.group('class')
+                keep = audit_class is None or (
+                    audit_class not in self.drop_classes and match.group('user') not in self.drop_roles)
+                if keep and audit_class is not None and dictionary is not None:
+                    line = dictionary.encode(line, match.end())
+            if keep:
+                kept.append(line)
+        self.keep = keep
+        return kept
+
+    def filter(self, chunks):
+        """ filters a log, given as an iterator of chunks, yielding the filtered chunks. """
+        dictionary = Dictionary() if self.dictionary else None
+        self.keep = True
+        rest = b''
+        for chunk in chunks:
+            self.bytes_in += len(chunk)
+            start = time.time()
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+            self.lines_in += len(lines)
+            kept = self.filter_lines(lines, dictionary)
+            if kept:
+                self.lines_out += len(kept)
+                # every line kept here ended in a newline
+                kept.append(b'')
+                output = b'\n'.join(kept)
+                self.bytes_out += len(output)
+                self.seconds += time.time() - start
+                yield output
+            else:
+                self.seconds += time.time() - start
+        if rest:
+            # the last line, without a newline
+            self.lines_in += 1
+            kept = self.filter_lines([rest], dictionary)
+            if kept:
+                self.lines_out += 1
+                self.bytes_out += len(kept[0])
+                yield kept[0]
+
+
+def decode_lines(lines):
+    """ decodes the lines of a log that was filtered with a dictionary, yielding them decoded. """
+    dictionary = Dictionary()
+    for line in lines:
+        match = RECORD_PATTERN.match(line)
+        if match is not None and match.group('class') is not None:
+            line = dictionary.decode(line, match.end())
+        yield line
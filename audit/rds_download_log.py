@@ -5,14 +5,41 @@ Based on this: https://github.com/aws/aws-cli/issues/2268#issuecomment-373803942
 """
 import boto3
 import os
-import sys, os, base64, datetime, hashlib, hmac, urllib
+import sys, os, base64, datetime, hashlib, hmac, threading, urllib
 import requests
+import urlparse
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 DB_INSTANCE_IDENTIFIER = os.getenv('DB_INSTANCE_IDENTIFIER')
+# only needed to point the rds api and downloads at something other than rds.<region>.amazonaws.com,
+# e.g. tools/rds_stub.py.
+RDS_ENDPOINT_URL = os.getenv('RDS_ENDPOINT_URL')
 DEBUG = False
 
+# number of bytes read from the response at a time when streaming a log file.
+CHUNK_SIZE = 64 * 1024
+
+# connections to the rds endpoint are kept alive and reused, by every download in an invocation
+# and by later warm invocations. HTTP_POOL_SIZE should be at least the number of download threads.
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '60'))
+# failed connections, throttling and 5xx responses are retried with an exponential backoff.
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '4'))
+HTTP_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+# lines requested per DownloadDBLogFilePortion call. the api silently truncates portions larger
+# than 1MB, so this should be small enough that a portion never gets close to that.
+PORTION_LINES = int(os.getenv('PORTION_LINES', '1000'))
+
 def get_database_region():
-    rds_client = boto3.client('rds')
+    rds_client = boto3.client('rds', endpoint_url=RDS_ENDPOINT_URL)
+    if not DB_INSTANCE_IDENTIFIER:
+        # several instances are archived, all in the lambda's own region.
+        return rds_client.meta.region_name
     resp = rds_client.describe_db_instances(
         DBInstanceIdentifier=DB_INSTANCE_IDENTIFIER
     )
@@ -23,114 +50,237 @@ def get_credentials():
     session = boto3.Session()
     return session.get_credentials()
 
-def get_log_file_contents_via_rest(filename):
-    def sign(key, msg):
-        return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
-
-    def getSignatureKey(key, dateStamp, regionName, serviceName):
-        kDate = sign(('AWS4' + key).encode('utf-8'), dateStamp)
-        kRegion = sign(kDate, regionName)
-        kService = sign(kRegion, serviceName)
-        kSigning = sign(kService, 'aws4_request')
-        return kSigning
-
-    # ************* REQUEST VALUES *************
-    method = 'GET'
-    service = 'rds'
-    region = get_database_region()
-    host = 'rds.'+ region +'.amazonaws.com'
-    # host = 'rds.us-west-2.amazonaws.com'
-    # region = 'us-west-2'
-    endpoint = 'https://' + host
-
-    # Key derivation functions. See:
-    # http://docs.aws.amazon.com/general/latest/gr/signature-v4-examples.html#signature-v4-examples-python
-    credentials = get_credentials()
-    access_key = credentials.access_key
-    secret_key = credentials.secret_key
-    if access_key is None or secret_key is None:
-        return 'No access key is available.'
-
-
-    # Create a date for headers and the credential string
-    t = datetime.datetime.utcnow()
-    amz_date = t.strftime('%Y%m%dT%H%M%SZ') # Format date as YYYYMMDD'T'HHMMSS'Z'
-    datestamp = t.strftime('%Y%m%d') # Date w/o time, used in credential scope
+def sign(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+def getSignatureKey(key, dateStamp, regionName, serviceName):
+    kDate = sign(('AWS4' + key).encode('utf-8'), dateStamp)
+    kRegion = sign(kDate, regionName)
+    kService = sign(kRegion, serviceName)
+    kSigning = sign(kService, 'aws4_request')
+    return kSigning
+
+
+class Signer(object):
+    """ presigns requests to the RDS REST api.
+
+    The database region and the credentials are resolved once, and the derived signing key is
+    cached per (secret key, date, region, service), so signing a request costs two HMACs and no
+    api calls. Credentials are re-read from botocore on each request, which only refreshes them
+    when they are close to expiring.
+
+    One signer is shared by every download in a run (and by warm lambda invocations), see get_signer().
+    """
+
+    def __init__(self, region=None, credentials=None, service='rds', endpoint_url=None):
+        self.service = service
+        self.endpoint_url = endpoint_url
+        self._region = region
+        self._credentials = credentials
+        self._signing_keys = {}
+        self._lock = threading.Lock()
+
+    @property
+    def region(self):
+        with self._lock:
+            if self._region is None:
+                self._region = get_database_region()
+            return self._region
+
+    def get_frozen_credentials(self):
+        with self._lock:
+            if self._credentials is None:
+                self._credentials = get_credentials()
+        # for refreshable credentials, botocore refreshes them here if they are about to expire.
+        return self._credentials.get_frozen_credentials()
+
+    def get_signing_key(self, secret_key, datestamp, region):
+        cache_key = (secret_key, datestamp, region, self.service)
+        with self._lock:
+            signing_key = self._signing_keys.get(cache_key)
+            if signing_key is None:
+                # keys from older dates or rotated credentials are never needed again.
+                self._signing_keys.clear()
+                signing_key = getSignatureKey(secret_key, datestamp, region, self.service)
+                self._signing_keys[cache_key] = signing_key
+            return signing_key
+
+    def presign_url(self, canonical_uri, method='GET'):
+        # ************* REQUEST VALUES *************
+        region = self.region
+        if self.endpoint_url:
+            endpoint = self.endpoint_url.rstrip('/')
+            host = urlparse.urlparse(endpoint).netloc
+        else:
+            host = 'rds.'+ region +'.amazonaws.com'
+            endpoint = 'https://' + host
+
+        # Key derivation functions. See:
+        # http://docs.aws.amazon.com/general/latest/gr/signature-v4-examples.html#signature-v4-examples-python
+        credentials = self.get_frozen_credentials()
+        access_key = credentials.access_key
+        secret_key = credentials.secret_key
+        if access_key is None or secret_key is None:
+            raise Exception('No access key is available.')
+
+        # Create a date for headers and the credential string
+        t = datetime.datetime.utcnow()
+        amz_date = t.strftime('%Y%m%dT%H%M%SZ') # Format date as YYYYMMDD'T'HHMMSS'Z'
+        datestamp = t.strftime('%Y%m%d') # Date w/o time, used in credential scope
+
+        # Step 3: Create the canonical headers and signed headers. Header names
+        # and value must be trimmed and lowercase, and sorted in ASCII order.
+        # Note trailing \n in canonical_headers.
+        # signed_headers is the list of headers that are being included
+        # as part of the signing process. For requests that use query strings,
+        # only "host" is included in the signed headers.
+        canonical_headers = 'host:' + host + '\n'
+        signed_headers = 'host'
+
+        # Match the algorithm to the hashing algorithm you use, either SHA-1 or
+        # SHA-256 (recommended)
+        algorithm = 'AWS4-HMAC-SHA256'
+        credential_scope = datestamp + '/' + region + '/' + self.service + '/' + 'aws4_request'
+
+        # Step 4: Create the canonical query string. In this example, request
+        # parameters are in the query string. Query string values must
+        # be URL-encoded (space=%20). The parameters must be sorted by name.
+        canonical_querystring = ''
+        canonical_querystring += 'X-Amz-Algorithm=AWS4-HMAC-SHA256'
+        canonical_querystring += '&X-Amz-Credential=' + urllib.quote_plus(access_key + '/' + credential_scope)
+        canonical_querystring += '&X-Amz-Date=' + amz_date
+        canonical_querystring += '&X-Amz-Expires=30'
+        # temporary credentials (e.g. the lambda's role) also have to send their session token.
+        if credentials.token:
+            canonical_querystring += '&X-Amz-Security-Token=' + urllib.quote(credentials.token, safe='')
+        canonical_querystring += '&X-Amz-SignedHeaders=' + signed_headers
+
+        # Step 5: Create payload hash. For GET requests, the payload is an
+        # empty string ("").
+        payload_hash = hashlib.sha256('').hexdigest()
+
+        # Step 6: Combine elements to create create canonical request
+        canonical_request = method + '\n' + canonical_uri + '\n' + canonical_querystring + '\n' + canonical_headers + '\n' + signed_headers + '\n' + payload_hash
+
+
+        # ************* TASK 2: CREATE THE STRING TO SIGN*************
+        string_to_sign = algorithm + '\n' +  amz_date + '\n' +  credential_scope + '\n' +  hashlib.sha256(canonical_request).hexdigest()
+
+
+        # ************* TASK 3: CALCULATE THE SIGNATURE *************
+        # Get the (cached) signing key
+        signing_key = self.get_signing_key(secret_key, datestamp, region)
+
+        # Sign the string_to_sign using the signing_key
+        signature = hmac.new(signing_key, (string_to_sign).encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+        # ************* TASK 4: ADD SIGNING INFORMATION TO THE REQUEST *************
+        # The auth information can be either in a query string
+        # value or in a header named Authorization. This code shows how to put
+        # everything into a query string.
+        canonical_querystring += '&X-Amz-Signature=' + signature
+
+        # The 'host' header is added automatically by the Python 'request' lib. But it
+        # must exist as a header in the request.
+        return endpoint + canonical_uri + "?" + canonical_querystring
+
+
+_signer = None
+_signer_lock = threading.Lock()
+
+def get_signer():
+    '''returns the signer shared by all downloads in this process'''
+    global _signer
+    with _signer_lock:
+        if _signer is None:
+            _signer = Signer(endpoint_url=RDS_ENDPOINT_URL)
+        return _signer
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def make_http_session(pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES):
+    '''a requests session with a connection pool, that retries throttled and failed requests'''
+    retry = Retry(
+        total=retries,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUS_CODES,
+        method_whitelist=['GET'],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def get_http_session():
+    '''returns the http session shared by all downloads in this process'''
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            _http_session = make_http_session()
+        return _http_session
+
+def get_log_file_contents_via_rest(filename, chunk_size=CHUNK_SIZE, signer=None, session=None, db_instance=None):
+    '''streams the contents of one of db_instance's (or DB_INSTANCE_IDENTIFIER's) log files,
+    yielding chunks of at most chunk_size bytes'''
+    if db_instance is None:
+        db_instance = DB_INSTANCE_IDENTIFIER
+    if signer is None:
+        signer = get_signer()
+    if session is None:
+        session = get_http_session()
 
     # sample usage : '/v13/downloadCompleteLogFile/DBInstanceIdentifier/error/postgresql.log.2017-05-26-04'
-    canonical_uri = '/v13/downloadCompleteLogFile/'+ DB_INSTANCE_IDENTIFIER + '/' + filename
-
-    # Step 3: Create the canonical headers and signed headers. Header names
-    # and value must be trimmed and lowercase, and sorted in ASCII order.
-    # Note trailing \n in canonical_headers.
-    # signed_headers is the list of headers that are being included
-    # as part of the signing process. For requests that use query strings,
-    # only "host" is included in the signed headers.
-    canonical_headers = 'host:' + host + '\n'
-    signed_headers = 'host'
-
-    # Match the algorithm to the hashing algorithm you use, either SHA-1 or
-    # SHA-256 (recommended)
-    algorithm = 'AWS4-HMAC-SHA256'
-    credential_scope = datestamp + '/' + region + '/' + service + '/' + 'aws4_request'
-
-    # Step 4: Create the canonical query string. In this example, request
-    # parameters are in the query string. Query string values must
-    # be URL-encoded (space=%20). The parameters must be sorted by name.
-    canonical_querystring = ''
-    canonical_querystring += 'X-Amz-Algorithm=AWS4-HMAC-SHA256'
-    canonical_querystring += '&X-Amz-Credential=' + urllib.quote_plus(access_key + '/' + credential_scope)
-    canonical_querystring += '&X-Amz-Date=' + amz_date
-    canonical_querystring += '&X-Amz-Expires=30'
-    canonical_querystring += '&X-Amz-SignedHeaders=' + signed_headers
-
-    # Step 5: Create payload hash. For GET requests, the payload is an
-    # empty string ("").
-    payload_hash = hashlib.sha256('').hexdigest()
-
-    # Step 6: Combine elements to create create canonical request
-    canonical_request = method + '\n' + canonical_uri + '\n' + canonical_querystring + '\n' + canonical_headers + '\n' + signed_headers + '\n' + payload_hash
-
-
-    # ************* TASK 2: CREATE THE STRING TO SIGN*************
-    string_to_sign = algorithm + '\n' +  amz_date + '\n' +  credential_scope + '\n' +  hashlib.sha256(canonical_request).hexdigest()
-
-
-    # ************* TASK 3: CALCULATE THE SIGNATURE *************
-    # Create the signing key
-    signing_key = getSignatureKey(secret_key, datestamp, region, service)
-
-    # Sign the string_to_sign using the signing_key
-    signature = hmac.new(signing_key, (string_to_sign).encode("utf-8"), hashlib.sha256).hexdigest()
-
-
-    # ************* TASK 4: ADD SIGNING INFORMATION TO THE REQUEST *************
-    # The auth information can be either in a query string
-    # value or in a header named Authorization. This code shows how to put
-    # everything into a query string.
-    canonical_querystring += '&X-Amz-Signature=' + signature
-
+    canonical_uri = '/v13/downloadCompleteLogFile/'+ db_instance + '/' + filename
 
     # ************* SEND THE REQUEST *************
-    # The 'host' header is added automatically by the Python 'request' lib. But it
-    # must exist as a header in the request.
-    request_url = endpoint + canonical_uri + "?" + canonical_querystring
+    request_url = signer.presign_url(canonical_uri)
 
     if DEBUG:
         print '\nBEGIN REQUEST++++++++++++++++++++++++++++++++++++'
         print 'Request URL = ' + request_url
 
-    r = requests.get(request_url)
+    r = session.get(request_url, stream=True, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
 
     if DEBUG:
         print '\nRESPONSE++++++++++++++++++++++++++++++++++++'
         print 'Response code: %d\n' % r.status_code
-    return r.text.encode('UTF-8')
+    r.raise_for_status()
+
+    try:
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            if chunk:
+                yield chunk
+    finally:
+        r.close()
+
+def get_log_file_portions(rds_client, filename, marker='0', number_of_lines=PORTION_LINES, db_instance=None):
+    '''pages through a log file with DownloadDBLogFilePortion, starting at marker.
+    yields (data, marker) tuples, where marker is where the next portion starts. the last marker
+    can be used to pick up from the same place once more has been written to the file.
+    '''
+    if db_instance is None:
+        db_instance = DB_INSTANCE_IDENTIFIER
+    while True:
+        response = rds_client.download_db_log_file_portion(
+            DBInstanceIdentifier=db_instance,
+            LogFileName=filename,
+            Marker=marker,
+            NumberOfLines=number_of_lines,
+        )
+        marker = response['Marker']
+        yield (response.get('LogFileData') or u'').encode('UTF-8'), marker
+        if not response['AdditionalDataPending']:
+            return
 
 
 def main():
     filename = 'error/postgresql.log.2018-05-16-22'
-    get_log_file_contents_via_rest(filename)
+    for chunk in get_log_file_contents_via_rest(filename):
+        sys.stdout.write(chunk)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,55 @@
+"""
+Retries
+
+Classifying failed requests, and how long to wait before retrying them, as glacier-upload's
+retry.py does for its uploads.
+
+Errors are throttling (slow down, then retry), transient (retry after a short wait) or fatal
+(retrying won't help, e.g. the upload id has expired). Backoff is exponential with full jitter:
+each retry waits a random time between nothing and the exponential delay, so parts that failed
+together don't all come back together.
+"""
+import random
+
+from botocore.exceptions import ChecksumError, ClientError, ConnectionError, EndpointConnectionError
+
+THROTTLING = 'throttling'
+TRANSIENT = 'transient'
+FATAL = 'fatal'
+
+THROTTLING_CODES = ('ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException', 'SlowDown',
+                    'Throttling')
+# BadDigest: s3 got a part whose Content-MD5 doesn't match it, i.e. it was corrupted on the way.
+TRANSIENT_CODES = ('RequestTimeoutException', 'RequestTimeout', 'ServiceUnavailableException', 'ServiceUnavailable',
+                   'InternalFailure', 'InternalError', 'BadDigest')
+
+BASE_DELAY = 0.5
+THROTTLING_BASE_DELAY = 2.0
+MAX_DELAY = 60.0
+
+
+class ChecksumMismatch(Exception):
+    """ the store's checksum of an uploaded part wasn't the one we calculated. """
+
+
+def classify_error(error):
+    """ THROTTLING, TRANSIENT or FATAL """
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        if code in THROTTLING_CODES or status == 429:
+            return THROTTLING
+        if code in TRANSIENT_CODES or status >= 500:
+            return TRANSIENT
+        return FATAL
+    # socket errors and timeouts are IOErrors (in python 2) or OSErrors, botocore's connection errors included
+    if isinstance(error, (ChecksumMismatch, ChecksumError, ConnectionError, EndpointConnectionError, IOError,
+                          OSError)):
+        return TRANSIENT
+    return FATAL
+
+
+def backoff_delay(attempt, kind=TRANSIENT):
+    """ seconds to wait before retry number attempt (counting from 1) of a failure of kind """
+    base = THROTTLING_BASE_DELAY if kind == THROTTLING else BASE_DELAY
+    return random.uniform(0, min(MAX_DELAY, base * 2 ** (attempt - 1)))
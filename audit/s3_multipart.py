@@ -0,0 +1,86 @@
+"""
+S3 Multipart Upload
+
+The S3 counterpart of glacier_multipart.py: uploads an object as a series of parts, num_threads at
+a time, while the caller keeps producing the rest of it. The object can be written straight into
+an archival storage class (GLACIER, DEEP_ARCHIVE, ...), which costs about what a vault does, but
+is listed, and restored and read with ranged GETs, like any other S3 object.
+
+What it has in common with the glacier uploader, and the bound on memory use, is in multipart.py.
+"""
+import base64
+import hashlib
+
+from multipart import MAX_ATTEMPTS, BaseMultipartUploader
+
+ONE_MB = 1024 * 1024
+# every part but the last must be at least 5MB, and an upload can have at most 10,000 of them.
+MIN_PART_SIZE = 5 * ONE_MB
+MAX_PART_SIZE = 5 * 1024 * ONE_MB
+MAX_PARTS = 10000
+
+
+def get_uri(bucket, key):
+    return 's3://%s/%s' % (bucket, key)
+
+
+class S3MultipartUploader(BaseMultipartUploader):
+    """ uploads an object to s3 as a series of parts, num_threads at a time.
+
+    usage:
+        uploader = S3MultipartUploader(s3_client, bucket, key, part_size, storage_class='GLACIER')
+        for part in parts:
+            uploader.submit(part)
+        uri = uploader.complete()
+
+    every part except the last must be exactly part_size bytes.
+    """
+
+    max_parts = MAX_PARTS
+
+    def __init__(self, s3_client, bucket, key, part_size, num_threads=4, storage_class=None,
+                 max_attempts=MAX_ATTEMPTS):
+        if part_size < MIN_PART_SIZE or part_size > MAX_PART_SIZE:
+            raise ValueError('part_size must be between 5MB and 5GB')
+        super(S3MultipartUploader, self).__init__(part_size, num_threads, max_attempts)
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.storage_class = storage_class
+
+    def initiate(self):
+        params = {'Bucket': self.bucket, 'Key': self.key}
+        if self.storage_class:
+            params['StorageClass'] = self.storage_class
+        return self.s3_client.create_multipart_upload(**params)['UploadId']
+
+    def upload_part(self, part_number, byte_pos, part):
+        """ s3 checks the part against its Content-MD5, and refuses it if they don't match. """
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            ContentMD5=base64.b64encode(hashlib.md5(part).digest()),
+            Body=part,
+        )
+        return response['ETag']
+
+    def complete_upload(self, etags):
+        """ the archive id is the object's s3:// uri """
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={
+                'Parts': [{'ETag': etag, 'PartNumber': i + 1} for i, etag in enumerate(etags)],
+            },
+        )
+        return get_uri(self.bucket, self.key)
+
+    def abort_upload(self):
+        self.s3_client.abort_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+        )
@@ -0,0 +1,192 @@
+"""
+Streaming Archive Helpers
+
+Lets log file contents flow from the RDS REST api, through tar and compression, and into a glacier vault
+(or an s3 bucket) without ever holding a whole log file (or the whole archive) in memory or on disk.
+
+Peak memory is roughly one download chunk plus (num_threads + 1) upload parts, regardless of
+how many gigabytes of logs are archived.
+"""
+import tarfile
+
+from compression import CompressingWriter
+from glacier_multipart import MultipartUploader
+from s3_multipart import S3MultipartUploader, get_uri
+
+
+class ChunkReader(object):
+    """ file-like wrapper around an iterator of byte chunks, so tarfile can read from it. """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b''
+        self.offset = 0
+
+    def read(self, size=-1):
+        pieces = []
+        remaining = size
+        while remaining != 0:
+            if self.offset >= len(self.chunk):
+                try:
+                    self.chunk = next(self.chunks)
+                except StopIteration:
+                    break
+                self.offset = 0
+                continue
+            if remaining < 0:
+                piece = self.chunk[self.offset:]
+            else:
+                piece = self.chunk[self.offset:self.offset + remaining]
+                remaining -= len(piece)
+            self.offset += len(piece)
+            pieces.append(piece)
+        return b''.join(pieces)
+
+
+class ArchiveSink(object):
+    """ write-only file object that uploads everything written to it as an archive.
+
+    Data is buffered until a full part is available, and then handed to a multipart uploader,
+    which uploads up to num_threads parts concurrently while the archive is still being written.
+    Archives smaller than a single part are sent with a single put() instead.
+
+    Subclasses set self.uploader, and implement put(body), which uploads a whole archive and
+    returns its id.
+    """
+
+    def __init__(self, uploader, part_size):
+        self.uploader = uploader
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.archive_id = None
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.part_size:
+            self.uploader.submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def flush(self):
+        pass
+
+    def put(self, body):
+        raise NotImplementedError
+
+    def close(self):
+        """ upload whatever is left in the buffer and finish the archive. returns the archive id. """
+        if self.archive_id is not None:
+            return self.archive_id
+
+        if self.uploader.upload_id is None:
+            self.archive_id = self.put(bytes(self.buffer))
+        else:
+            if self.buffer:
+                self.uploader.submit(bytes(self.buffer))
+            self.archive_id = self.uploader.complete()
+        del self.buffer[:]
+        return self.archive_id
+
+    def abort(self):
+        self.uploader.abort()
+
+
+class GlacierArchiveSink(ArchiveSink):
+    """ uploads an archive to a glacier vault. the archive id is glacier's. """
+
+    def __init__(self, glacier_client, vault_name, description, part_size, num_threads=4):
+        super(GlacierArchiveSink, self).__init__(
+            MultipartUploader(glacier_client, vault_name, description, part_size, num_threads), part_size)
+        self.glacier_client = glacier_client
+        self.vault_name = vault_name
+        self.description = description
+
+    def put(self, body):
+        response = self.glacier_client.upload_archive(
+            vaultName=self.vault_name,
+            archiveDescription=self.description,
+            body=body,
+        )
+        if 'archiveId' not in response:
+            raise Exception('failed to upload archive: %s' % self.description)
+        return response['archiveId']
+
+
+class S3ArchiveSink(ArchiveSink):
+    """ uploads an archive to an s3 object, in storage_class. the archive id is the object's s3:// uri. """
+
+    def __init__(self, s3_client, bucket, key, part_size, num_threads=4, storage_class=None):
+        super(S3ArchiveSink, self).__init__(
+            S3MultipartUploader(s3_client, bucket, key, part_size, num_threads, storage_class), part_size)
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.storage_class = storage_class
+
+    def put(self, body):
+        params = {'Bucket': self.bucket, 'Key': self.key, 'Body': body}
+        if self.storage_class:
+            params['StorageClass'] = self.storage_class
+        self.s3_client.put_object(**params)
+        return get_uri(self.bucket, self.key)
+
+
+class StreamingTar(object):
+    """ a compressed tar written straight into a file object, one streamed member at a time.
+
+    With make_compressor, every member is compressed as a stream of its own, started with a new
+    compressor from make_compressor(). Each one can then be decompressed and read as a tar on its
+    own, from just its byte range of the archive. The ranges are recorded in members.
+    """
+
+    def __init__(self, fileobj, bufsize, compressor, make_compressor=None):
+        self.writer = CompressingWriter(fileobj, compressor)
+        self.make_compressor = make_compressor
+        # name, size, tar offset and compressed byte range of each member
+        self.members = []
+        if make_compressor is None:
+            # 'w|' is tarfile's stream mode: it never seeks, and passes each block on as it goes.
+            self.tar = tarfile.open(fileobj=self.writer, mode='w|', bufsize=bufsize)
+        else:
+            # 'w' mode doesn't seek either, but it writes each member out as soon as it is added,
+            # rather than buffering blocks across members, so their boundaries are known.
+            self.tar = tarfile.open(fileobj=self.writer, mode='w')
+
+    def _start_stream(self):
+        """ ends the current compressed stream, and the last member's byte range with it. """
+        if not self.writer.bytes_in:
+            # nothing has been written, so the first stream can start with the first compressor
+            return
+        self.writer.restart(self.make_compressor())
+        if self.members:
+            member = self.members[-1]
+            member['compressed_size'] = self.writer.bytes_out - member['compressed_offset']
+
+    def add_stream(self, arcname, size, chunks, mtime):
+        """ add a member whose contents come from an iterator of chunks.
+
+        tar headers record the size up front, so it must be known before streaming starts.
+        """
+        if self.make_compressor is not None:
+            self._start_stream()
+            self.members.append({
+                'name': arcname,
+                'size': size,
+                'offset': self.writer.tell(),
+                'compressed_offset': self.writer.bytes_out,
+            })
+        info = tarfile.TarInfo(name=arcname)
+        info.size = size
+        info.mtime = mtime
+        reader = ChunkReader(chunks)
+        self.tar.addfile(tarinfo=info, fileobj=reader)
+        if reader.read(1):
+            raise IOError('%s is larger than the expected %s bytes' % (arcname, size))
+
+    def close(self):
+        if self.make_compressor is not None:
+            # the end of archive blocks go in a stream of their own, after the last member's
+            self._start_stream()
+        self.tar.close()
+        self.writer.close()
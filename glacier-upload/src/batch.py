@@ -0,0 +1,269 @@
+"""Deleting, or starting retrievals of, many archives at once: e.g. to enforce a retention
+period, or to restore a month of logs.
+
+The archives are given by id, or found with a query of the local index (see inventory.py). Each
+takes one request. Requests go through a single shared client, num_threads at a time, at most
+--rate a second. Failed requests are retried with backoff (see retry.py).
+
+Each archive's outcome is appended to a results file, a json line each, as soon as it is known:
+
+    {"archive_id": "...", "status": "done", "job_id": "..."}
+    {"archive_id": "...", "status": "not_found"}
+    {"archive_id": "...", "status": "failed", "error": "..."}
+
+An archive to delete that glacier doesn't have is not_found, unless a delete of it failed earlier
+in the same batch: that delete may have gone through after all, so it counts as done.
+
+Run the same batch again with the same results file to carry on after an interruption, or retry
+what failed: archives already done, or not found, are skipped.
+"""
+
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+import boto3
+import click
+from botocore.config import Config
+
+from inventory import INDEX_PATH, DateTime, connect, find_archives, remove_archives
+from retry import run_with_retries
+
+DONE = 'done'
+NOT_FOUND = 'not_found'
+FAILED = 'failed'
+
+ENDPOINT_URL = os.environ.get('GLACIER_ENDPOINT_URL')
+
+
+class RateLimiter:
+    """Spaces requests out, across threads, to at most rate a second."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self._next_at = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start_at = max(now, self._next_at)
+            self._next_at = start_at + self.interval
+        time.sleep(start_at - now)
+
+
+class BatchResults:
+    """The results file of a batch: what has been done so far, what wasn't found, and what
+    failed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.not_found = set()
+        self.failed = {}
+        try:
+            with open(path) as results_file:
+                for line in results_file:
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        # the last line of a batch that was killed may be cut short
+                        continue
+                    self._add(result['archive_id'], result['status'], result.get('error'))
+        except FileNotFoundError:
+            pass
+        self._file = open(path, 'a')
+
+    def record(self, archive_id, status, **fields):
+        fields.update(archive_id=archive_id, status=status)
+        self._file.write(json.dumps(fields, sort_keys=True) + '\n')
+        self._file.flush()
+        self._add(archive_id, status, fields.get('error'))
+
+    def _add(self, archive_id, status, error):
+        if status == DONE:
+            self.done.add(archive_id)
+        elif status == NOT_FOUND:
+            self.not_found.add(archive_id)
+        if status == FAILED:
+            self.failed[archive_id] = error
+        else:
+            self.failed.pop(archive_id, None)
+
+    def finished(self, archive_id):
+        """Whether there is nothing more to do for the archive."""
+        return archive_id in self.done or archive_id in self.not_found
+
+    def close(self):
+        self._file.close()
+
+
+def delete_archive(glacier, vault_name, archive_id, options):
+    try:
+        glacier.delete_archive(vaultName=vault_name, archiveId=archive_id)
+    except glacier.exceptions.ResourceNotFoundException:
+        # run_batch decides whether this is an earlier attempt having gone through
+        return {'status': NOT_FOUND}
+    return {}
+
+
+def initiate_retrieval(glacier, vault_name, archive_id, options):
+    job_params = {'Type': 'archive-retrieval', 'ArchiveId': archive_id}
+    job_params.update(options)
+    response = glacier.initiate_job(vaultName=vault_name, jobParameters=job_params)
+    return {'job_id': response['jobId']}
+
+
+def run_batch(action, vault_name, archive_ids, results, num_threads, rate, options=None):
+    """Call action(glacier, vault_name, archive_id, options) for each archive not finished already,
+    num_threads at a time, recording each outcome and what action returned in results. action
+    may return a 'status' of NOT_FOUND, which is recorded as done if the archive's request
+    already failed once in this batch. Returns the ids of the archives it was done for."""
+    glacier = boto3.client('glacier', endpoint_url=ENDPOINT_URL, config=Config(
+        retries={'max_attempts': 0}, max_pool_connections=max(10, num_threads)))
+    limiter = RateLimiter(rate)
+
+    def run(archive_id):
+        limiter.wait()
+        return action(glacier, vault_name, archive_id, options or {})
+
+    pending = [archive_id for archive_id in archive_ids if not results.finished(archive_id)]
+    total = len(pending)
+    done = []
+    retried = set()
+
+    def archive_done(archive_id, result):
+        status = result.pop('status', DONE)
+        if status == NOT_FOUND and archive_id in retried:
+            # the request that failed may have gone through after all
+            status = DONE
+        results.record(archive_id, status, **result)
+        if status != DONE:
+            click.echo('{} not found.'.format(archive_id))
+            return
+        done.append(archive_id)
+        if len(done) % 100 == 0:
+            click.echo('{} of {} done.'.format(len(done), total))
+
+    def archive_failed(archive_id, e):
+        click.echo('{} failed: {!r}'.format(archive_id, e))
+        results.record(archive_id, FAILED, error=repr(e))
+
+    def archive_retried(archive_id, kind, e, delay):
+        retried.add(archive_id)
+
+    start = time.perf_counter()
+    click.echo('{} archives to do, {} done or not found already.'.format(
+        total, len(archive_ids) - total))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        run_with_retries(executor, pending, run, archive_done, archive_failed, num_threads,
+                         on_retry=archive_retried)
+
+    elapsed = time.perf_counter() - start
+    click.echo('{} of {} done in {:.1f}s ({:.1f}/s), {} not found, {} failed.'.format(
+        len(done), total, elapsed, len(done) / max(elapsed, 1e-9),
+        len(set(archive_ids) & results.not_found), len(set(archive_ids) & set(results.failed))))
+    return done
+
+
+def get_archive_ids(vault_name, archive_ids, ids_file, start, end, instance, created_before,
+                    index):
+    """The ids given, or else the ids of the archives the query finds in the index."""
+    archive_ids = list(archive_ids)
+    if ids_file is not None:
+        archive_ids.extend(line.strip() for line in ids_file if line.strip())
+    if archive_ids:
+        return list(dict.fromkeys(archive_ids))
+    if (start, end, instance, created_before) == (None, None, None, None):
+        raise click.UsageError('Give archive ids, or a query: --start, --end, --instance '
+                               'or --created-before')
+    rows = find_archives(connect(index), vault_name, start, end, instance, created_before)
+    return [row['archive_id'] for row in rows]
+
+
+def batch_options(command):
+    for option in reversed([
+            click.option('-v', '--vault-name', required=True,
+                         help='The name of the vault'),
+            click.option('-a', '--archive-id', 'archive_ids', multiple=True,
+                         help='The id of an archive. Can be given more than once'),
+            click.option('-f', '--ids-file', type=click.File('r'),
+                         help='A file of archive ids, one a line, or - for stdin'),
+            click.option('-s', '--start', type=DateTime(),
+                         help='Or: archives in the index with logs from after this time (UTC)'),
+            click.option('-e', '--end', type=DateTime(),
+                         help='Or: archives in the index with logs from before this time (UTC)'),
+            click.option('-i', '--instance',
+                         help='Or: archives in the index of this db instance'),
+            click.option('-b', '--created-before', type=DateTime(),
+                         help='Or: archives in the index uploaded before this time (UTC)'),
+            click.option('--index', default=INDEX_PATH,
+                         help='The index to query (default: {})'.format(INDEX_PATH)),
+            click.option('-r', '--results-file', required=True,
+                         help='Where to record the results. Run again with the same file '
+                              'to resume'),
+            click.option('-t', '--num-threads', type=int, default=10,
+                         help='Requests in flight at once (default: 10)'),
+            click.option('--rate', type=float, default=10,
+                         help='At most this many requests a second, 0 for no limit '
+                              '(default: 10)'),
+            click.option('-n', '--dry-run', is_flag=True,
+                         help='Only list the archives'),
+    ]):
+        command = option(command)
+    return command
+
+
+@click.command()
+@batch_options
+def delete_archives(vault_name, archive_ids, ids_file, start, end, instance, created_before,
+                    index, results_file, num_threads, rate, dry_run):
+    """Delete many archives, and take them out of the index: given by id or found with a query,
+    and whether or not glacier had them."""
+    archive_ids = get_archive_ids(vault_name, archive_ids, ids_file, start, end, instance,
+                                  created_before, index)
+    if dry_run:
+        for archive_id in archive_ids:
+            click.echo(archive_id)
+        click.echo('Would delete {} archives.'.format(len(archive_ids)))
+        return
+    results = BatchResults(results_file)
+    try:
+        run_batch(delete_archive, vault_name, archive_ids, results, num_threads, rate)
+    finally:
+        results.close()
+        if os.path.exists(index):
+            remove_archives(connect(index), vault_name, [
+                archive_id for archive_id in archive_ids if results.finished(archive_id)])
+
+
+@click.command()
+@batch_options
+@click.option('--tier', type=click.Choice(['Expedited', 'Standard', 'Bulk']),
+              help='The retrieval tier (default: Standard)')
+@click.option('--sns-topic',
+              help='An SNS topic to notify when each job completes')
+def retrieve_archives(vault_name, archive_ids, ids_file, start, end, instance, created_before,
+                      index, results_file, num_threads, rate, dry_run, tier, sns_topic):
+    """Start archive-retrieval jobs for many archives. Their job ids go in the results file."""
+    archive_ids = get_archive_ids(vault_name, archive_ids, ids_file, start, end, instance,
+                                  created_before, index)
+    if dry_run:
+        for archive_id in archive_ids:
+            click.echo(archive_id)
+        click.echo('Would retrieve {} archives.'.format(len(archive_ids)))
+        return
+    options = {}
+    if tier is not None:
+        options['Tier'] = tier
+    if sns_topic is not None:
+        options['SNSTopic'] = sns_topic
+    results = BatchResults(results_file)
+    try:
+        run_batch(initiate_retrieval, vault_name, archive_ids, results, num_threads, rate, options)
+    finally:
+        results.close()
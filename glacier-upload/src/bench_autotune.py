@@ -0,0 +1,67 @@
+import os
+import tempfile
+import time
+
+import click
+
+from glacier_stub import GlacierStub
+
+MB = 1024 * 1024
+
+
+@click.command()
+@click.option('-s', '--size-mb', type=int, default=256,
+              help='Size of the test file, in megabytes (default: 256)')
+@click.option('-p', '--part-size', default='auto',
+              help='Part size to upload with, in megabytes, or auto (default: auto)')
+@click.option('-t', '--num-threads', multiple=True,
+              help='Thread counts to try, and auto (default: 1, 4, 8, 16, 32, auto)')
+@click.option('--latency', type=float, default=0.05,
+              help='Seconds the stub adds to every request (default: 0.05)')
+@click.option('--bandwidth-mb', type=float, default=200,
+              help='Bandwidth shared by all uploads, in MB/s (default: 200)')
+@click.option('--connection-bandwidth-mb', type=float, default=20,
+              help='Bandwidth of each connection, in MB/s (default: 20)')
+@click.option('--max-concurrent', type=int, default=12,
+              help='Requests in flight beyond this are throttled (default: 12)')
+def bench(size_mb, part_size, num_threads, latency, bandwidth_mb, connection_bandwidth_mb,
+          max_concurrent):
+    """Upload a test file to a local Glacier stub at fixed thread counts, and with auto-tuning."""
+    stub = GlacierStub(latency, bandwidth_mb * MB, connection_bandwidth_mb * MB, max_concurrent)
+    stub.start()
+    # upload.py makes its clients on import, so point them at the stub first
+    os.environ['GLACIER_ENDPOINT_URL'] = stub.url
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'stub')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'stub')
+    from click.testing import CliRunner
+    import upload
+
+    num_threads = num_threads or ('1', '4', '8', '16', '32', 'auto')
+    with tempfile.NamedTemporaryFile() as test_file:
+        click.echo('Writing {} MB test file...'.format(size_mb))
+        for _ in range(size_mb):
+            test_file.write(os.urandom(MB))
+        test_file.flush()
+
+        click.echo('{:>7} {:>10} {:>9} {:>10}'.format('threads', 'MB/s', 'throttled', 'peak'))
+        for threads in num_threads:
+            stub.throttled = stub.peak_in_flight = 0
+            archives = len(stub.archives)
+            start = time.perf_counter()
+            result = CliRunner().invoke(upload.upload, [
+                '-v', 'bench', '-f', test_file.name, '-p', part_size, '-t', threads])
+            elapsed = time.perf_counter() - start
+            if result.exit_code != 0 or len(stub.archives) != archives + 1:
+                click.echo('{:>7} {:>10} {:>9} {:>10}'.format(
+                    threads, 'failed', stub.throttled, stub.peak_in_flight))
+                continue
+            click.echo('{:>7} {:>10.1f} {:>9} {:>10}'.format(
+                threads, size_mb / elapsed, stub.throttled, stub.peak_in_flight))
+            if threads == 'auto':
+                click.echo(result.output.rsplit('Archive ID:', 1)[1].split('\n', 1)[1].rstrip())
+    stub.stop()
+
+
+if __name__ == '__main__':
+    bench()
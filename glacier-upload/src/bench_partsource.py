@@ -0,0 +1,108 @@
+import concurrent.futures
+import hashlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import click
+
+from partsource import PartSource
+
+SEND_BLOCK_SIZE = 64 * 1024
+
+
+def send(body):
+    """Stand in for an upload: read the body in blocks, as http.client does, and hash it."""
+    checksum = hashlib.sha256()
+    for block in iter(lambda: body.read(SEND_BLOCK_SIZE), b''):
+        checksum.update(block)
+    return checksum.digest()
+
+
+def run_locked(fileobj, file_size, part_size, num_threads):
+    # the old upload_part: one shared file handle, guarded by a lock
+    fileblock = threading.Lock()
+
+    def upload_part(byte_pos):
+        with fileblock:
+            fileobj.seek(byte_pos)
+            part = fileobj.read(part_size)
+        return send(io.BytesIO(part))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(executor.map(upload_part, range(0, file_size, part_size)))
+
+
+def run_mapped(fileobj, file_size, part_size, num_threads):
+    source = PartSource(fileobj)
+
+    def upload_part(byte_pos):
+        result = send(source.reader(byte_pos, part_size))
+        source.release(byte_pos, part_size)
+        return result
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        results = list(executor.map(upload_part, range(0, file_size, part_size)))
+    source.close()
+    return results
+
+
+MODES = {'locked': run_locked, 'mmap': run_mapped}
+
+
+def run_single(mode, file_name, part_size, num_threads):
+    """Run one configuration, and print its results as json. Runs in its own process, so
+    that peak RSS isn't carried over between configurations."""
+    with open(file_name, 'rb') as fileobj:
+        file_size = fileobj.seek(0, 2)
+        start = time.perf_counter()
+        MODES[mode](fileobj, file_size, part_size, num_threads)
+        elapsed = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(json.dumps({'elapsed': elapsed, 'peak_rss': peak_rss, 'size': file_size}))
+
+
+@click.command()
+@click.option('-s', '--size-mb', type=int, default=1024,
+              help='Size of the test file, in megabytes (default: 1024)')
+@click.option('-p', '--part-size', type=int, default=64,
+              help='Part size, in megabytes (default: 64)')
+@click.option('-t', '--num-threads', type=int, multiple=True,
+              help='Thread counts to try (default: 1, 2, 5, 10)')
+@click.option('--single', type=(str, str, int, int), default=None, hidden=True)
+def bench(size_mb, part_size, num_threads, single):
+    """Compare peak RSS and throughput of locked reads and mmap part reads."""
+    if single is not None:
+        run_single(*single)
+        return
+
+    num_threads = num_threads or (1, 2, 5, 10)
+    part_size = part_size * 1024 * 1024
+    with tempfile.NamedTemporaryFile() as test_file:
+        click.echo('Writing {} MB test file...'.format(size_mb))
+        for _ in range(size_mb):
+            test_file.write(os.urandom(1024 * 1024))
+        test_file.flush()
+
+        click.echo('{:<8} {:>7} {:>10} {:>12}'.format('mode', 'threads', 'MB/s', 'peak RSS MB'))
+        for threads in num_threads:
+            for mode in sorted(MODES):
+                output = subprocess.check_output([
+                    sys.executable, __file__, '--single',
+                    mode, test_file.name, str(part_size), str(threads)])
+                result = json.loads(output)
+                click.echo('{:<8} {:>7} {:>10.1f} {:>12.1f}'.format(
+                    mode, threads,
+                    result['size'] / 1024 / 1024 / result['elapsed'],
+                    result['peak_rss'] / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,105 @@
+import binascii
+import hashlib
+import os
+import time
+
+import click
+
+from treehash import PartHasher, TreeHash, combine_tree_hashes, tree_hash
+
+
+def legacy_calculate_tree_hash(part, part_size):
+    # calculate_tree_hash as it was before treehash.py
+    checksums = []
+    upper_bound = min(len(part), part_size)
+    step = 1024 * 1024  # 1 MB
+    for chunk_pos in range(0, upper_bound, step):
+        chunk = part[chunk_pos:chunk_pos+step]
+        checksums.append(hashlib.sha256(chunk).hexdigest())
+        del chunk
+    return legacy_calculate_total_tree_hash(checksums)
+
+
+def legacy_calculate_total_tree_hash(list_of_checksums):
+    # calculate_total_tree_hash as it was before treehash.py
+    tree = list_of_checksums[:]
+    while len(tree) > 1:
+        parent = []
+        for i in range(0, len(tree), 2):
+            if i < len(tree) - 1:
+                part1 = binascii.unhexlify(tree[i])
+                part2 = binascii.unhexlify(tree[i + 1])
+                parent.append(hashlib.sha256(part1 + part2).hexdigest())
+            else:
+                parent.append(tree[i])
+        tree = parent
+    return tree[0]
+
+
+def timed(label, size, func):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    click.echo('{:<28} {:8.1f} MB/s {:9.1f} ms'.format(
+        label, size / 1024 / 1024 / elapsed, elapsed * 1000))
+    return result
+
+
+@click.command()
+@click.option('-s', '--size-mb', type=int, default=512,
+              help='Amount of data to hash, in megabytes (default: 512)')
+@click.option('-p', '--part-size', type=int, default=8,
+              help='Part size, in megabytes (default: 8)')
+@click.option('-c', '--chunk-kb', type=int, default=64,
+              help='Size of the writes fed to the streaming hashers, '
+              'in kilobytes (default: 64)')
+def bench(size_mb, part_size, chunk_kb):
+    """Compare treehash.py with the old tree hash functions."""
+    data = os.urandom(size_mb * 1024 * 1024)
+    part_size = part_size * 1024 * 1024
+    chunk_size = chunk_kb * 1024
+    click.echo('Hashing {} MB in {} MB parts.'.format(
+        size_mb, part_size // 1024 // 1024))
+
+    def legacy():
+        return legacy_calculate_total_tree_hash([
+            legacy_calculate_tree_hash(data[pos:pos + part_size], part_size)
+            for pos in range(0, len(data), part_size)])
+
+    def parts():
+        view = memoryview(data)
+        return combine_tree_hashes([
+            tree_hash(view[pos:pos + part_size])
+            for pos in range(0, len(data), part_size)]).hex()
+
+    def streaming():
+        hasher = TreeHash()
+        view = memoryview(data)
+        for pos in range(0, len(data), chunk_size):
+            hasher.update(view[pos:pos + chunk_size])
+        return hasher.hexdigest()
+
+    class Discard:
+        def write(self, data):
+            return len(data)
+
+    def streaming_parts():
+        hasher = PartHasher(Discard(), part_size)
+        view = memoryview(data)
+        for pos in range(0, len(data), chunk_size):
+            hasher.write(view[pos:pos + chunk_size])
+        return combine_tree_hashes(hasher.finish()).hex()
+
+    results = [
+        timed('legacy (per part)', len(data), legacy),
+        timed('treehash (per part)', len(data), parts),
+        timed('treehash (streaming)', len(data), streaming),
+        timed('treehash (streaming parts)', len(data), streaming_parts),
+    ]
+    if len(set(results)) != 1:
+        raise click.ClickException('Tree hashes differ: {}'.format(results))
+    click.echo('All tree hashes match: {}'.format(results[0]))
+
+
+if __name__ == '__main__':
+    bench()
@@ -5,7 +5,7 @@ import click
 @click.command()
 @click.option('-v', '--vault-name', required=True,
               help='The name of the vault')
-@click.option('-u', '--upload-id', required=True,
+@click.option('-a', '--archive-id', required=True,
               help='ID of the archive to delete')
 def delete_archive(vault_name, archive_id):
     glacier = boto3.client('glacier')
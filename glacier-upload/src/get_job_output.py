@@ -1,7 +1,31 @@
+import concurrent.futures
 import json
+import os
+import sys
+import time
 
 import boto3
 import click
+from botocore.config import Config
+
+from inventory import INDEX_PATH, connect, load_inventory_body
+from retry import ChecksumMismatch, run_with_retries
+from treehash import TreeHash, combine_tree_hashes
+from upload_state import SAVE_INTERVAL, write_json
+
+# archive output is read from the response and written to the file this much at a time, so each
+# range in flight holds one block in memory, however big the range is
+BLOCK_SIZE = 1024 * 1024
+PROGRESS_SUFFIX = '.progress.json'
+
+ENDPOINT_URL = os.environ.get('GLACIER_ENDPOINT_URL')
+
+
+def check_range_size(ctx, param, value):
+    # ranges must line up with glacier's tree hashes, which are of 1 MB blocks, in pairs
+    if value < 1 or value & (value - 1):
+        raise click.BadParameter('{} is not a power of 2'.format(value))
+    return value
 
 
 @click.command()
@@ -12,8 +36,19 @@ import click
 @click.option('-f', '--file-name', default='glacier_archive.tar.xz',
               help='File name of archive to be saved, '
                    'if the job is an archive-retrieval')
-def get_job_output(vault_name, job_id, file_name):
-    glacier = boto3.client('glacier')
+@click.option('-r', '--range-size', type=int, default=64, callback=check_range_size,
+              help='Size of the ranges an archive is downloaded in, in '
+                   'megabytes. Must be a power of 2 (default: 64)')
+@click.option('-t', '--num-threads', type=int, default=5,
+              help='The number of ranges to download at once (default: 5)')
+@click.option('--index', default=INDEX_PATH,
+              help='The local index to load an inventory-retrieval into '
+                   '(default: {})'.format(INDEX_PATH))
+@click.option('--raw', is_flag=True,
+              help='Print an inventory-retrieval as it is, instead of '
+                   'loading it into the index')
+def get_job_output(vault_name, job_id, file_name, range_size, num_threads, index, raw):
+    glacier = boto3.client('glacier', endpoint_url=ENDPOINT_URL)
 
     click.echo('Checking job status...')
     response = glacier.describe_job(
@@ -25,17 +60,183 @@ def get_job_output(vault_name, job_id, file_name):
     if not response['Completed']:
         click.echo('Exiting.')
         return
+    elif response['Action'] == 'ArchiveRetrieval':
+        download_archive(vault_name, job_id, file_name, range_size * 1024 * 1024,
+                         num_threads, response)
     else:
         click.echo('Retrieving job data...')
         response = glacier.get_job_output(
             vaultName=vault_name,
             jobId=job_id)
 
-        if response['contentType'] == 'application/json':
-            inventory_json = json.loads(response['body'].read().decode('utf-8'))
-            click.echo(json.dumps(inventory_json, indent=2))
-        elif response['contentType'] == 'text/csv':
-            click.echo(response['body'].read())
+        if raw:
+            stdout = click.get_binary_stream('stdout')
+            for chunk in iter(lambda: response['body'].read(BLOCK_SIZE), b''):
+                stdout.write(chunk)
+        elif response['contentType'] in ('application/json', 'text/csv'):
+            click.echo('Loading inventory into {}...'.format(index))
+            count = load_inventory_body(
+                connect(index), vault_name, response['body'], response['contentType'])
+            click.echo('Indexed {} archives. Search them with inventory.find.'.format(count))
         else:
             with open(file_name, 'xb') as file:
                 file.write(response['body'].read())
+
+
+class DownloadProgress:
+    """Ranges of a retrieval already written to disk, in a sidecar next to the output file, so
+    that an interrupted download carries on where it stopped."""
+
+    def __init__(self, file_name, job_id, size, range_size, checksums=None):
+        self.path = file_name + PROGRESS_SUFFIX
+        self.job_id = job_id
+        self.size = size
+        self.range_size = range_size
+        # tree hashes of the ranges written, by range number
+        self.checksums = checksums or {}
+        self._dirty = True
+        self._saved_at = 0
+
+    @classmethod
+    def load(cls, file_name, job_id, size, range_size):
+        """The progress of this download, or None if there is none to resume."""
+        try:
+            with open(file_name + PROGRESS_SUFFIX) as progress_file:
+                data = json.load(progress_file)
+        except FileNotFoundError:
+            return None
+        if (data['job_id'], data['size'], data['range_size']) != (job_id, size, range_size):
+            return None
+        return cls(file_name, job_id, size, range_size, {
+            int(range_num): checksum for range_num, checksum in data['checksums'].items()})
+
+    def record(self, range_num, checksum):
+        self.checksums[range_num] = checksum
+        self._dirty = True
+
+    def save(self, force=False):
+        if not self._dirty or (not force and time.monotonic() - self._saved_at < SAVE_INTERVAL):
+            return
+        write_json(self.path, {
+            'job_id': self.job_id,
+            'size': self.size,
+            'range_size': self.range_size,
+            'checksums': self.checksums,
+        })
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def remove(self):
+        os.remove(self.path)
+
+
+def download_archive(vault_name, job_id, file_name, range_size, num_threads, job):
+    """Download an archive retrieval's output in ranges, num_threads at a time, checking each
+    against its tree hash, and the whole against the job's."""
+    if job.get('RetrievalByteRange'):
+        first, last = job['RetrievalByteRange'].split('-')
+        size = int(last) - int(first) + 1
+    else:
+        size = job['ArchiveSizeInBytes']
+    num_ranges = max(1, -(-size // range_size))
+
+    progress = None
+    if os.path.exists(file_name):
+        progress = DownloadProgress.load(file_name, job_id, size, range_size)
+        if progress is None:
+            raise click.ClickException(
+                '{} already exists, and is not a download of this job to resume'.format(file_name))
+        click.echo('Resuming download: {} of {} ranges done.'.format(
+            len(progress.checksums), num_ranges))
+        fd = os.open(file_name, os.O_WRONLY)
+    else:
+        progress = DownloadProgress(file_name, job_id, size, range_size)
+        progress.save(force=True)
+        fd = os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        # allocate the whole file up front, so ranges can be written wherever they land
+        os.ftruncate(fd, size)
+
+    # ranges are retried by the download loop rather than botocore
+    glacier = boto3.client('glacier', endpoint_url=ENDPOINT_URL, config=Config(
+        retries={'max_attempts': 0}, max_pool_connections=max(10, num_threads)))
+
+    pending = [
+        range_num for range_num in range(num_ranges) if range_num not in progress.checksums]
+    errors = []
+
+    def run_range(range_num):
+        return download_range(glacier, vault_name, job_id, fd, range_num, range_size, size)
+
+    def range_done(range_num, checksum):
+        progress.record(range_num, checksum)
+        progress.save()
+        click.echo('Range {} of {} done.'.format(range_num + 1, num_ranges))
+
+    def range_failed(range_num, e):
+        errors.append(e)
+
+    def range_retried(range_num, kind, e, delay):
+        click.echo('Range {} failed ({}: {!r}). Retrying in {:.1f}s.'.format(
+            range_num + 1, kind, e, delay))
+
+    start = time.perf_counter()
+    click.echo('Downloading {} bytes in {} ranges...'.format(size, len(pending)))
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+            run_with_retries(executor, pending, run_range, range_done, range_failed, num_threads,
+                             on_retry=range_retried, stop_on_failure=True)
+    finally:
+        os.fsync(fd)
+        os.close(fd)
+        progress.save(force=True)
+
+    if errors:
+        for e in errors:
+            click.echo('Exception occured: %r' % e)
+        click.echo('Download incomplete. Run again to resume it.')
+        sys.exit(1)
+
+    elapsed = time.perf_counter() - start
+    checksum = combine_tree_hashes(
+        bytes.fromhex(progress.checksums[range_num]) for range_num in range(num_ranges)).hex()
+    expected = job.get('SHA256TreeHash')
+    if expected is not None and checksum != expected:
+        click.echo('Tree hash of the download is {}, but glacier has {}.'.format(
+            checksum, expected))
+        click.echo('Delete {} and {} to download it again.'.format(file_name, progress.path))
+        sys.exit(1)
+    progress.remove()
+    click.echo('Downloaded {} bytes in {:.1f}s ({:.1f} MB/s).'.format(
+        size, elapsed, size / 1024 / 1024 / max(elapsed, 1e-9)))
+    click.echo('Tree hash: {}'.format(checksum))
+    click.echo('Done.')
+
+
+def download_range(glacier, vault_name, job_id, fd, range_num, range_size, size):
+    """Download one range of a job's output into the file at fd. Returns its tree hash."""
+    first = range_num * range_size
+    last = min(first + range_size, size) - 1
+    response = glacier.get_job_output(
+        vaultName=vault_name, jobId=job_id, range='bytes={}-{}'.format(first, last))
+
+    hasher = TreeHash()
+    pos = first
+    body = response['body']
+    for block in iter(lambda: body.read(BLOCK_SIZE), b''):
+        hasher.update(block)
+        view = memoryview(block)
+        while view:
+            written = os.pwrite(fd, view, pos)
+            view = view[written:]
+            pos += written
+    if pos != last + 1:
+        raise ChecksumMismatch('Range {}: expected {} bytes, got {}'.format(
+            range_num + 1, last + 1 - first, pos - first))
+
+    checksum = hasher.hexdigest()
+    # ranges are powers of two megabytes from a multiple of their size, so glacier sends their
+    # tree hash. it doesn't for the output of a retrieval of part of an archive, though.
+    if response.get('checksum') and response['checksum'] != checksum:
+        raise ChecksumMismatch('Range {}: calculated {}, glacier has {}'.format(
+            range_num + 1, checksum, response['checksum']))
+    return checksum
@@ -0,0 +1,382 @@
+"""A local stand-in for the Glacier api, for testing and benchmarking uploads and retrievals.
+
+Archives are kept in memory. Signatures are not checked. Retrieval jobs complete as soon as they
+are initiated. Every request waits for latency, and parts and job output also take their size
+over the bandwidth they get: each connection gets at most connection_bandwidth, and together
+they share bandwidth. Requests over max_concurrent in flight are refused with a
+ThrottlingException, and error_rate of them fail with a 500.
+
+GET /stats returns the stub's counters, and how long each part or whole archive upload took to
+answer, in seconds.
+
+    stub = GlacierStub(latency=0.05, bandwidth=100 * 1024 * 1024, max_concurrent=12)
+    stub.start()
+    # point uploads at stub.url, e.g. GLACIER_ENDPOINT_URL=stub.url
+    stub.stop()
+
+Or run it on its own:
+
+    python glacier_stub.py --port 8000 --latency 0.05 --max-concurrent 12
+    GLACIER_ENDPOINT_URL=http://127.0.0.1:8000 python upload.py -v vault -f file -p auto -t auto
+"""
+
+import csv
+import http.server
+import io
+import json
+import random
+import threading
+import time
+import uuid
+
+import click
+
+from treehash import tree_hash
+
+MB = 1024 * 1024
+
+
+class GlacierStubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def handle_request(self, method):
+        stub = self.server.stub
+        start = time.perf_counter()
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if method == 'GET' and self.path == '/stats':
+            return self.send_json(200, stub.stats())
+        # path is /<account id>/vaults/<vault name>/<resource>[/<id>[/output]]
+        parts = self.path.split('?', 1)[0].strip('/').split('/')
+        resource = parts[3] if len(parts) > 3 else None
+        resource_id = parts[4] if len(parts) > 4 else None
+
+        with stub.lock:
+            stub.requests += 1
+            stub.in_flight += 1
+            stub.peak_in_flight = max(stub.peak_in_flight, stub.in_flight)
+            in_flight = stub.in_flight
+        try:
+            if stub.max_concurrent is not None and in_flight > stub.max_concurrent:
+                with stub.lock:
+                    stub.throttled += 1
+                time.sleep(stub.latency)
+                return self.send_error_json(400, 'ThrottlingException', 'Rate exceeded')
+            if stub.error_rate and random.random() < stub.error_rate:
+                with stub.lock:
+                    stub.errors += 1
+                time.sleep(stub.latency)
+                return self.send_error_json(500, 'ServiceUnavailableException', 'Injected error')
+            time.sleep(stub.latency + stub.transfer_time(len(body), in_flight))
+
+            if resource == 'jobs':
+                if method == 'POST' and resource_id is None:
+                    return self.initiate_job(body)
+                if resource_id not in stub.jobs:
+                    return self.send_error_json(404, 'ResourceNotFoundException', 'No such job')
+                if parts[5:] == ['output']:
+                    return self.get_job_output(resource_id, in_flight)
+                return self.describe_job(resource_id)
+            if method == 'POST' and resource == 'archives':
+                return self.upload_archive(body)
+            if method == 'DELETE' and resource == 'archives':
+                return self.delete_archive(resource_id)
+            if method == 'POST' and resource == 'multipart-uploads' and resource_id is None:
+                return self.initiate_multipart_upload()
+            if resource != 'multipart-uploads' or resource_id not in stub.uploads:
+                return self.send_error_json(404, 'ResourceNotFoundException', 'No such upload')
+            if method == 'PUT':
+                return self.upload_part(resource_id, body)
+            if method == 'POST':
+                return self.complete_multipart_upload(resource_id)
+            if method == 'GET':
+                return self.list_parts(resource_id)
+            del stub.uploads[resource_id]
+            return self.send_empty(204, {})
+        finally:
+            with stub.lock:
+                stub.in_flight -= 1
+                if (method, resource) in (('PUT', 'multipart-uploads'), ('POST', 'archives')):
+                    stub.upload_seconds.append(time.perf_counter() - start)
+
+    def upload_archive(self, body):
+        checksum = tree_hash(body).hex()
+        if checksum != self.headers.get('x-amz-sha256-tree-hash', checksum):
+            return self.send_error_json(400, 'InvalidParameterValueException', 'Bad checksum')
+        archive_id = self.server.stub.add_archive(
+            body, self.headers.get('x-amz-archive-description'))
+        return self.send_empty(201, {
+            'Location': '/-/vaults/stub/archives/' + archive_id,
+            'x-amz-archive-id': archive_id,
+            'x-amz-sha256-tree-hash': checksum})
+
+    def delete_archive(self, archive_id):
+        stub = self.server.stub
+        if stub.archives.pop(archive_id, None) is None:
+            return self.send_error_json(404, 'ResourceNotFoundException', 'No such archive')
+        del stub.descriptions[archive_id], stub.creation_dates[archive_id]
+        return self.send_empty(204, {})
+
+    def initiate_multipart_upload(self):
+        upload_id = uuid.uuid4().hex
+        self.server.stub.uploads[upload_id] = {
+            'part_size': int(self.headers['x-amz-part-size']), 'parts': {},
+            'description': self.headers.get('x-amz-archive-description')}
+        return self.send_empty(201, {
+            'Location': '/-/vaults/stub/multipart-uploads/' + upload_id,
+            'x-amz-multipart-upload-id': upload_id})
+
+    def upload_part(self, upload_id, body):
+        # Content-Range is bytes <first>-<last>/*
+        first, last = self.headers['Content-Range'].split()[1].split('/')[0].split('-')
+        checksum = tree_hash(body).hex()
+        if int(last) - int(first) + 1 != len(body):
+            return self.send_error_json(400, 'InvalidParameterValueException', 'Bad range')
+        if checksum != self.headers.get('x-amz-sha256-tree-hash', checksum):
+            return self.send_error_json(400, 'InvalidParameterValueException', 'Bad checksum')
+        self.server.stub.uploads[upload_id]['parts'][int(first)] = body
+        return self.send_empty(204, {'x-amz-sha256-tree-hash': checksum})
+
+    def complete_multipart_upload(self, upload_id):
+        upload = self.server.stub.uploads[upload_id]
+        data = b''.join(upload['parts'][pos] for pos in sorted(upload['parts']))
+        checksum = tree_hash(data).hex()
+        if (len(data) != int(self.headers['x-amz-archive-size']) or
+                checksum != self.headers['x-amz-sha256-tree-hash']):
+            return self.send_error_json(400, 'InvalidParameterValueException',
+                                        'Archive size or checksum does not match the parts')
+        del self.server.stub.uploads[upload_id]
+        archive_id = self.server.stub.add_archive(data, upload['description'])
+        return self.send_empty(201, {
+            'Location': '/-/vaults/stub/archives/' + archive_id,
+            'x-amz-archive-id': archive_id,
+            'x-amz-sha256-tree-hash': checksum})
+
+    def list_parts(self, upload_id):
+        upload = self.server.stub.uploads[upload_id]
+        return self.send_json(200, {
+            'MultipartUploadId': upload_id,
+            'PartSizeInBytes': upload['part_size'],
+            'Marker': None,
+            'Parts': [{
+                'RangeInBytes': '{}-{}'.format(pos, pos + len(part) - 1),
+                'SHA256TreeHash': tree_hash(part).hex()}
+                for pos, part in sorted(upload['parts'].items())]})
+
+    def initiate_job(self, body):
+        params = json.loads(body.decode('utf-8'))
+        if params.get('Type') == 'inventory-retrieval':
+            job = {'Format': params.get('Format', 'JSON')}
+        elif params.get('ArchiveId') in self.server.stub.archives:
+            job = {'ArchiveId': params['ArchiveId']}
+        else:
+            return self.send_error_json(400, 'InvalidParameterValueException',
+                                        'The stub only retrieves archives it has')
+        job_id = uuid.uuid4().hex
+        self.server.stub.jobs[job_id] = job
+        return self.send_empty(202, {
+            'Location': '/-/vaults/stub/jobs/' + job_id, 'x-amz-job-id': job_id})
+
+    def describe_job(self, job_id):
+        job = self.server.stub.jobs[job_id]
+        if 'Format' in job:
+            return self.send_json(200, {
+                'JobId': job_id,
+                'Action': 'InventoryRetrieval',
+                'Completed': True,
+                'StatusCode': 'Succeeded',
+                'InventoryRetrievalParameters': {'Format': job['Format']}})
+        archive_id = job['ArchiveId']
+        archive = self.server.stub.archives[archive_id]
+        checksum = tree_hash(archive).hex()
+        return self.send_json(200, {
+            'JobId': job_id,
+            'Action': 'ArchiveRetrieval',
+            'ArchiveId': archive_id,
+            'ArchiveSizeInBytes': len(archive),
+            'ArchiveSHA256TreeHash': checksum,
+            'SHA256TreeHash': checksum,
+            'RetrievalByteRange': '0-{}'.format(len(archive) - 1),
+            'Completed': True,
+            'StatusCode': 'Succeeded'})
+
+    def get_job_output(self, job_id, in_flight):
+        job = self.server.stub.jobs[job_id]
+        if 'Format' in job:
+            return self.get_inventory(job['Format'])
+        archive = self.server.stub.archives[job['ArchiveId']]
+        first, last = 0, len(archive) - 1
+        if self.headers.get('Range'):
+            # Range is bytes=<first>-<last>
+            first, last = (int(pos) for pos in self.headers['Range'].split('=')[1].split('-'))
+            last = min(last, len(archive) - 1)
+        data = archive[first:last + 1]
+        time.sleep(self.server.stub.transfer_time(len(data), in_flight))
+
+        headers = {'Content-Type': 'application/octet-stream', 'Accept-Ranges': 'bytes'}
+        if self.headers.get('Range'):
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(first, last, len(archive))
+        # glacier only sends the tree hash of ranges that line up with the tree: they start on a
+        # megabyte, and are either a power of two megabytes from a multiple of that, or the end
+        length = len(data)
+        megabytes = length // MB
+        if first % MB == 0 and (last == len(archive) - 1 or (
+                length % MB == 0 and megabytes & (megabytes - 1) == 0 and first % length == 0)):
+            headers['x-amz-sha256-tree-hash'] = tree_hash(data).hex()
+        self.send_response(206 if self.headers.get('Range') else 200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def get_inventory(self, format):
+        stub = self.server.stub
+        archives = [{
+            'ArchiveId': archive_id,
+            'ArchiveDescription': stub.descriptions.get(archive_id) or '',
+            'CreationDate': stub.creation_dates[archive_id],
+            'Size': len(archive),
+            'SHA256TreeHash': tree_hash(archive).hex()}
+            for archive_id, archive in stub.archives.items()]
+        if format == 'JSON':
+            return self.send_json(200, {
+                'VaultARN': 'arn:aws:glacier:us-east-1:000000000000:vaults/stub',
+                'InventoryDate': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'ArchiveList': archives})
+        output = io.StringIO()
+        writer = csv.DictWriter(output, ['ArchiveId', 'ArchiveDescription', 'CreationDate',
+                                         'Size', 'SHA256TreeHash'])
+        writer.writeheader()
+        writer.writerows(archives)
+        body = output.getvalue().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status, headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, code, message):
+        return self.send_json(status, {'code': code, 'message': message, 'type': 'Client'},
+                              {'x-amzn-ErrorType': code})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GlacierStub:
+
+    def __init__(self, latency=0, bandwidth=None, connection_bandwidth=None,
+                 max_concurrent=None, error_rate=0, port=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.connection_bandwidth = connection_bandwidth
+        self.max_concurrent = max_concurrent
+        self.error_rate = error_rate
+        self.uploads = {}
+        self.archives = {}
+        self.descriptions = {}
+        self.creation_dates = {}
+        self.jobs = {}
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.upload_seconds = []
+        self.lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), GlacierStubHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def transfer_time(self, size, in_flight):
+        rates = [rate for rate in (
+            self.connection_bandwidth,
+            self.bandwidth / in_flight if self.bandwidth else None) if rate]
+        return size / min(rates) if rates else 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'errors': self.errors,
+                'peak_in_flight': self.peak_in_flight,
+                'archives': len(self.archives),
+                'archive_bytes': sum(len(archive) for archive in self.archives.values()),
+                'upload_seconds': list(self.upload_seconds)}
+
+    def add_archive(self, data, description=None):
+        archive_id = uuid.uuid4().hex
+        self.archives[archive_id] = data
+        self.descriptions[archive_id] = description
+        self.creation_dates[archive_id] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        return archive_id
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@click.command()
+@click.option('--port', type=int, default=8000, help='Port to listen on (default: 8000)')
+@click.option('--latency', type=float, default=0.05,
+              help='Seconds added to every request (default: 0.05)')
+@click.option('--bandwidth-mb', type=float, default=None,
+              help='Bandwidth shared by all uploads, in MB/s (default: unlimited)')
+@click.option('--connection-bandwidth-mb', type=float, default=None,
+              help='Bandwidth of each connection, in MB/s (default: unlimited)')
+@click.option('--max-concurrent', type=int, default=None,
+              help='Requests in flight beyond this are throttled (default: no limit)')
+@click.option('--error-rate', type=float, default=0,
+              help='Fraction of requests that fail with a 500 (default: 0)')
+def main(port, latency, bandwidth_mb, connection_bandwidth_mb, max_concurrent, error_rate):
+    """Run a local Glacier stub until interrupted."""
+    stub = GlacierStub(
+        latency, bandwidth_mb and bandwidth_mb * 1024 * 1024,
+        connection_bandwidth_mb and connection_bandwidth_mb * 1024 * 1024,
+        max_concurrent, error_rate, port)
+    click.echo('Glacier stub listening on {}'.format(stub.url))
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        click.echo('{} requests, {} throttled, {} errors, {} archives.'.format(
+            stub.requests, stub.throttled, stub.errors, len(stub.archives)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+"""A local SQLite index of a vault's archives, loaded from inventory retrievals.
+
+Inventories are parsed as they stream in, a record at a time, so neither the response nor the
+list of archives is ever held in memory whole. Each load replaces the vault's rows in the index.
+
+Archives uploaded by the audit lambda are described by their name:
+
+    <db instance id>-<YYYY-MM-DD__HH-mm-ss__UTC>[-shard-<i>-of-<n>]<.tar.gz, -manifest.json, ...>
+
+Archives uploaded by older versions of the lambda have the path of the tar they were uploaded from
+as their description, /tmp/<tmp dir>/<name>.tar, and are indexed by the name alone.
+
+The instance id and run time are indexed, so archives can be found by instance and date without
+another inventory job. A run archives the logs written since the instance's previous run (or in
+the 24 hours before it, for its first), so that is the time range each archive is taken to
+cover. Archives with other descriptions are indexed too, just without an instance or times.
+"""
+
+import codecs
+import csv
+import datetime
+import json
+import os
+import re
+import sqlite3
+
+import click
+
+from upload_state import STATE_DIR
+
+INDEX_PATH = os.path.join(STATE_DIR, 'inventory.sqlite')
+READ_SIZE = 1024 * 1024
+INSERT_BATCH_SIZE = 1000
+
+DESCRIPTION_PATTERN = re.compile(
+    r'^(?:.*/)?(?P<instance>[^/]+?)-(?P<date>\d{4}-\d{2}-\d{2})__(?P<hour>\d{2})-(?P<minute>\d{2})-'
+    r'(?P<second>\d{2})__UTC'
+    r'(?:-shard-(?P<shard>\d+)-of-(?P<shard_count>\d+))?(?P<suffix>.*)$')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS archives (
+    vault TEXT NOT NULL,
+    archive_id TEXT NOT NULL,
+    description TEXT,
+    creation_date TEXT,
+    size INTEGER,
+    tree_hash TEXT,
+    instance TEXT,
+    run_time TEXT,
+    covers_from TEXT,
+    shard INTEGER,
+    shard_count INTEGER,
+    suffix TEXT,
+    PRIMARY KEY (vault, archive_id)
+);
+CREATE INDEX IF NOT EXISTS archives_by_time ON archives (vault, run_time);
+CREATE INDEX IF NOT EXISTS archives_by_instance ON archives (vault, instance, run_time);
+CREATE TABLE IF NOT EXISTS inventories (
+    vault TEXT PRIMARY KEY,
+    inventory_date TEXT,
+    archive_count INTEGER,
+    loaded_at TEXT
+);
+'''
+
+COLUMNS = ('archive_id', 'description', 'creation_date', 'size', 'tree_hash', 'instance',
+           'run_time', 'covers_from', 'shard', 'shard_count', 'suffix')
+
+
+def connect(path=INDEX_PATH):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    connection = sqlite3.connect(path)
+    connection.row_factory = sqlite3.Row
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def iter_chunks(body, size=READ_SIZE):
+    for chunk in iter(lambda: body.read(size), b''):
+        yield chunk
+
+
+def iter_text(chunks):
+    """Decode utf-8 chunks, which may split characters between them."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+
+def iter_lines(texts):
+    """Split text into lines, keeping their line endings, as csv.reader wants them."""
+    rest = ''
+    for text in texts:
+        lines = (rest + text).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if rest:
+        yield rest
+
+
+def iter_json_inventory(texts, header):
+    """The archives of a json inventory, one dict at a time.
+
+    Decodes one ArchiveList element at a time from a sliding buffer, so only the current
+    element is held whole. Top level fields before the list are put in header.
+    """
+    decoder = json.JSONDecoder()
+    texts = iter(texts)
+    buffer = ''
+
+    def fill():
+        nonlocal buffer
+        text = next(texts, None)
+        if text is None:
+            return False
+        buffer += text
+        return True
+
+    # everything up to the list is small; take the fields we know of out of it
+    while True:
+        start = buffer.find('"ArchiveList"')
+        if start >= 0 and buffer.find('[', start) >= 0:
+            break
+        if not fill():
+            raise ValueError('No ArchiveList in the inventory')
+    for key in ('VaultARN', 'InventoryDate'):
+        match = re.search(r'"{}"\s*:\s*("(?:[^"\\]|\\.)*")'.format(key), buffer[:start])
+        if match:
+            header[key] = json.loads(match.group(1))
+    pos = buffer.find('[', start) + 1
+
+    while True:
+        # skip to the next element, or the end of the list
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer):
+                break
+            buffer, pos = '', 0
+            if not fill():
+                raise ValueError('The inventory ended in the middle of ArchiveList')
+        if buffer[pos] == ']':
+            return
+        try:
+            archive, end = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            # the element isn't all here yet
+            buffer, pos = buffer[pos:], 0
+            if not fill():
+                raise
+            continue
+        yield archive
+        pos = end
+
+
+def iter_csv_inventory(texts):
+    """The archives of a csv inventory, one dict at a time."""
+    for row in csv.DictReader(iter_lines(texts)):
+        row['Size'] = int(row['Size'])
+        yield row
+
+
+def parse_description(description):
+    """The instance id, run time ('YYYY-MM-DD HH:MM:SS', UTC), shard, shard count and suffix of
+    an audit archive's description, or Nones for any other."""
+    match = DESCRIPTION_PATTERN.match(description or '')
+    if match is None:
+        return None, None, None, None, None
+    # strptime would be most of the time it takes to load an inventory
+    run_time = '{} {}:{}:{}'.format(*match.group('date', 'hour', 'minute', 'second'))
+    return (match.group('instance'), run_time,
+            match.group('shard') and int(match.group('shard')),
+            match.group('shard_count') and int(match.group('shard_count')),
+            match.group('suffix'))
+
+
+def make_row(archive):
+    instance, run_time, shard, shard_count, suffix = parse_description(
+        archive.get('ArchiveDescription'))
+    return (archive['ArchiveId'], archive.get('ArchiveDescription'), archive.get('CreationDate'),
+            archive.get('Size'), archive.get('SHA256TreeHash'), instance, run_time, None,
+            shard, shard_count, suffix)
+
+
+def load_inventory(connection, vault, archives, inventory_date=None):
+    """Replace the vault's archives in the index with archives, an iterable of inventory
+    records. Returns how many there were."""
+    count = 0
+    with connection:
+        connection.execute('DELETE FROM archives WHERE vault = ?', (vault,))
+        insert = 'INSERT OR REPLACE INTO archives (vault, {}) VALUES (?, {})'.format(
+            ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)))
+        batch = []
+        for archive in archives:
+            batch.append((vault,) + make_row(archive))
+            if len(batch) >= INSERT_BATCH_SIZE:
+                connection.executemany(insert, batch)
+                count += len(batch)
+                batch = []
+        connection.executemany(insert, batch)
+        count += len(batch)
+
+        # each run covers the time since the instance's previous run, or the day before it
+        connection.execute('''
+            UPDATE archives SET covers_from = COALESCE(
+                (SELECT MAX(previous.run_time) FROM archives AS previous
+                 WHERE previous.vault = archives.vault AND previous.instance = archives.instance
+                 AND previous.run_time < archives.run_time),
+                datetime(run_time, '-1 day'))
+            WHERE vault = ? AND run_time IS NOT NULL''', (vault,))
+        connection.execute(
+            'INSERT OR REPLACE INTO inventories VALUES (?, ?, ?, datetime(\'now\'))',
+            (vault, inventory_date, count))
+    return count
+
+
+def load_inventory_body(connection, vault, body, content_type):
+    """Stream an inventory job's output into the index. Returns how many archives it had."""
+    texts = iter_text(iter_chunks(body))
+    if content_type == 'text/csv':
+        return load_inventory(connection, vault, iter_csv_inventory(texts))
+    header = {}
+    archives = iter_json_inventory(texts, header)
+    # the header is read along with the first archive, so only look at it after loading
+    count = load_inventory(connection, vault, archives)
+    if header.get('InventoryDate'):
+        with connection:
+            connection.execute('UPDATE inventories SET inventory_date = ? WHERE vault = ?',
+                               (header['InventoryDate'], vault))
+    return count
+
+
+def find_archives(connection, vault, start=None, end=None, instance=None, created_before=None):
+    """Archives that may hold logs written between start and end (datetimes, UTC), of instance
+    and uploaded before created_before if given, ordered by instance and run time."""
+    query = 'SELECT * FROM archives WHERE vault = ?'
+    params = [vault]
+    if created_before is not None:
+        # glacier's creation dates are like 2018-05-16T00:30:00Z, which sort as they should
+        query += ' AND creation_date < ?'
+        params.append(created_before.strftime('%Y-%m-%dT%H:%M:%SZ'))
+    if instance is not None:
+        query += ' AND instance = ?'
+        params.append(instance)
+    if end is not None:
+        query += ' AND covers_from < ?'
+        params.append(end.strftime('%Y-%m-%d %H:%M:%S'))
+    if start is not None:
+        query += ' AND run_time > ?'
+        params.append(start.strftime('%Y-%m-%d %H:%M:%S'))
+    query += ' ORDER BY instance, run_time, shard'
+    return connection.execute(query, params).fetchall()
+
+
+def remove_archives(connection, vault, archive_ids):
+    """Take deleted archives out of the index."""
+    with connection:
+        connection.executemany('DELETE FROM archives WHERE vault = ? AND archive_id = ?',
+                               ((vault, archive_id) for archive_id in archive_ids))
+
+
+class DateTime(click.ParamType):
+    """A date, or a date and time, in one of formats. click 6 has no DateTime of its own."""
+    name = 'datetime'
+
+    def __init__(self, formats=('%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S')):
+        self.formats = formats
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, datetime.datetime):
+            return value
+        for date_format in self.formats:
+            try:
+                return datetime.datetime.strptime(value, date_format)
+            except ValueError:
+                pass
+        self.fail('{} is not a date in one of the formats {}'.format(
+            value, ', '.join(self.formats)), param, ctx)
+
+
+@click.command()
+@click.option('-v', '--vault-name', required=True,
+              help='The name of the vault')
+@click.option('-d', '--date', type=DateTime(['%Y-%m-%d']),
+              help='Find archives with logs from this day (UTC)')
+@click.option('-s', '--start', type=DateTime(),
+              help='Find archives with logs from after this time (UTC)')
+@click.option('-e', '--end', type=DateTime(),
+              help='Find archives with logs from before this time (UTC)')
+@click.option('-i', '--instance',
+              help='Only find archives of this db instance')
+@click.option('--index', default=INDEX_PATH,
+              help='The index to search (default: {})'.format(INDEX_PATH))
+def find(vault_name, date, start, end, instance, index):
+    """Find archives in the local index, loaded by get_job_output from an inventory job."""
+    if date is not None:
+        start, end = date, date + datetime.timedelta(days=1)
+    connection = connect(index)
+    loaded = connection.execute(
+        'SELECT * FROM inventories WHERE vault = ?', (vault_name,)).fetchone()
+    if loaded is None:
+        raise click.ClickException('No inventory of {} has been loaded into {}'.format(
+            vault_name, index))
+    click.echo('Inventory of {} from {}, {} archives.'.format(
+        vault_name, loaded['inventory_date'] or loaded['loaded_at'], loaded['archive_count']))
+    for row in find_archives(connection, vault_name, start, end, instance):
+        click.echo('{}  {}  {:>12}  {}'.format(
+            row['run_time'] or '-', row['archive_id'], row['size'], row['description']))
@@ -0,0 +1,112 @@
+"""Lock-free, zero-copy access to the parts of a file being uploaded.
+
+PartSource memory-maps the file, so each upload thread gets its part as a memoryview of the
+mapping. Threads share no file cursor, so no lock is needed, and no part is copied into a new
+bytes object. Pages are dropped from memory as soon as they have been read, so resident memory
+stays around num_threads megabytes rather than num_threads * part_size. If they are read again
+(e.g. when a part is retried) they come back from the page cache.
+
+Files that can't be mapped (empty files, pipes, some network file systems) fall back to
+os.pread, which reads at an offset without touching the shared cursor either.
+"""
+
+import io
+import mmap
+import os
+
+
+RELEASE_EVERY = 1024 * 1024
+
+
+class MemoryViewReader(io.RawIOBase):
+    """A seekable, read-only file object over a memoryview, for use as a request body.
+
+    release(offset, length), if given, is called with each megabyte that has been read.
+    """
+
+    def __init__(self, view, release=None):
+        self._view = view
+        self._pos = 0
+        self._release = release
+        self._released = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = min(len(buffer), len(self._view) - self._pos)
+        buffer[:count] = self._view[self._pos:self._pos + count]
+        self._pos += count
+        if self._release is not None and (
+                self._pos - self._released >= RELEASE_EVERY or self._pos == len(self._view)):
+            if self._pos > self._released:
+                self._release(self._released, self._pos - self._released)
+            self._released = self._pos
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = len(self._view) + offset
+        self._pos = max(0, min(self._pos, len(self._view)))
+        self._released = min(self._released, self._pos)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def __len__(self):
+        return len(self._view)
+
+
+class PartSource:
+
+    def __init__(self, fileobj):
+        fileobj.flush()
+        self._fd = fileobj.fileno()
+        self.size = os.fstat(self._fd).st_size
+        self._map = None
+        if self.size > 0:
+            try:
+                self._map = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                self._map = None
+        self.mapped = self._map is not None
+
+    def part(self, byte_pos, part_size):
+        """The bytes of one part, as a memoryview."""
+        length = max(0, min(part_size, self.size - byte_pos))
+        if self._map is not None:
+            return memoryview(self._map)[byte_pos:byte_pos + length]
+        return memoryview(os.pread(self._fd, length, byte_pos))
+
+    def reader(self, byte_pos, part_size):
+        """One part as a file object, to pass as an upload body."""
+        return MemoryViewReader(
+            self.part(byte_pos, part_size),
+            lambda offset, length: self.release(byte_pos + offset, length))
+
+    def release(self, byte_pos, length):
+        """Tell the kernel a range isn't needed anymore, so its pages can leave memory."""
+        if self._map is None or not hasattr(self._map, 'madvise'):
+            return
+        start = byte_pos - byte_pos % mmap.PAGESIZE
+        end = min(byte_pos + length, self.size)
+        if end > start:
+            self._map.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+    def close(self):
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # a memoryview of the map is still alive somewhere; it is unmapped
+                # once that is garbage collected.
+                pass
+            self._map = None
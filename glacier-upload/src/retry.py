@@ -0,0 +1,139 @@
+"""Classifying failed requests, and scheduling their retries with backoff.
+
+Errors are throttling (slow down, then retry), transient (retry after a short wait) or fatal
+(retrying won't help, e.g. the upload id has expired). Backoff is exponential with full jitter:
+each retry waits a random time between nothing and the exponential delay, so parts that failed
+together don't all come back together.
+
+run_with_retries is the loop that uploads parts, downloads ranges and runs batches: it keeps a
+bounded number of jobs in flight on an executor, and puts failed jobs back once their backoff is
+over, so that a worker is never tied up sleeping.
+"""
+
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import random
+import time
+
+from botocore.exceptions import ChecksumError, ClientError, EndpointConnectionError
+
+THROTTLING = 'throttling'
+TRANSIENT = 'transient'
+FATAL = 'fatal'
+
+THROTTLING_CODES = ('ThrottlingException', 'RequestLimitExceeded',
+                    'TooManyRequestsException', 'SlowDown')
+TRANSIENT_CODES = ('RequestTimeoutException', 'ServiceUnavailableException',
+                   'InternalFailure', 'InternalError', 'ServiceUnavailable')
+
+MAX_ATTEMPTS = 10
+
+BASE_DELAY = 0.5
+THROTTLING_BASE_DELAY = 2.0
+MAX_DELAY = 60.0
+
+
+class ChecksumMismatch(Exception):
+    """Glacier's tree hash of an uploaded part wasn't the one we calculated."""
+
+
+def classify_error(error):
+    """THROTTLING, TRANSIENT or FATAL."""
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        if code in THROTTLING_CODES or status == 429:
+            return THROTTLING
+        if code in TRANSIENT_CODES or status >= 500:
+            return TRANSIENT
+        return FATAL
+    # connection errors and timeouts are all OSErrors, botocore's included
+    if isinstance(error, (ChecksumMismatch, ChecksumError, EndpointConnectionError, OSError)):
+        return TRANSIENT
+    return FATAL
+
+
+def backoff_delay(attempt, kind=TRANSIENT):
+    """Seconds to wait before retry number attempt (counting from 1) of a failure of kind."""
+    base = THROTTLING_BASE_DELAY if kind == THROTTLING else BASE_DELAY
+    return random.uniform(0, min(MAX_DELAY, base * 2 ** (attempt - 1)))
+
+
+class RetryQueue:
+    """Jobs waiting out their backoff before they can be retried."""
+
+    def __init__(self):
+        self._heap = []
+        # breaks ties between jobs due at the same time, so jobs themselves are never compared
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, job, delay):
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), job))
+
+    def pop_ready(self):
+        """Jobs whose backoff is over, in the order they became due."""
+        ready = []
+        now = time.monotonic()
+        while self._heap and self._heap[0][0] <= now:
+            ready.append(heapq.heappop(self._heap)[2])
+        return ready
+
+    def next_ready_in(self):
+        """Seconds until the next job is due, or None if there are none."""
+        if not self._heap:
+            return None
+        return max(0, self._heap[0][0] - time.monotonic())
+
+
+def run_with_retries(executor, jobs, run_job, on_success, on_failure, max_in_flight,
+                     on_retry=None, stop_on_failure=False, max_attempts=MAX_ATTEMPTS):
+    """Run run_job(job) on executor for each of jobs, at most max_in_flight at a time.
+
+    on_success(job, result) is called with what each job returned, and on_failure(job, error)
+    once a job has failed for good: with a fatal error, or max_attempts times. Any other failure
+    is retried after its backoff, and on_retry(job, kind, error, delay) is called. The callbacks
+    run on the calling thread.
+
+    max_in_flight is a number, or a function returning one, for a limit that changes as jobs
+    run. With stop_on_failure, no more jobs are started once one has failed for good, and only
+    those in flight are waited for. Returns whether every job succeeded.
+    """
+    limit = max_in_flight if callable(max_in_flight) else lambda: max_in_flight
+    pending = collections.deque(jobs)
+    retries = RetryQueue()
+    attempts = collections.Counter()
+    failed = False
+    futures = {}
+    while ((pending or retries) and not (failed and stop_on_failure)) or futures:
+        pending.extend(retries.pop_ready())
+        while pending and not (failed and stop_on_failure) and len(futures) < limit():
+            job = pending.popleft()
+            futures[executor.submit(run_job, job)] = job
+        if not futures:
+            time.sleep(retries.next_ready_in())
+            continue
+        done, _ = concurrent.futures.wait(
+            futures, timeout=retries.next_ready_in(),
+            return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            job = futures.pop(future)
+            error = future.exception()
+            if error is None:
+                on_success(job, future.result())
+                continue
+            kind = classify_error(error)
+            attempts[job] += 1
+            if kind == FATAL or attempts[job] >= max_attempts:
+                failed = True
+                on_failure(job, error)
+                continue
+            delay = backoff_delay(attempts[job], kind)
+            if on_retry is not None:
+                on_retry(job, kind, error, delay)
+            retries.push(job, delay)
+    return not failed
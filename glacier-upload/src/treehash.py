@@ -0,0 +1,151 @@
+"""Incremental Glacier SHA256 tree hashes.
+
+Glacier checksums are the root of a binary tree of SHA256 digests, whose leaves are the hashes
+of each 1 MB chunk of the data. Each level pairs up neighbours from left to right, and an odd
+one out is promoted to the next level unchanged.
+
+TreeHash computes this incrementally, so data can be hashed as it streams past (while it is
+being read, tarred or uploaded) rather than in a separate pass. Chunks are hashed through
+memoryview slices, so nothing is copied, and digests are kept as raw bytes until the end.
+Only one digest per level of the tree is kept, so memory use is O(log n).
+"""
+
+import hashlib
+
+CHUNK_SIZE = 1024 * 1024  # 1 MB
+EMPTY_DIGEST = hashlib.sha256(b'').digest()
+
+
+def _combine(left, right):
+    return hashlib.sha256(left + right).digest()
+
+
+class TreeHash:
+    """Incremental tree hash, used like a hashlib object."""
+
+    def __init__(self, data=None):
+        self._leaf = hashlib.sha256()
+        self._leaf_size = 0
+        self._size = 0
+        # roots of perfect subtrees, largest first, as (height, digest) pairs. like the digits
+        # of a binary counter, adding a leaf merges equal height subtrees from the right.
+        self._stack = []
+        if data is not None:
+            self.update(data)
+
+    def __len__(self):
+        return self._size
+
+    def update(self, data):
+        view = memoryview(data).cast('B')
+        pos = 0
+        while pos < len(view):
+            take = min(CHUNK_SIZE - self._leaf_size, len(view) - pos)
+            self._leaf.update(view[pos:pos + take])
+            self._leaf_size += take
+            pos += take
+            if self._leaf_size == CHUNK_SIZE:
+                self._push_leaf()
+        self._size += len(view)
+
+    def _push_leaf(self):
+        digest = self._leaf.digest()
+        self._leaf = hashlib.sha256()
+        self._leaf_size = 0
+        height = 0
+        while self._stack and self._stack[-1][0] == height:
+            digest = _combine(self._stack.pop()[1], digest)
+            height += 1
+        self._stack.append((height, digest))
+
+    def digest(self):
+        """The tree hash of everything so far, as raw bytes. More data can still be added."""
+        stack = list(self._stack)
+        if self._leaf_size:
+            stack.append((0, self._leaf.digest()))
+        if not stack:
+            return EMPTY_DIGEST
+        # level by level pairing leaves the perfect subtrees intact, and then joins what is
+        # left from the right, which is where the odd ones out end up.
+        digest = stack.pop()[1]
+        while stack:
+            digest = _combine(stack.pop()[1], digest)
+        return digest
+
+    def hexdigest(self):
+        return self.digest().hex()
+
+
+def tree_hash(data):
+    """The tree hash of a bytes-like object, as raw bytes."""
+    return TreeHash(data).digest()
+
+
+def combine_tree_hashes(digests):
+    """Combine raw tree hashes of consecutive parts into the tree hash of the whole.
+
+    Every part but the last must be a power of two number of megabytes, as multipart upload
+    part sizes are.
+    """
+    tree = list(digests)
+    if not tree:
+        return EMPTY_DIGEST
+    while len(tree) > 1:
+        parent = [_combine(tree[i], tree[i + 1]) for i in range(0, len(tree) - 1, 2)]
+        if len(tree) % 2:
+            parent.append(tree[-1])
+        tree = parent
+    return tree[0]
+
+
+class PartHasher:
+    """Tree hashes every part_size part of a stream as it passes, e.g. while it is written.
+
+    Wraps a file object: writes go through to it, and part_digests fills up with the raw tree
+    hash of each completed part.
+    """
+
+    def __init__(self, fileobj, part_size):
+        self.fileobj = fileobj
+        self.part_size = part_size
+        self.part_digests = []
+        self._part = TreeHash()
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        pos = 0
+        while pos < len(view):
+            take = min(self.part_size - len(self._part), len(view) - pos)
+            self._part.update(view[pos:pos + take])
+            pos += take
+            if len(self._part) == self.part_size:
+                self.part_digests.append(self._part.digest())
+                self._part = TreeHash()
+        return self.fileobj.write(data)
+
+    def finish(self):
+        """Hash the final, partial part. Returns the digests of all parts."""
+        if len(self._part):
+            self.part_digests.append(self._part.digest())
+            self._part = TreeHash()
+        return self.part_digests
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+def tree_hash_file_range(file_name, offset, length):
+    """The tree hash of length bytes of a file from offset, as raw bytes. Reads a chunk at a
+    time, so memory use doesn't grow with length. Opens the file itself, so it can run in
+    another process."""
+    hasher = TreeHash()
+    buffer = bytearray(CHUNK_SIZE)
+    with open(file_name, 'rb', buffering=0) as part_file:
+        part_file.seek(offset)
+        while length > 0:
+            count = part_file.readinto(memoryview(buffer)[:min(CHUNK_SIZE, length)])
+            if not count:
+                break
+            hasher.update(memoryview(buffer)[:count])
+            length -= count
+    return hasher.digest()
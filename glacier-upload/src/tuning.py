@@ -0,0 +1,164 @@
+"""Part size selection and concurrency auto-tuning for multipart uploads.
+
+Glacier multipart uploads take at most 10,000 parts, of a power of two number of megabytes
+between 1 MB and 4 GB. choose_part_size picks the smallest part size that fits a file into that.
+
+ConcurrencyTuner decides how many parts are in flight at once. It works in rounds: each round
+lasts until as many parts have completed as were allowed in flight when it started. At the end of
+a round it compares the round's throughput with the previous one's, and climbs towards whichever
+limit uploads fastest, one part at a time. Throttling halves the limit straight away, and the
+limit is also walked back when part latency grows without throughput growing with it, since that
+means more parts are only queueing up somewhere.
+"""
+
+import threading
+import time
+
+MB = 1024 * 1024
+MAX_PARTS = 10000
+MIN_PART_SIZE = 1 * MB
+MAX_PART_SIZE = 4096 * MB
+
+# a round must beat the last by this much for the limit to keep moving the same way
+IMPROVEMENT = 0.05
+# part latency this many times the best seen, without more throughput, means we're queueing
+LATENCY_SLACK = 2.0
+
+
+def choose_part_size(file_size):
+    """The smallest valid part size, in bytes, that uploads file_size in at most 10,000 parts."""
+    part_size = MIN_PART_SIZE
+    while part_size * MAX_PARTS < file_size:
+        part_size *= 2
+    if part_size > MAX_PART_SIZE:
+        raise ValueError('File is too large for a multipart upload: {} bytes is more than '
+                         '10,000 parts of 4096 MB'.format(file_size))
+    return part_size
+
+
+def check_part_size(part_size, file_size):
+    """Raise a ValueError if file_size doesn't fit in 10,000 parts of part_size bytes."""
+    num_parts = -(-file_size // part_size)
+    if num_parts > MAX_PARTS:
+        raise ValueError('part-size of {} MB would need {} parts, but glacier allows at most '
+                         '10,000. Use a part-size of at least {} MB, or auto.'.format(
+                             part_size // MB, num_parts, choose_part_size(file_size) // MB))
+
+
+class ConcurrencyTuner:
+    """Picks how many parts to keep in flight, from the latency and throughput of past parts.
+
+    With min_limit == max_limit the limit never changes, and the tuner only keeps statistics.
+    """
+
+    def __init__(self, initial_limit, min_limit=1, max_limit=None):
+        self.min_limit = min_limit
+        self.max_limit = max_limit or initial_limit
+        self.limit = max(min_limit, min(initial_limit, self.max_limit))
+        self.initial_limit = self.limit
+        self.peak_limit = self.limit
+
+        self.parts = 0
+        self.bytes = 0
+        self.retries = 0
+        self.throttles = 0
+        self.start_time = None
+        self.end_time = None
+
+        self._lock = threading.Lock()
+        self._direction = 1
+        self._last_throughput = None
+        self._best_latency = None
+        self.start()
+
+    def start(self):
+        """Start the clocks, of the whole upload and of the first round. Call it just before the
+        first part is submitted, so time spent getting ready doesn't count as uploading."""
+        self.start_time = time.perf_counter()
+        self._new_round()
+
+    def _new_round(self):
+        self._round_start = time.perf_counter()
+        self._round_parts = 0
+        self._round_bytes = 0
+        self._round_latency = 0.0
+        self._round_throttled = False
+
+    @property
+    def fixed(self):
+        return self.min_limit == self.max_limit
+
+    def record_part(self, size, latency):
+        """Record a part that uploaded, with how long its successful attempt took."""
+        with self._lock:
+            self.parts += 1
+            self.bytes += size
+            self._round_parts += 1
+            self._round_bytes += size
+            self._round_latency += latency
+            if self._round_parts >= self.limit:
+                self._end_round()
+
+    def record_retry(self, throttled=False):
+        """Record a failed attempt at a part. Throttling backs off at once."""
+        with self._lock:
+            self.retries += 1
+            if not throttled:
+                return
+            self.throttles += 1
+            if not self._round_throttled:
+                # one halving per round, since every part in flight may be throttled together
+                self._round_throttled = True
+                self._set_limit(self.limit // 2)
+                self._direction = 1
+                self._last_throughput = None
+
+    def _end_round(self):
+        elapsed = max(time.perf_counter() - self._round_start, 1e-9)
+        throughput = self._round_bytes / elapsed
+        latency = self._round_latency / self._round_parts
+        if self._best_latency is None or latency < self._best_latency:
+            self._best_latency = latency
+
+        if self._round_throttled:
+            pass
+        elif self._last_throughput is None:
+            # nothing to compare with yet, keep probing upwards
+            self._set_limit(self.limit + self._direction)
+        elif throughput > self._last_throughput * (1 + IMPROVEMENT):
+            # that step helped, take another the same way
+            self._set_limit(self.limit + self._direction)
+        elif latency > self._best_latency * LATENCY_SLACK:
+            # slower parts with no more throughput to show for it
+            self._direction = -1
+            self._set_limit(self.limit - 1)
+        elif throughput < self._last_throughput * (1 - IMPROVEMENT):
+            # that step hurt, turn around
+            self._direction = -self._direction
+            self._set_limit(self.limit + self._direction)
+        self._last_throughput = throughput
+        self._new_round()
+
+    def _set_limit(self, limit):
+        self.limit = max(self.min_limit, min(limit, self.max_limit))
+        self.peak_limit = max(self.peak_limit, self.limit)
+
+    def finish(self):
+        self.end_time = time.perf_counter()
+
+    def summary(self, part_size):
+        """A human readable report of the upload's throughput, retries and settings."""
+        elapsed = max((self.end_time or time.perf_counter()) - self.start_time, 1e-9)
+        lines = [
+            'Uploaded {} parts, {:.1f} MB in {:.1f}s ({:.1f} MB/s).'.format(
+                self.parts, self.bytes / MB, elapsed, self.bytes / MB / elapsed),
+            'Retries: {} ({} throttled).'.format(self.retries, self.throttles),
+        ]
+        if self.fixed:
+            lines.append('Part size: {} MB, threads: {}.'.format(part_size // MB, self.limit))
+        else:
+            lines.append('Part size: {} MB, parts in flight: started at {}, peaked at {}, '
+                         'finished at {} (max {}).'.format(
+                             part_size // MB, self.initial_limit, self.peak_limit, self.limit,
+                             self.max_limit))
+        return '\n'.join(lines)
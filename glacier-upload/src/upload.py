@@ -14,23 +14,50 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import binascii
 import concurrent.futures
-import hashlib
+import itertools
 import math
-import os.path
+import os
 import sys
 import tarfile
 import tempfile
-import threading
+import time
 
 import boto3
 import click
+from botocore.config import Config
 
-MAX_ATTEMPTS = 10
+from partsource import PartSource
+from retry import THROTTLING, ChecksumMismatch, run_with_retries
+from treehash import (PartHasher, combine_tree_hashes, tree_hash,
+                      tree_hash_file_range)
+from tuning import (MIN_PART_SIZE, ConcurrencyTuner, check_part_size,
+                    choose_part_size)
+from upload_state import FileManifest, UploadState
 
-fileblock = threading.Lock()
-glacier = boto3.client('glacier')
+# with --num-threads auto, how many parts are in flight to begin with
+AUTO_INITIAL_THREADS = 4
+
+# GLACIER_ENDPOINT_URL points the script somewhere other than aws, e.g. at glacier_stub.py
+ENDPOINT_URL = os.environ.get('GLACIER_ENDPOINT_URL')
+
+glacier = boto3.client('glacier', endpoint_url=ENDPOINT_URL)
+# parts are retried by the upload loop rather than botocore, so that throttling can be seen and
+# backed off from. the pool is big enough for any sensible --max-threads.
+part_client = boto3.client('glacier', endpoint_url=ENDPOINT_URL, config=Config(
+    retries={'max_attempts': 0}, max_pool_connections=64))
+
+
+class IntOrAuto(click.ParamType):
+    name = 'integer|auto'
+
+    def convert(self, value, param, ctx):
+        if value == 'auto' or isinstance(value, int):
+            return value
+        try:
+            return int(value)
+        except ValueError:
+            self.fail('{} is not an integer or auto'.format(value), param, ctx)
 
 
 @click.command()
@@ -42,41 +69,77 @@ glacier = boto3.client('glacier')
 @click.option('-d', '--arc-desc', default='',
               metavar='ARCHIVE_DESCRIPTION',
               help='The archive description to help identify archives later')
-@click.option('-p', '--part-size', type=int, default=8,
+@click.option('-p', '--part-size', type=IntOrAuto(), default=8,
               help='The part size for multipart upload, in '
-              'megabytes (e.g. 1, 2, 4, 8) default: 8')
-@click.option('-t', '--num-threads', type=int, default=5,
-              help='The amount of concurrent threads (default: 5)')
+              'megabytes (e.g. 1, 2, 4, 8), or auto for the smallest that '
+              'fits the file in 10,000 parts. default: 8')
+@click.option('-t', '--num-threads', type=IntOrAuto(), default=5,
+              help='The amount of concurrent threads, or auto to adjust it '
+              'while uploading (default: 5)')
+@click.option('-m', '--max-threads', type=int, default=32,
+              help='With --num-threads auto, the most threads to use '
+              '(default: 32)')
 @click.option('-u', '--upload-id',
               help='Optional upload id, if provided then will '
               'resume upload.')
-def upload(vault_name, file_name, arc_desc, part_size, num_threads, upload_id):
-    if not math.log2(part_size).is_integer():
-        raise ValueError('part-size must be a power of 2')
-    if part_size < 1 or part_size > 4096:
-        raise ValueError('part-size must be more than 1 MB '
-                         'and less than 4096 MB')
+@click.option('-j', '--verify-processes', type=int, default=1,
+              help='When resuming, the number of processes to hash uploaded '
+              'parts with, for parts with no saved tree hash (default: 1)')
+def upload(vault_name, file_name, arc_desc, part_size, num_threads, max_threads,
+           upload_id, verify_processes):
+    if part_size != 'auto':
+        if part_size < 1 or part_size > 4096:
+            raise ValueError('part-size must be more than 1 MB '
+                             'and less than 4096 MB')
+        if not math.log2(part_size).is_integer():
+            raise ValueError('part-size must be a power of 2')
+        part_size = part_size * 1024 * 1024
+    if num_threads == 'auto':
+        tuner = ConcurrencyTuner(AUTO_INITIAL_THREADS, 1, max_threads)
+    elif num_threads < 1:
+        raise ValueError('num-threads must be at least 1')
+    else:
+        tuner = ConcurrencyTuner(num_threads, num_threads, num_threads)
+
+    # tree hashes of parts already known without reading the file again, by part number
+    known_checksums = {}
+    hashed_digests = None
 
     click.echo('Reading file...')
     if len(file_name) > 1 or os.path.isdir(file_name[0]):
         click.echo('Tarring file...')
         file_to_upload = tempfile.TemporaryFile()
-        tar = tarfile.open(fileobj=file_to_upload, mode='w:xz')
+        # hash the parts while the tar is written, rather than reading it back later. an auto
+        # part size isn't known until the tar is, so hash 1 MB parts and combine them after.
+        hasher = PartHasher(file_to_upload, MIN_PART_SIZE if part_size == 'auto' else part_size)
+        tar = tarfile.open(fileobj=hasher, mode='w:xz')
         for filename in file_name:
             tar.add(filename)
         tar.close()
+        hashed_digests = hasher.finish()
+        # the temporary file is memory-mapped below, like any other file
+        file_to_upload.flush()
         click.echo('File tarred.')
     else:
         file_to_upload = open(file_name[0], mode='rb')
         click.echo('Opened single file.')
 
-    part_size = part_size * 1024 * 1024
-
     file_size = file_to_upload.seek(0, 2)
+    if part_size == 'auto':
+        part_size = choose_part_size(file_size)
+        click.echo('Part size: {} MB.'.format(part_size // 1024 // 1024))
+    if hashed_digests is not None:
+        # hashed_digests are for parts of hasher.part_size; a part of part_size bytes is a
+        # whole subtree of them, since both are powers of two
+        per_part = part_size // hasher.part_size
+        known_checksums = {
+            part_num: combine_tree_hashes(hashed_digests[pos:pos + per_part]).hex()
+            for part_num, pos in enumerate(range(0, len(hashed_digests), per_part))}
 
     if file_size < 4096:
         click.echo('File size is less than 4 MB. Uploading in one request...')
 
+        file_to_upload.seek(0)
         response = glacier.upload_archive(
             vaultName=vault_name,
             archiveDescription=arc_desc,
@@ -90,10 +153,20 @@ def upload(vault_name, file_name, arc_desc, part_size, num_threads, upload_id):
         file_to_upload.close()
         return
 
+    source = PartSource(file_to_upload)
     job_list = []
     list_of_checksums = []
+    # a tar is made afresh each run, so only a single file's parts can be trusted on resume
+    state = None
+    manifest = None
+    if hashed_digests is None:
+        file_path = os.path.abspath(file_name[0])
+        file_mtime = os.fstat(file_to_upload.fileno()).st_mtime_ns
+    else:
+        file_path = None
 
     if upload_id is None:
+        check_part_size(part_size, file_size)
         click.echo('Initiating multipart upload...')
         response = glacier.initiate_multipart_upload(
             vaultName=vault_name,
@@ -101,6 +174,13 @@ def upload(vault_name, file_name, arc_desc, part_size, num_threads, upload_id):
             partSize=str(part_size)
         )
         upload_id = response['uploadId']
+        if file_path is not None:
+            state = UploadState(upload_id, vault_name, file_path, file_size, file_mtime,
+                                part_size)
+            state.save(force=True)
+            click.echo('Upload state: {}'.format(state.path))
+            manifest = FileManifest.load(file_path, file_size, file_mtime, part_size)
+            known_checksums.update(manifest.checksums)
 
         for byte_pos in range(0, file_size, part_size):
             job_list.append(byte_pos)
@@ -117,6 +197,10 @@ def upload(vault_name, file_name, arc_desc, part_size, num_threads, upload_id):
             uploadId=upload_id
         )
         parts = response['Parts']
+        if part_size != response['PartSizeInBytes']:
+            click.echo('Using the upload\'s part size of {} MB.'.format(
+                response['PartSizeInBytes'] // 1024 // 1024))
+            known_checksums = {}
         part_size = response['PartSizeInBytes']
         while 'Marker' in response:
             click.echo('Getting more parts...')
@@ -127,48 +211,100 @@ def upload(vault_name, file_name, arc_desc, part_size, num_threads, upload_id):
             )
             parts.extend(response['Parts'])
 
-        for byte_pos in range(0, file_size, part_size):
-            job_list.append(byte_pos)
-            list_of_checksums.append(None)
-
-        num_parts = len(job_list)
-        with click.progressbar(parts, label='Verifying uploaded parts') as bar:
-            for part_data in bar:
-                byte_start = int(part_data['RangeInBytes'].partition('-')[0])
-                file_to_upload.seek(byte_start)
-                part = file_to_upload.read(part_size)
-                checksum = calculate_tree_hash(part, part_size)
-
-                if checksum == part_data['SHA256TreeHash']:
-                    job_list.remove(byte_start)
-                    part_num = byte_start // part_size
-                    list_of_checksums[part_num] = checksum
+        num_parts = -(-file_size // part_size)
+        list_of_checksums = [None] * num_parts
+        if file_path is not None:
+            state = UploadState.load(upload_id)
+            if state is not None and not state.matches(
+                    vault_name, file_path, file_size, file_mtime, part_size):
+                click.echo('Saved state of this upload is for a different or changed file. '
+                           'Ignoring it.')
+                state = None
+            if state is None:
+                state = UploadState(upload_id, vault_name, file_path, file_size, file_mtime,
+                                    part_size)
+            else:
+                click.echo('Loaded upload state: {} parts done.'.format(len(state.checksums)))
+            manifest = FileManifest.load(file_path, file_size, file_mtime, part_size)
+            known_checksums.update(manifest.checksums)
+
+        # parts whose saved tree hash matches glacier's are trusted without reading them
+        to_verify = []
+        for part_data in parts:
+            part_num = int(part_data['RangeInBytes'].partition('-')[0]) // part_size
+            glacier_checksum = part_data['SHA256TreeHash']
+            if ((state is not None and state.checksums.get(part_num) == glacier_checksum) or
+                    (manifest is not None and
+                     manifest.checksums.get(part_num) == glacier_checksum)):
+                list_of_checksums[part_num] = glacier_checksum
+            else:
+                to_verify.append((part_num, glacier_checksum))
+        click.echo('{} uploaded parts match saved tree hashes, {} to verify.'.format(
+            len(parts) - len(to_verify), len(to_verify)))
+
+        checksums = hash_parts(
+            source, file_path, [part_num * part_size for part_num, _ in to_verify],
+            part_size, verify_processes)
+        for (part_num, glacier_checksum), checksum in zip(to_verify, checksums):
+            if manifest is not None:
+                manifest.record(part_num, checksum)
+            if checksum == glacier_checksum:
+                list_of_checksums[part_num] = checksum
+
+        for part_num, checksum in enumerate(list_of_checksums):
+            if checksum is None:
+                job_list.append(part_num * part_size)
+            elif state is not None:
+                state.record(part_num, checksum)
 
     click.echo('Spawning threads...')
-    with concurrent.futures.ThreadPoolExecutor(
-            max_workers=num_threads) as executor:
-        futures_list = {executor.submit(
-            upload_part, job, vault_name, upload_id, part_size, file_to_upload,
-            file_size, num_parts): job // part_size for job in job_list}
-        done, not_done = concurrent.futures.wait(
-            futures_list, return_when=concurrent.futures.FIRST_EXCEPTION)
-        if len(not_done) > 0:
-            # an exception occured
-            for future in not_done:
-                future.cancel()
-            for future in done:
-                e = future.exception()
-                if e is not None:
-                    click.echo('Exception occured: %r' % e)
-            click.echo('Upload not aborted. Upload id: %s' % upload_id)
-            click.echo('Exiting.')
-            file_to_upload.close()
-            sys.exit(1)
-        else:
-            # all threads completed without raising
-            for future in done:
-                job_index = futures_list[future]
-                list_of_checksums[job_index] = future.result()
+    errors = []
+
+    def run_part(job):
+        return upload_part(job, vault_name, upload_id, part_size, source, file_size, num_parts,
+                           tuner, known_checksums)
+
+    def part_done(job, checksum):
+        part_num = job // part_size
+        list_of_checksums[part_num] = checksum
+        if state is not None:
+            state.record(part_num, checksum)
+            state.save()
+        if manifest is not None:
+            manifest.record(part_num, checksum)
+            manifest.save()
+
+    def part_failed(job, e):
+        errors.append(e)
+
+    def part_retried(job, kind, e, delay):
+        tuner.record_retry(kind == THROTTLING)
+        click.echo('Part {} failed ({}: {!r}). Retrying in {:.1f}s.'.format(
+            job // part_size + 1, kind, e, delay))
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=tuner.max_limit) as executor:
+            # parts are submitted as others finish, so no more than tuner.limit are in flight
+            tuner.start()
+            run_with_retries(executor, job_list, run_part, part_done, part_failed,
+                             lambda: tuner.limit, on_retry=part_retried, stop_on_failure=True)
+    finally:
+        if state is not None:
+            state.save(force=True)
+        if manifest is not None:
+            manifest.save(force=True)
+    tuner.finish()
+    if errors:
+        # an exception occured
+        for e in errors:
+            click.echo('Exception occured: %r' % e)
+        click.echo(tuner.summary(part_size))
+        click.echo('Upload not aborted. Upload id: %s' % upload_id)
+        click.echo('Exiting.')
+        source.close()
+        file_to_upload.close()
+        sys.exit(1)
 
     if len(list_of_checksums) != num_parts:
         click.echo('List of checksums incomplete. Recalculating...')
@@ -176,9 +312,8 @@ def upload(vault_name, file_name, arc_desc, part_size, num_threads, upload_id):
         for byte_pos in range(0, file_size, part_size):
             part_num = int(byte_pos / part_size)
             click.echo('Checksum %s of %s...' % (part_num + 1, num_parts))
-            file_to_upload.seek(byte_pos)
-            part = file_to_upload.read(part_size)
-            list_of_checksums.append(calculate_tree_hash(part, part_size))
+            list_of_checksums.append(calculate_tree_hash(
+                source.part(byte_pos, part_size), part_size))
 
     total_tree_hash = calculate_total_tree_hash(list_of_checksums)
 
@@ -191,16 +326,19 @@ def upload(vault_name, file_name, arc_desc, part_size, num_threads, upload_id):
     click.echo('Glacier total tree hash: %s' % response['checksum'])
     click.echo('Location: %s' % response['location'])
     click.echo('Archive ID: %s' % response['archiveId'])
+    click.echo(tuner.summary(part_size))
     click.echo('Done.')
+    if state is not None:
+        state.remove()
+    source.close()
     file_to_upload.close()
 
 
-def upload_part(byte_pos, vault_name, upload_id, part_size, fileobj, file_size,
-                num_parts):
-    fileblock.acquire()
-    fileobj.seek(byte_pos)
-    part = fileobj.read(part_size)
-    fileblock.release()
+def upload_part(byte_pos, vault_name, upload_id, part_size, source, file_size,
+                num_parts, tuner, known_checksums):
+    """Make one attempt at uploading a part. Returns its tree hash; retries are up to the
+    caller."""
+    part = source.part(byte_pos, part_size)
 
     range_header = 'bytes {}-{}/{}'.format(
         byte_pos, byte_pos + len(part) - 1, file_size)
@@ -210,54 +348,57 @@ def upload_part(byte_pos, vault_name, upload_id, part_size, fileobj, file_size,
     click.echo('Uploading part {0} of {1}... ({2:.2%})'.format(
         part_num + 1, num_parts, percentage))
 
-    for i in range(MAX_ATTEMPTS):
-        try:
-            response = glacier.upload_multipart_part(
-                vaultName=vault_name, uploadId=upload_id,
-                range=range_header, body=part)
-            checksum = calculate_tree_hash(part, part_size)
-            if checksum != response['checksum']:
-                click.echo('Checksums do not match. Will try again.')
-                continue
-
-            # if everything worked, then we can break
-            break
-        except:
-            click.echo('Upload error:', sys.exc_info()[0])
-            click.echo('Trying again. Part {0}'.format(part_num + 1))
-    else:
-        click.echo('After multiple attempts, still failed to upload part')
-        click.echo('Exiting.')
-        sys.exit(1)
-
+    # hash once, whatever the number of attempts; passing the checksum stops botocore computing
+    # the tree hash again, though it still computes the linear sha256 of the whole part for
+    # x-amz-content-sha256
+    checksum = known_checksums.get(part_num)
+    if checksum is None:
+        checksum = calculate_tree_hash(part, part_size)
+        known_checksums[part_num] = checksum
     del part
+
+    try:
+        start = time.perf_counter()
+        response = part_client.upload_multipart_part(
+            vaultName=vault_name, uploadId=upload_id,
+            range=range_header, body=source.reader(byte_pos, part_size),
+            checksum=checksum)
+        if checksum != response['checksum']:
+            raise ChecksumMismatch('Part {}: calculated {}, glacier has {}'.format(
+                part_num + 1, checksum, response['checksum']))
+        tuner.record_part(min(part_size, file_size - byte_pos), time.perf_counter() - start)
+    finally:
+        source.release(byte_pos, part_size)
     return checksum
 
 
-def calculate_tree_hash(part, part_size):
+def hash_parts(source, file_path, byte_positions, part_size, num_processes):
+    """Tree hashes of the parts at byte_positions, in order. With more than one process, and a
+    file that other processes can open, they are spread over a process pool."""
+    if num_processes > 1 and file_path is not None and len(byte_positions) > 1:
+        with concurrent.futures.ProcessPoolExecutor(num_processes) as executor:
+            digests = executor.map(
+                tree_hash_file_range, itertools.repeat(file_path), byte_positions,
+                itertools.repeat(part_size))
+            with click.progressbar(digests, length=len(byte_positions),
+                                   label='Verifying uploaded parts') as bar:
+                return [digest.hex() for digest in bar]
+
     checksums = []
-    upper_bound = min(len(part), part_size)
-    step = 1024 * 1024  # 1 MB
-    for chunk_pos in range(0, upper_bound, step):
-        chunk = part[chunk_pos:chunk_pos+step]
-        checksums.append(hashlib.sha256(chunk).hexdigest())
-        del chunk
-    return calculate_total_tree_hash(checksums)
+    with click.progressbar(byte_positions, label='Verifying uploaded parts') as bar:
+        for byte_pos in bar:
+            checksums.append(calculate_tree_hash(source.part(byte_pos, part_size), part_size))
+            source.release(byte_pos, part_size)
+    return checksums
+
+
+def calculate_tree_hash(part, part_size):
+    return tree_hash(memoryview(part)[:part_size]).hex()
 
 
 def calculate_total_tree_hash(list_of_checksums):
-    tree = list_of_checksums[:]
-    while len(tree) > 1:
-        parent = []
-        for i in range(0, len(tree), 2):
-            if i < len(tree) - 1:
-                part1 = binascii.unhexlify(tree[i])
-                part2 = binascii.unhexlify(tree[i + 1])
-                parent.append(hashlib.sha256(part1 + part2).hexdigest())
-            else:
-                parent.append(tree[i])
-        tree = parent
-    return tree[0]
+    return combine_tree_hashes(
+        [bytes.fromhex(checksum) for checksum in list_of_checksums]).hex()
 
 
 if __name__ == '__main__':
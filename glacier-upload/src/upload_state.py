@@ -0,0 +1,152 @@
+"""Upload state kept on disk, so that a resumed upload knows which parts are already done.
+
+Each multipart upload gets a json file named after its upload id, in ~/.glacier-upload (or
+GLACIER_UPLOAD_STATE_DIR). It records the file the upload is of and the tree hash of every part
+Glacier has confirmed. Resuming with --upload-id trusts those parts when list_parts agrees,
+instead of reading them back from disk and hashing them again.
+
+Each uploaded file also gets a sidecar manifest next to it, <file>.treehash.json, with the tree
+hash of every part of it that has been hashed, whichever upload that was for. It holds the
+file's size and mtime, and is ignored once either changes. It lets a resume skip reading parts
+even when the upload's own state is lost, and a fresh upload of the same file skip hashing.
+
+Saves are rate limited, since the whole file is rewritten each time. They are atomic, so an
+interrupted save leaves the previous state behind.
+"""
+
+import json
+import os
+import time
+
+STATE_DIR = os.environ.get('GLACIER_UPLOAD_STATE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.glacier-upload'))
+SAVE_INTERVAL = 5  # seconds
+MANIFEST_SUFFIX = '.treehash.json'
+
+
+def get_state_path(upload_id):
+    return os.path.join(STATE_DIR, '{}.json'.format(upload_id))
+
+
+def write_json(path, data):
+    """Write data to path as json, atomically."""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as json_file:
+        json.dump(data, json_file)
+    os.replace(temp_path, path)
+
+
+class UploadState:
+
+    def __init__(self, upload_id, vault_name, file_name, file_size, file_mtime, part_size,
+                 checksums=None):
+        self.upload_id = upload_id
+        self.vault_name = vault_name
+        self.file_name = file_name
+        self.file_size = file_size
+        self.file_mtime = file_mtime
+        self.part_size = part_size
+        # tree hashes of parts glacier has confirmed, by part number
+        self.checksums = checksums or {}
+        self.path = get_state_path(upload_id)
+        self._dirty = True
+        self._saved_at = 0
+
+    @classmethod
+    def load(cls, upload_id):
+        """The saved state of an upload, or None if there is none."""
+        try:
+            with open(get_state_path(upload_id)) as state_file:
+                data = json.load(state_file)
+        except FileNotFoundError:
+            return None
+        state = cls(data['upload_id'], data['vault_name'], data['file_name'], data['file_size'],
+                    data.get('file_mtime'), data['part_size'],
+                    {int(part_num): checksum for part_num, checksum in data['checksums'].items()})
+        state._dirty = False
+        return state
+
+    def matches(self, vault_name, file_name, file_size, file_mtime, part_size):
+        return (self.vault_name, self.file_name, self.file_size, self.file_mtime,
+                self.part_size) == (vault_name, file_name, file_size, file_mtime, part_size)
+
+    def record(self, part_num, checksum):
+        self.checksums[part_num] = checksum
+        self._dirty = True
+
+    def save(self, force=False):
+        """Write the state out if it changed, at most every SAVE_INTERVAL seconds unless forced."""
+        if not self._dirty or (not force and time.monotonic() - self._saved_at < SAVE_INTERVAL):
+            return
+        os.makedirs(STATE_DIR, exist_ok=True)
+        write_json(self.path, {
+            'upload_id': self.upload_id,
+            'vault_name': self.vault_name,
+            'file_name': self.file_name,
+            'file_size': self.file_size,
+            'file_mtime': self.file_mtime,
+            'part_size': self.part_size,
+            'checksums': self.checksums,
+        })
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def remove(self):
+        """Forget the upload, once it is complete."""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class FileManifest:
+    """Tree hashes of the parts of a file, kept in a sidecar next to it."""
+
+    def __init__(self, file_name, file_size, file_mtime, part_size, checksums=None):
+        self.path = file_name + MANIFEST_SUFFIX
+        self.file_size = file_size
+        self.file_mtime = file_mtime
+        self.part_size = part_size
+        # tree hashes by part number
+        self.checksums = checksums or {}
+        self.writable = True
+        self._dirty = False
+        self._saved_at = 0
+
+    @classmethod
+    def load(cls, file_name, file_size, file_mtime, part_size):
+        """The file's manifest, or an empty one if it has none or the file has changed since."""
+        manifest = cls(file_name, file_size, file_mtime, part_size)
+        try:
+            with open(manifest.path) as manifest_file:
+                data = json.load(manifest_file)
+        except (OSError, ValueError):
+            return manifest
+        if (data.get('file_size'), data.get('file_mtime'), data.get('part_size')) == (
+                file_size, file_mtime, part_size):
+            manifest.checksums = {
+                int(part_num): checksum for part_num, checksum in data['checksums'].items()}
+        return manifest
+
+    def record(self, part_num, checksum):
+        if self.checksums.get(part_num) != checksum:
+            self.checksums[part_num] = checksum
+            self._dirty = True
+
+    def save(self, force=False):
+        """Like UploadState.save. Gives up quietly on a directory that can't be written to."""
+        if not self.writable or not self._dirty or (
+                not force and time.monotonic() - self._saved_at < SAVE_INTERVAL):
+            return
+        try:
+            write_json(self.path, {
+                'file_size': self.file_size,
+                'file_mtime': self.file_mtime,
+                'part_size': self.part_size,
+                'checksums': self.checksums,
+            })
+        except OSError:
+            self.writable = False
+            return
+        self._dirty = False
+        self._saved_at = time.monotonic()
@@ -0,0 +1,193 @@
+"""
+Archive Store Stubs
+
+In-memory stand-ins for the glacier and s3 clients the archive stores use (see
+audit/archive_stores.py), for testing and benchmarking uploads without an AWS account.
+
+They check what the real services check: glacier tree hashes, and s3 Content-MD5s and part sizes.
+Every request waits for latency, and then for its body to go over the network, at most
+connection_bandwidth bytes a second per request and bandwidth for all of them together (either
+can be 0, for no limit). error_rate of the requests with a body fail.
+
+    network = StubNetwork(latency=0.05, bandwidth=200 * MB, connection_bandwidth=40 * MB)
+    glacier_client = StubGlacierClient(network)
+    s3_client = StubS3Client(network)
+"""
+import base64
+import hashlib
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+def get_parent_path(path):
+    return os.path.abspath(os.path.join(path, os.pardir))
+
+SCRIPT_DIR = get_parent_path(os.path.realpath(__file__))
+PROJECT_DIR = get_parent_path(SCRIPT_DIR)
+sys.path.append(os.path.join(PROJECT_DIR, 'audit'))
+
+from glacier_multipart import calculate_total_tree_hash, calculate_tree_hash
+from instances import RateLimiter
+from s3_multipart import MIN_PART_SIZE
+
+MB = 1024 * 1024
+
+
+class StubError(ClientError):
+    """ an error response, 'Code: message', raised like botocore raises them. """
+
+    def __init__(self, error, status=400):
+        code, _, message = error.partition(': ')
+        super(StubError, self).__init__(
+            {'Error': {'Code': code, 'Message': message}, 'ResponseMetadata': {'HTTPStatusCode': status}}, 'Stub')
+
+
+class StubNetwork(object):
+
+    def __init__(self, latency=0, bandwidth=0, connection_bandwidth=0, error_rate=0):
+        self.latency = latency
+        self.connection_bandwidth = connection_bandwidth
+        self.error_rate = error_rate
+        self.shared = RateLimiter(bandwidth)
+        self.requests = 0
+        self.bytes = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def send(self, size=0):
+        """ waits as long as sending size bytes would take, and fails error_rate of the time. """
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+        if self.latency:
+            time.sleep(self.latency)
+        if size:
+            self.shared.wait(size)
+            if self.connection_bandwidth:
+                time.sleep(float(size) / self.connection_bandwidth)
+            if self.error_rate and random.random() < self.error_rate:
+                with self.lock:
+                    self.errors += 1
+                raise StubError('InternalError: injected error', 500)
+
+
+class StubGlacierClient(object):
+    """ a glacier client for a single vault, keeping archives in memory, by archive id. """
+
+    def __init__(self, network=None):
+        self.network = network or StubNetwork()
+        self.archives = {}
+        self.descriptions = {}
+        self.uploads = {}
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def _add_archive(self, description, body):
+        with self.lock:
+            archive_id = 'archive-%s' % next(self.ids)
+            self.archives[archive_id] = body
+            self.descriptions[archive_id] = description
+        return archive_id
+
+    def upload_archive(self, vaultName, archiveDescription, body):
+        self.network.send(len(body))
+        return {'archiveId': self._add_archive(archiveDescription, body), 'checksum': calculate_tree_hash(body)}
+
+    def initiate_multipart_upload(self, vaultName, archiveDescription, partSize):
+        self.network.send()
+        with self.lock:
+            upload_id = 'upload-%s' % next(self.ids)
+            self.uploads[upload_id] = {'description': archiveDescription, 'part_size': int(partSize), 'parts': {}}
+        return {'uploadId': upload_id}
+
+    def upload_multipart_part(self, vaultName, uploadId, range, body, checksum=None):
+        self.network.send(len(body))
+        first, last = [int(pos) for pos in range.split(' ')[1].split('/')[0].split('-')]
+        if last - first + 1 != len(body):
+            raise StubError('InvalidParameterValueException: range does not match the body')
+        part_checksum = calculate_tree_hash(body)
+        if checksum is not None and checksum != part_checksum:
+            raise StubError('InvalidParameterValueException: checksum does not match the body')
+        with self.lock:
+            self.uploads[uploadId]['parts'][first] = (part_checksum, bytes(body))
+        return {'checksum': part_checksum}
+
+    def complete_multipart_upload(self, vaultName, uploadId, archiveSize, checksum):
+        self.network.send()
+        with self.lock:
+            upload = self.uploads.pop(uploadId)
+        parts = [upload['parts'][first] for first in sorted(upload['parts'])]
+        body = b''.join(part for _, part in parts)
+        if len(body) != int(archiveSize):
+            raise StubError('InvalidParameterValueException: archive size does not match the parts')
+        if calculate_total_tree_hash([part_checksum for part_checksum, _ in parts]) != checksum:
+            raise StubError('InvalidParameterValueException: checksum does not match the parts')
+        return {'archiveId': self._add_archive(upload['description'], body), 'checksum': checksum}
+
+    def abort_multipart_upload(self, vaultName, uploadId):
+        self.network.send()
+        with self.lock:
+            self.uploads.pop(uploadId, None)
+
+
+class StubS3Client(object):
+    """ an s3 client keeping objects in memory, as (body, storage class), by (bucket, key). """
+
+    def __init__(self, network=None):
+        self.network = network or StubNetwork()
+        self.objects = {}
+        self.uploads = {}
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, StorageClass='STANDARD', **kwargs):
+        self.network.send(len(Body))
+        with self.lock:
+            self.objects[(Bucket, Key)] = (bytes(Body), StorageClass)
+        return {'ETag': '"%s"' % hashlib.md5(Body).hexdigest()}
+
+    def create_multipart_upload(self, Bucket, Key, StorageClass='STANDARD', **kwargs):
+        self.network.send()
+        with self.lock:
+            upload_id = 'upload-%s' % next(self.ids)
+            self.uploads[upload_id] = {'key': (Bucket, Key), 'storage_class': StorageClass, 'parts': {}}
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ContentMD5=None, **kwargs):
+        self.network.send(len(Body))
+        digest = hashlib.md5(Body)
+        if ContentMD5 is not None and base64.b64decode(ContentMD5) != digest.digest():
+            raise StubError('BadDigest: the Content-MD5 does not match the body')
+        etag = '"%s"' % digest.hexdigest()
+        with self.lock:
+            self.uploads[UploadId]['parts'][PartNumber] = (etag, bytes(Body))
+        return {'ETag': etag}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.network.send()
+        with self.lock:
+            upload = self.uploads.pop(UploadId)
+        parts = MultipartUpload['Parts']
+        if [part['PartNumber'] for part in parts] != sorted(upload['parts']):
+            raise StubError('InvalidPartOrder: parts must be listed in order, each once')
+        bodies = []
+        for i, part in enumerate(parts):
+            etag, body = upload['parts'][part['PartNumber']]
+            if part['ETag'] != etag:
+                raise StubError('InvalidPart: ETag does not match part %s' % part['PartNumber'])
+            if i < len(parts) - 1 and len(body) < MIN_PART_SIZE:
+                raise StubError('EntityTooSmall: part %s is smaller than 5MB' % part['PartNumber'])
+            bodies.append(body)
+        with self.lock:
+            self.objects[upload['key']] = (b''.join(bodies), upload['storage_class'])
+        return {'Bucket': Bucket, 'Key': Key}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.network.send()
+        with self.lock:
+            self.uploads.pop(UploadId, None)
@@ -0,0 +1,97 @@
+"""
+Archive Store Benchmark
+
+Streams the same data into a glacier vault and an s3 bucket (see audit/archive_stores.py), the way
+an archive is written, and reports the throughput of each, and how many requests it took. Both run
+against the in-memory stubs in archive_stubs.py, over the same simulated network, and the uploaded
+archives are checked against the data.
+
+    python tools/bench_archive_stores.py --size-mb 256 --threads 4 --latency-ms 50 --connection-mbps 40
+
+With --s3-endpoint-url, the s3 bucket is a real one there instead, e.g. a moto server
+(`moto_server s3 -p 5000`, then --s3-endpoint-url http://127.0.0.1:5000), and the network
+options only apply to the glacier stub.
+"""
+import hashlib
+import os
+import sys
+import time
+
+import boto3
+import click
+
+def get_parent_path(path):
+    return os.path.abspath(os.path.join(path, os.pardir))
+
+SCRIPT_DIR = get_parent_path(os.path.realpath(__file__))
+PROJECT_DIR = get_parent_path(SCRIPT_DIR)
+sys.path.append(os.path.join(PROJECT_DIR, 'audit'))
+
+from archive_stores import GlacierVault, S3Bucket
+from archive_stubs import MB, StubGlacierClient, StubNetwork, StubS3Client
+
+BUFFER_SIZE = MB
+BUCKET = 'bench-archives'
+
+def write_archive(store, data):
+    sink = store.open('bench.tar.gz')
+    start = time.time()
+    try:
+        for pos in range(0, len(data), BUFFER_SIZE):
+            sink.write(data[pos:pos + BUFFER_SIZE])
+        archive_id = sink.close()
+    except Exception:
+        sink.abort()
+        raise
+    return archive_id, time.time() - start
+
+def get_uploaded(store, archive_id):
+    if isinstance(store, GlacierVault):
+        return store.glacier_client.archives[archive_id]
+    if isinstance(store.s3_client, StubS3Client):
+        return store.s3_client.objects[(store.bucket, store.get_key('bench.tar.gz'))][0]
+    return store.s3_client.get_object(Bucket=store.bucket, Key=store.get_key('bench.tar.gz'))['Body'].read()
+
+@click.command()
+@click.option('--size-mb', type=int, default=128, help='Size of the archive, in MB')
+@click.option('--part-size-mb', type=int, default=8, help='Part size, in MB. A power of 2, at least 8 (default: 8)')
+@click.option('--threads', type=int, default=4, help='Parts uploaded at once (default: 4)')
+@click.option('--latency-ms', type=int, default=50, help='Latency of every request, in ms (default: 50)')
+@click.option('--bandwidth-mbps', type=float, default=0, help='MB/s shared by all requests, 0 for no limit')
+@click.option('--connection-mbps', type=float, default=40, help='MB/s of each request, 0 for no limit (default: 40)')
+@click.option('--error-rate', type=float, default=0, help='Share of part uploads that fail, e.g. 0.01')
+@click.option('--storage-class', default='GLACIER', help='S3 storage class (default: GLACIER)')
+@click.option('--s3-endpoint-url', help='Use the s3 api at this url instead of the stub, e.g. a moto server')
+def main(size_mb, part_size_mb, threads, latency_ms, bandwidth_mbps, connection_mbps, error_rate, storage_class,
+         s3_endpoint_url):
+    data = os.urandom(size_mb * MB)
+    digest = hashlib.sha256(data).hexdigest()
+    part_size = part_size_mb * MB
+
+    def make_network():
+        return StubNetwork(latency=latency_ms / 1000.0, bandwidth=bandwidth_mbps * MB,
+                           connection_bandwidth=connection_mbps * MB, error_rate=error_rate)
+
+    glacier_network = make_network()
+    stores = [('glacier vault', glacier_network,
+               GlacierVault(StubGlacierClient(glacier_network), 'bench', part_size, threads))]
+    if s3_endpoint_url:
+        s3_client = boto3.client('s3', endpoint_url=s3_endpoint_url)
+        s3_client.create_bucket(Bucket=BUCKET)
+        stores.append(('s3 ' + storage_class, None, S3Bucket(s3_client, BUCKET, 'bench', storage_class, part_size, threads)))
+    else:
+        s3_network = make_network()
+        stores.append(('s3 ' + storage_class, s3_network,
+                       S3Bucket(StubS3Client(s3_network), BUCKET, 'bench', storage_class, part_size, threads)))
+
+    click.echo('%s MB in %s MB parts, %s at a time' % (size_mb, part_size_mb, threads))
+    click.echo('%-20s %8s %8s %9s %7s' % ('store', 'seconds', 'MB/s', 'requests', 'errors'))
+    for name, network, store in stores:
+        archive_id, elapsed = write_archive(store, data)
+        if hashlib.sha256(get_uploaded(store, archive_id)).hexdigest() != digest:
+            raise Exception('the archive uploaded to the %s does not match the data' % name)
+        click.echo('%-20s %8.2f %8.1f %9s %7s' % (
+            name, elapsed, size_mb / elapsed, network.requests if network else '-', network.errors if network else '-'))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Compression Codec Benchmark
+
+Compresses sample pgaudit logs with each available codec and level, and reports throughput and
+compression ratio.
+
+    python tools/bench_compression.py --size-mb 64
+    python tools/bench_compression.py --log-file error/postgresql.log.2018-05-16-22 --codec gzip --codec zstd
+"""
+import os
+import sys
+import time
+
+import click
+
+def get_parent_path(path):
+    return os.path.abspath(os.path.join(path, os.pardir))
+
+SCRIPT_DIR = get_parent_path(os.path.realpath(__file__))
+PROJECT_DIR = get_parent_path(SCRIPT_DIR)
+sys.path.append(os.path.join(PROJECT_DIR, 'audit'))
+
+from compression import CODECS
+from pgaudit_sample import generate_log
+
+LEVELS = {
+    'gzip': [1, 6, 9],
+    'bz2': [1, 9],
+    'xz': [0, 6],
+    'zstd': [1, 3, 9, 19],
+    'none': [None],
+}
+CHUNK_SIZE = 1024 * 1024
+
+def compress(data, codec, level, threads):
+    compressor = codec.compressor(level, threads=threads)
+    size = 0
+    for pos in range(0, len(data), CHUNK_SIZE):
+        size += len(compressor.compress(data[pos:pos + CHUNK_SIZE]))
+    size += len(compressor.flush())
+    return size
+
+@click.command()
+@click.option('--size-mb', type=int, default=32, help='Size of the generated sample log, in MB')
+@click.option('--log-file', type=click.Path(exists=True), help='Use a real log file instead of a generated one')
+@click.option('--codec', multiple=True, help='Only benchmark these codecs (default: all available)')
+@click.option('--threads', type=int, default=0, help='Threads for gzip and zstd (0 compresses in the calling thread)')
+def main(size_mb, log_file, codec, threads):
+    if log_file:
+        with open(log_file, 'rb') as f:
+            data = f.read()
+    else:
+        data = generate_log(size_mb * 1024 * 1024)
+    click.echo('Sample is %.1f MB' % (len(data) / 1024.0 / 1024))
+    click.echo('%-6s %5s %10s %8s' % ('codec', 'level', 'MB/s', 'ratio'))
+
+    for name in codec or sorted(CODECS):
+        if not CODECS[name].available:
+            click.echo('%-6s not installed, skipping' % name)
+            continue
+        for level in LEVELS[name]:
+            start = time.time()
+            compressed_size = compress(data, CODECS[name], level, threads)
+            elapsed = time.time() - start
+            click.echo('%-6s %5s %10.1f %8.2f' % (
+                name, level if level is not None else '-',
+                len(data) / 1024.0 / 1024 / elapsed, float(len(data)) / compressed_size))
+
+if __name__ == "__main__":
+    main()
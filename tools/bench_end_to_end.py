@@ -0,0 +1,302 @@
+"""
+End To End Benchmark
+
+Runs the audit lambda (audit/core.py) and glacier-upload's upload.py end to end without AWS:
+synthetic pgaudit logs (see pgaudit_sample.py) are served by rds_stub.py, and both upload to
+glacier-upload's glacier_stub.py. Either stub can add latency, limit bandwidth and inject errors.
+
+Each is run as a process of its own, and measured from outside: its throughput, its peak memory,
+and the 50th, 95th and 99th percentile latency of its log downloads (from the lambda's METRICS
+lines) and uploads (from the glacier stub). Any other audit settings, e.g. COMPRESSION_CODEC
+or DOWNLOAD_THREADS, are taken from the environment, as the lambda would.
+
+    python tools/bench_end_to_end.py --files 8 --file-size-mb 32 --latency-ms 50 --results bench.jsonl
+
+With --results, each run is appended to a json lines file, with the commit it was measured at, and
+compared with the last run there with the same options, so a regression shows up as a drop in
+throughput or a rise in latency or memory from one commit to the next.
+
+glacier_stub.py and upload.py are python 3: --python3 is an interpreter with glacier-upload's
+requirements installed.
+"""
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+
+import click
+
+def get_parent_path(path):
+    return os.path.abspath(os.path.join(path, os.pardir))
+
+SCRIPT_DIR = get_parent_path(os.path.realpath(__file__))
+PROJECT_DIR = get_parent_path(SCRIPT_DIR)
+sys.path.append(os.path.join(PROJECT_DIR, 'audit'))
+
+from pgaudit_sample import STATEMENT_MIX, generate_logs, parse_mix
+from rds_stub import RdsStub
+
+MB = 1024 * 1024
+GLACIER_UPLOAD_DIR = os.path.join(PROJECT_DIR, 'glacier-upload', 'src')
+DB_INSTANCE = 'bench'
+VAULT_NAME = 'bench'
+# the lambda's settings that would send it somewhere other than the stubs
+IGNORED_SETTINGS = ['DB_INSTANCE_IDENTIFIERS', 'DB_INSTANCE_TAG', 'ARCHIVE_S3_URI', 'CHECKPOINT_URI', 'FANOUT_SHARD_MB']
+STUB_CREDENTIALS = {
+    'AWS_ACCESS_KEY_ID': 'stub',
+    'AWS_SECRET_ACCESS_KEY': 'stub',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+}
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def get_python3_env(**variables):
+    """ the environment for python 3, without the python 2 PYTHONPATH the lambda may be run with """
+    env = dict(os.environ, **variables)
+    env.pop('PYTHONPATH', None)
+    return env
+
+def percentiles(values):
+    """ the 50th, 95th and 99th percentiles of values, or Nones if there are none """
+    values = sorted(values)
+    if not values:
+        return [None, None, None]
+    return [values[min(int(len(values) * p), len(values) - 1)] for p in (0.5, 0.95, 0.99)]
+
+
+class GlacierStubProcess(object):
+    """ glacier_stub.py, run by python3 on a port of its own """
+
+    def __init__(self, python3, latency, bandwidth, connection_bandwidth, max_concurrent, error_rate):
+        self.url = 'http://127.0.0.1:%s' % get_free_port()
+        args = [python3, 'glacier_stub.py', '--port', self.url.rsplit(':', 1)[1],
+                '--latency', str(latency), '--error-rate', str(error_rate)]
+        if bandwidth:
+            args += ['--bandwidth-mb', str(bandwidth)]
+        if connection_bandwidth:
+            args += ['--connection-bandwidth-mb', str(connection_bandwidth)]
+        if max_concurrent:
+            args += ['--max-concurrent', str(max_concurrent)]
+        self.process = subprocess.Popen(args, cwd=GLACIER_UPLOAD_DIR, env=get_python3_env(),
+                                        stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        for _ in range(100):
+            try:
+                self.stats()
+                return
+            except IOError:
+                if self.process.poll() is not None:
+                    break
+                time.sleep(0.1)
+        self.stop()
+        raise click.ClickException('glacier_stub.py did not start, is %s the right --python3?' % python3)
+
+    def stats(self):
+        return json.load(urllib2.urlopen(self.url + '/stats'))
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+
+def run_measured(args, env, cwd=None):
+    """ runs args to completion. returns its output, how long it took and its peak memory, in MB """
+    start = time.time()
+    process = subprocess.Popen(args, env=env, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.read()
+    # wait4 rather than wait, for the rusage of just this process
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.WEXITSTATUS(status)
+    seconds = time.time() - start
+    if status:
+        raise click.ClickException('%s failed:\n%s' % (' '.join(args), output[-4000:]))
+    return output, seconds, rusage.ru_maxrss / 1024.0
+
+def get_metrics(output):
+    """ the lambda's METRICS lines: those of each log file, and the run's """
+    log_files = []
+    run = None
+    for line in output.splitlines():
+        if not line.startswith('{"'):
+            continue
+        record = json.loads(line)
+        if 'LogFileName' in record:
+            log_files.append(record)
+        elif 'RunTime' in record:
+            run = record
+    return log_files, run
+
+def get_glacier_results(before, after):
+    """ the upload latencies and the errors (throttling included) of the glacier requests between two stats """
+    return {
+        'upload_ms': percentiles([1000 * seconds for seconds in after['upload_seconds'][len(before['upload_seconds']):]]),
+        'errors': after['errors'] + after['throttled'] - before['errors'] - before['throttled'],
+    }
+
+def bench_audit(glacier_stub, rds_stub, log_bytes):
+    env = dict(os.environ, **STUB_CREDENTIALS)
+    for name in IGNORED_SETTINGS:
+        env.pop(name, None)
+    env.update({
+        'DB_INSTANCE_IDENTIFIER': DB_INSTANCE,
+        'GLACIER_VAULT_NAME': VAULT_NAME,
+        'RDS_ENDPOINT_URL': rds_stub.url,
+        'GLACIER_ENDPOINT_URL': glacier_stub.url,
+        'METRICS': 'true',
+    })
+    before = glacier_stub.stats()
+    rds_errors = rds_stub.errors
+    output, seconds, peak_memory = run_measured([sys.executable, os.path.join(PROJECT_DIR, 'audit', 'core.py')], env)
+    after = glacier_stub.stats()
+    log_files, run = get_metrics(output)
+    if run is None or after['archives'] == before['archives']:
+        raise click.ClickException('the audit lambda did not upload an archive:\n%s' % output[-4000:])
+    result = get_glacier_results(before, after)
+    result.update({
+        'seconds': seconds,
+        'mb_per_second': log_bytes / MB / seconds,
+        'peak_memory_mb': peak_memory,
+        'log_files': len(set(record['LogFileName'] for record in log_files)),
+        'compression_ratio': run.get('CompressionRatio'),
+        'download_ms': percentiles([record['DownloadTime'] for record in log_files if 'DownloadTime' in record]),
+    })
+    result['errors'] += rds_stub.errors - rds_errors
+    return result
+
+def bench_upload_script(glacier_stub, python3, logs, part_size_mb, threads):
+    work_dir = tempfile.mkdtemp()
+    try:
+        file_name = os.path.join(work_dir, 'logs')
+        with open(file_name, 'wb') as log_file:
+            for name in sorted(logs):
+                log_file.write(logs[name])
+        size = os.path.getsize(file_name)
+        env = get_python3_env(GLACIER_ENDPOINT_URL=glacier_stub.url, GLACIER_UPLOAD_STATE_DIR=work_dir,
+                              **STUB_CREDENTIALS)
+        before = glacier_stub.stats()
+        output, seconds, peak_memory = run_measured(
+            [python3, 'upload.py', '-v', VAULT_NAME, '-f', file_name, '-p', str(part_size_mb), '-t', str(threads)],
+            env, cwd=GLACIER_UPLOAD_DIR)
+    finally:
+        shutil.rmtree(work_dir)
+    result = get_glacier_results(before, glacier_stub.stats())
+    result.update({
+        'seconds': seconds,
+        'mb_per_second': float(size) / MB / seconds,
+        'peak_memory_mb': peak_memory,
+    })
+    return result
+
+def get_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_DIR).strip()
+        if subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=PROJECT_DIR):
+            commit += '+changes'
+        return commit
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def find_previous(results_file, settings):
+    """ the last result in results_file with the same settings, if any """
+    previous = None
+    if results_file and os.path.exists(results_file):
+        with open(results_file) as results:
+            for line in results:
+                result = json.loads(line)
+                if result['settings'] == settings:
+                    previous = result
+    return previous
+
+def format_ms(value):
+    return '%9.1f' % value if value is not None else '%9s' % '-'
+
+def format_change(value, previous):
+    if not previous or value is None:
+        return ''
+    return ' (%+.0f%%)' % (100.0 * (value - previous) / previous)
+
+def report(name, result, previous):
+    previous = previous or {}
+    click.echo('%-8s %7.2f MB/s%s, peak memory %.0f MB%s, %s errors injected' % (
+        name, result['mb_per_second'], format_change(result['mb_per_second'], previous.get('mb_per_second')),
+        result['peak_memory_mb'], format_change(result['peak_memory_mb'], previous.get('peak_memory_mb')),
+        result['errors']))
+    for label, key in (('download', 'download_ms'), ('upload', 'upload_ms')):
+        if key in result:
+            p95 = result[key][1]
+            click.echo('%-8s %-10s p50 %s ms  p95 %s ms%s  p99 %s ms' % (
+                '', label, format_ms(result[key][0]), format_ms(p95),
+                format_change(p95, (previous.get(key) or [None, None])[1]), format_ms(result[key][2])))
+
+@click.command()
+@click.option('--files', type=int, default=8, help='Number of log files to archive (default: 8)')
+@click.option('--file-size-mb', type=float, default=16, help='Size of each log file, in MB (default: 16)')
+@click.option('--mix', help='Statement mix by audit class, e.g. READ=50,WRITE=40,DDL=10 (default: pgaudit_sample.py\'s)')
+@click.option('--seed', type=int, default=0, help='Seed of the generated logs (default: 0)')
+@click.option('--rds-latency-ms', type=int, default=20, help='Latency of every rds request, in ms (default: 20)')
+@click.option('--rds-mbps', type=float, default=0, help='MB/s of each log download, 0 for no limit')
+@click.option('--rds-error-rate', type=float, default=0, help='Share of log downloads that fail, e.g. 0.05')
+@click.option('--latency-ms', type=int, default=50, help='Latency of every glacier request, in ms (default: 50)')
+@click.option('--bandwidth-mbps', type=float, default=0, help='MB/s shared by all glacier uploads, 0 for no limit')
+@click.option('--connection-mbps', type=float, default=40,
+              help='MB/s of each glacier upload, 0 for no limit (default: 40)')
+@click.option('--max-concurrent', type=int, default=0, help='Glacier requests in flight beyond this are throttled')
+@click.option('--error-rate', type=float, default=0, help='Share of glacier requests that fail, e.g. 0.01')
+@click.option('--part-size-mb', type=int, default=8, help='upload.py\'s part size, in MB (default: 8)')
+@click.option('--threads', type=int, default=4, help='upload.py\'s threads (default: 4)')
+@click.option('--skip-upload-script', is_flag=True, help='Only benchmark the audit lambda')
+@click.option('--python3', default='python3', help='Python 3 to run glacier-upload with (default: python3)')
+@click.option('--results', type=click.Path(dir_okay=False), help='Append the results to this json lines file')
+def main(files, file_size_mb, mix, seed, rds_latency_ms, rds_mbps, rds_error_rate, latency_ms, bandwidth_mbps,
+         connection_mbps, max_concurrent, error_rate, part_size_mb, threads, skip_upload_script, python3, results):
+    settings = dict((key, value) for key, value in locals().items() if key not in ('python3', 'results'))
+    # the audit lambda's own settings change its results as much as the options do
+    settings['audit'] = dict((key, value) for key, value in os.environ.items()
+                             if key.endswith(('_MB', '_THREADS', '_CODEC', '_LEVEL')) or key.startswith('PGAUDIT_'))
+    try:
+        statement_mix = parse_mix(mix) if mix else STATEMENT_MIX
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--mix')
+
+    click.echo('Generating %s logs of %s MB...' % (files, file_size_mb))
+    # the newest log is the one rds is still writing, which isn't archived
+    logs = generate_logs(files + 1, int(file_size_mb * MB), seed, statement_mix)
+    newest = max(logs)
+    log_bytes = sum(len(contents) for name, contents in logs.items() if name != newest)
+
+    rds_stub = RdsStub(logs, latency=rds_latency_ms / 1000.0, bandwidth=rds_mbps * MB, error_rate=rds_error_rate)
+    rds_stub.start()
+    glacier_stub = GlacierStubProcess(python3, latency_ms / 1000.0, bandwidth_mbps, connection_mbps,
+                                      max_concurrent, error_rate)
+    result = {'commit': get_commit(), 'time': int(time.time()), 'settings': settings}
+    try:
+        result['audit'] = bench_audit(glacier_stub, rds_stub, log_bytes)
+        if not skip_upload_script:
+            del logs[newest]
+            result['upload'] = bench_upload_script(glacier_stub, python3, logs, part_size_mb, threads)
+    finally:
+        glacier_stub.stop()
+        rds_stub.stop()
+
+    previous = find_previous(results, settings) or {}
+    if previous:
+        click.echo('Compared with %s:' % (previous.get('commit') or 'the last run'))
+    report('audit', result['audit'], previous.get('audit'))
+    if 'upload' in result:
+        report('upload', result['upload'], previous.get('upload'))
+    if results:
+        with open(results, 'a') as results_file:
+            results_file.write(json.dumps(result, sort_keys=True) + '\n')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+HTTP Connection Pool Benchmark
+
+Downloads a set of log files from a local rds stub, once through the pooled http session and
+once with a new connection per file, and reports the per file latency of each.
+
+    python tools/bench_http_pool.py --files 50 --size-kb 256 --connect-latency-ms 30
+"""
+import os
+import sys
+import time
+
+import click
+import requests
+
+from botocore.credentials import Credentials
+
+def get_parent_path(path):
+    return os.path.abspath(os.path.join(path, os.pardir))
+
+SCRIPT_DIR = get_parent_path(os.path.realpath(__file__))
+PROJECT_DIR = get_parent_path(SCRIPT_DIR)
+sys.path.append(os.path.join(PROJECT_DIR, 'audit'))
+
+import rds_download_log
+from rds_stub import RdsStub
+
+def time_downloads(filenames, signer, session):
+    latencies = []
+    for filename in filenames:
+        start = time.time()
+        for chunk in rds_download_log.get_log_file_contents_via_rest(filename, signer=signer, session=session):
+            pass
+        latencies.append(time.time() - start)
+    return latencies
+
+def report(label, latencies):
+    latencies = sorted(latencies)
+    click.echo('%-12s mean %7.2f ms   p50 %7.2f ms   p95 %7.2f ms   total %7.2f s' % (
+        label,
+        1000 * sum(latencies) / len(latencies),
+        1000 * latencies[len(latencies) // 2],
+        1000 * latencies[int(len(latencies) * 0.95)],
+        sum(latencies),
+    ))
+
+@click.command()
+@click.option('--files', type=int, default=50, help='Number of log files to download')
+@click.option('--size-kb', type=int, default=256, help='Size of each log file, in KB')
+@click.option('--connect-latency-ms', type=int, default=30,
+              help='Simulated cost of a new connection (TCP + TLS handshake), in ms')
+def main(files, size_kb, connect_latency_ms):
+    contents = ('x' * 1023 + '\n') * size_kb
+    logs = dict(('error/postgresql.log.%s' % i, contents) for i in range(files))
+    stub = RdsStub(logs, connect_latency=connect_latency_ms / 1000.0)
+    stub.start()
+
+    rds_download_log.DB_INSTANCE_IDENTIFIER = 'bench'
+    signer = rds_download_log.Signer(
+        region='us-west-2', credentials=Credentials('access', 'secret'), endpoint_url=stub.url)
+    filenames = sorted(logs)
+
+    try:
+        connections = stub.connections
+        report('unpooled', time_downloads(filenames, signer, requests))
+        click.echo('%-12s %s connections' % ('', stub.connections - connections))
+
+        connections = stub.connections
+        report('pooled', time_downloads(filenames, signer, rds_download_log.make_http_session()))
+        click.echo('%-12s %s connections' % ('', stub.connections - connections))
+    finally:
+        stub.stop()
+
+if __name__ == "__main__":
+    main()
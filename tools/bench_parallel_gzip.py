@@ -0,0 +1,63 @@
+"""
+Parallel Gzip Benchmark
+
+Compresses a sample pgaudit log with gzip at an increasing number of threads, and reports the
+throughput and speedup of each, along with the cost in compression ratio of cutting the stream
+into independent gzip members. Also checks that the output decompresses back to the input.
+
+    python tools/bench_parallel_gzip.py --size-mb 64 --max-threads 8
+"""
+import gzip
+import io
+import multiprocessing
+import os
+import sys
+import time
+
+import click
+
+def get_parent_path(path):
+    return os.path.abspath(os.path.join(path, os.pardir))
+
+SCRIPT_DIR = get_parent_path(os.path.realpath(__file__))
+PROJECT_DIR = get_parent_path(SCRIPT_DIR)
+sys.path.append(os.path.join(PROJECT_DIR, 'audit'))
+
+from compression import get_codec
+from pgaudit_sample import generate_log
+
+CHUNK_SIZE = 1024 * 1024
+
+def compress(data, level, threads):
+    compressor = get_codec('gzip').compressor(level, threads=threads)
+    output = []
+    for pos in range(0, len(data), CHUNK_SIZE):
+        output.append(compressor.compress(data[pos:pos + CHUNK_SIZE]))
+    output.append(compressor.flush())
+    return b''.join(output)
+
+@click.command()
+@click.option('--size-mb', type=int, default=32, help='Size of the generated sample log, in MB')
+@click.option('--level', type=int, default=6, help='gzip compression level')
+@click.option('--max-threads', type=int, default=multiprocessing.cpu_count(),
+              help='Largest thread count to try (default: the number of cores)')
+def main(size_mb, level, max_threads):
+    data = generate_log(size_mb * 1024 * 1024)
+    click.echo('Sample is %.1f MB, %s cores' % (len(data) / 1024.0 / 1024, multiprocessing.cpu_count()))
+    click.echo('%7s %10s %8s %8s' % ('threads', 'MB/s', 'speedup', 'ratio'))
+
+    baseline = None
+    threads = 1
+    while threads <= max_threads:
+        start = time.time()
+        compressed = compress(data, level, threads)
+        elapsed = time.time() - start
+        if gzip.GzipFile(fileobj=io.BytesIO(compressed)).read() != data:
+            raise Exception('output with %s threads does not decompress to the input' % threads)
+        throughput = len(data) / 1024.0 / 1024 / elapsed
+        baseline = baseline or throughput
+        click.echo('%7s %10.1f %7.2fx %8.2f' % (threads, throughput, throughput / baseline, float(len(data)) / len(compressed)))
+        threads *= 2
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+PG Audit Columns Benchmark
+
+Converts sample pgaudit logs into a columns file (see audit/pgaudit_columns.py), and reports rows and
+MB per second, and how big the file is against the log gzipped. Then reads it back, every column of
+every row, and just the rows of one user, and reports rows per second of each.
+
+    python tools/bench_pgaudit_columns.py --size-mb 256
+    python tools/bench_pgaudit_columns.py --log-file error/postgresql.log.2018-05-16-22 --row-group-rows 65536
+"""
+import io
+import os
+import sys
+import time
+import zlib
+
+import click
+
+def get_parent_path(path):
+    return os.path.abspath(os.path.join(path, os.pardir))
+
+SCRIPT_DIR = get_parent_path(os.path.realpath(__file__))
+PROJECT_DIR = get_parent_path(SCRIPT_DIR)
+sys.path.append(os.path.join(PROJECT_DIR, 'audit'))
+
+from pgaudit_columns import ROW_GROUP_ROWS, ROW_GROUP_SIZE, ColumnFile, PgAuditColumnWriter, may_contain
+from pgaudit_filter import parse_list
+from pgaudit_sample import generate_log
+
+CHUNK_SIZE = 1024 * 1024
+
+def iter_chunks(data):
+    for pos in range(0, len(data), CHUNK_SIZE):
+        yield data[pos:pos + CHUNK_SIZE]
+
+def gzip_size(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    size = sum(len(compressor.compress(chunk)) for chunk in chunks)
+    return size + len(compressor.flush())
+
+@click.command()
+@click.option('--size-mb', type=int, default=64, help='Size of the generated sample log, in MB')
+@click.option('--log-file', type=click.Path(exists=True), help='Use a real log file instead of a generated one')
+@click.option('--drop-classes', default='', help='Classes to drop, comma separated (default: none)')
+@click.option('--drop-roles', default='', help='Users to drop, comma separated (default: none)')
+@click.option('--row-group-rows', type=int, default=ROW_GROUP_ROWS,
+              help='The most rows in a row group (default: %s)' % ROW_GROUP_ROWS)
+@click.option('--user', default='admin', help='The user to query the rows of (default: admin)')
+def main(size_mb, log_file, drop_classes, drop_roles, row_group_rows, user):
+    if log_file:
+        with open(log_file, 'rb') as f:
+            data = f.read()
+    else:
+        data = generate_log(size_mb * 1024 * 1024)
+    gzipped = gzip_size(iter_chunks(data))
+    click.echo('Sample is %.1f MB, %s lines, %.1f MB gzipped' % (
+        len(data) / 1024.0 / 1024, data.count(b'\n'), gzipped / 1024.0 / 1024))
+
+    output = io.BytesIO()
+    writer = PgAuditColumnWriter(output, parse_list(drop_classes), parse_list(drop_roles), row_group_rows,
+                                 ROW_GROUP_SIZE)
+    start = time.time()
+    writer.add(log_file or 'sample', iter_chunks(data))
+    writer.close()
+    elapsed = time.time() - start
+    size = len(output.getvalue())
+    click.echo('%-12s %10s %12s %8s %10s %10s' % ('', 'rows', 'rows/s', 'MB/s', 'size MB', 'vs gzip'))
+    click.echo('%-12s %10s %12.0f %8.1f %10.2f %9.1f%%' % (
+        'write', writer.rows, writer.rows / elapsed, len(data) / 1024.0 / 1024 / elapsed, size / 1024.0 / 1024,
+        100.0 * size / gzipped))
+
+    column_file = ColumnFile(output)
+    start = time.time()
+    rows = sum(1 for _ in column_file.iter_rows())
+    elapsed = time.time() - start
+    click.echo('%-12s %10s %12.0f' % ('read all', rows, rows / elapsed))
+
+    start = time.time()
+    row_groups = [row_group for row_group in column_file.row_groups if may_contain(row_group, 'user', user, user)]
+    rows = 0
+    for row_group in row_groups:
+        rows += column_file.read_column(row_group, 'user').count(user.encode('utf-8'))
+    elapsed = time.time() - start
+    click.echo('%-12s %10s %12.0f   (%s of %s row groups)' % (
+        'user=' + user, rows, column_file.footer['rows'] / elapsed, len(row_groups), len(column_file.row_groups)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+PG Audit Filter Benchmark
+
+Filters sample pgaudit logs with a few filter settings, and reports lines and MB per second, how
+much of the log is kept, and how big it is once gzipped, against the log as it is.
+
+    python tools/bench_pgaudit_filter.py --size-mb 256
+    python tools/bench_pgaudit_filter.py --log-file error/postgresql.log.2018-05-16-22 --drop-roles rdsadmin
+"""
+import os
+import sys
+import time
+import zlib
+
+import click
+
+def get_parent_path(path):
+    return os.path.abspath(os.path.join(path, os.pardir))
+
+SCRIPT_DIR = get_parent_path(os.path.realpath(__file__))
+PROJECT_DIR = get_parent_path(SCRIPT_DIR)
+sys.path.append(os.path.join(PROJECT_DIR, 'audit'))
+
+from pgaudit_filter import PgAuditFilter, parse_list
+from pgaudit_sample import generate_log
+
+CHUNK_SIZE = 1024 * 1024
+
+def iter_chunks(data):
+    for pos in range(0, len(data), CHUNK_SIZE):
+        yield data[pos:pos + CHUNK_SIZE]
+
+def gzip_size(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    size = sum(len(compressor.compress(chunk)) for chunk in chunks)
+    return size + len(compressor.flush())
+
+@click.command()
+@click.option('--size-mb', type=int, default=64, help='Size of the generated sample log, in MB')
+@click.option('--log-file', type=click.Path(exists=True), help='Use a real log file instead of a generated one')
+@click.option('--drop-classes', default='MISC', help='Classes to drop (default: MISC)')
+@click.option('--drop-roles', default='healthcheck,pgbouncer', help='Users to drop (default: healthcheck,pgbouncer)')
+def main(size_mb, log_file, drop_classes, drop_roles):
+    if log_file:
+        with open(log_file, 'rb') as f:
+            data = f.read()
+    else:
+        data = generate_log(size_mb * 1024 * 1024)
+    click.echo('Sample is %.1f MB, %s lines, %.1f MB gzipped' % (
+        len(data) / 1024.0 / 1024, data.count(b'\n'), gzip_size(iter_chunks(data)) / 1024.0 / 1024))
+    click.echo('%-24s %12s %8s %8s %10s' % ('filter', 'lines/s', 'MB/s', 'kept', 'gzipped MB'))
+
+    drop_classes, drop_roles = parse_list(drop_classes), parse_list(drop_roles)
+    settings = [
+        ('parse only', PgAuditFilter()),
+        ('drop', PgAuditFilter(drop_classes, drop_roles)),
+        ('dictionary', PgAuditFilter(dictionary=True)),
+        ('drop + dictionary', PgAuditFilter(drop_classes, drop_roles, dictionary=True)),
+    ]
+    for name, log_filter in settings:
+        start = time.time()
+        output = list(log_filter.filter(iter_chunks(data)))
+        elapsed = time.time() - start
+        click.echo('%-24s %12.0f %8.1f %7.1f%% %10.1f' % (
+            name, log_filter.lines_in / elapsed, len(data) / 1024.0 / 1024 / elapsed,
+            100.0 * log_filter.bytes_out / len(data), gzip_size(output) / 1024.0 / 1024))
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,8 @@ set -e
 SCRIPT_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
 PROJECT_DIR=$(dirname "$SCRIPT_DIR")
 
-STACK_NAME='pg-audit-'$DB_INSTANCE_IDENTIFIER
+# set STACK_NAME when archiving several instances (DB_INSTANCE_IDENTIFIERS or DB_INSTANCE_TAG)
+STACK_NAME=${STACK_NAME:-'pg-audit-'$DB_INSTANCE_IDENTIFIER}
 
 # zip local artifacts that are referenced by template file in (CodeUri: dist)
 # uploads them to the s3 bucket
@@ -17,24 +17,95 @@ def get_parent_path(path):
 
 SCRIPT_DIR = get_parent_path(os.path.realpath(__file__))
 PROJECT_DIR = get_parent_path(SCRIPT_DIR)
+sys.path.append(os.path.join(PROJECT_DIR, 'audit'))
+
+from checkpoint import MARKERS_SUFFIX, get_instance_checkpoint_uri
 
 DB_INSTANCE_IDENTIFIER = os.getenv('DB_INSTANCE_IDENTIFIER')
+DB_INSTANCE_IDENTIFIERS = os.getenv('DB_INSTANCE_IDENTIFIERS')
+DB_INSTANCE_TAG = os.getenv('DB_INSTANCE_TAG')
+MULTI_INSTANCE = bool(DB_INSTANCE_IDENTIFIERS or DB_INSTANCE_TAG)
+STACK_NAME = os.getenv('STACK_NAME') or 'pg-audit-%s' % DB_INSTANCE_IDENTIFIER
 GLACIER_VAULT_NAME = os.getenv('GLACIER_VAULT_NAME')
+ARCHIVE_S3_URI = os.getenv('ARCHIVE_S3_URI')
+ARCHIVE_STORAGE_CLASS = os.getenv('ARCHIVE_STORAGE_CLASS')
+CHECKPOINT_URI = os.getenv('CHECKPOINT_URI')
+SCHEDULE = os.getenv('SCHEDULE')
+FANOUT_SHARD_MB = os.getenv('FANOUT_SHARD_MB')
+METRICS = os.getenv('METRICS')
+# runtime settings, passed through to the lambda's environment as they are (see the README)
+ARCHIVE_ACTIVE_LOG = os.getenv('ARCHIVE_ACTIVE_LOG')
+COMPRESSION_CODEC = os.getenv('COMPRESSION_CODEC')
+COMPRESSION_LEVEL = os.getenv('COMPRESSION_LEVEL')
+COMPRESSION_THREADS = os.getenv('COMPRESSION_THREADS')
+ARCHIVE_INDEX = os.getenv('ARCHIVE_INDEX')
+PGAUDIT_DROP_CLASSES = os.getenv('PGAUDIT_DROP_CLASSES')
+PGAUDIT_DROP_ROLES = os.getenv('PGAUDIT_DROP_ROLES')
+PGAUDIT_DICTIONARY = os.getenv('PGAUDIT_DICTIONARY')
+PGAUDIT_COLUMNS = os.getenv('PGAUDIT_COLUMNS')
+PGAUDIT_FILTER_PART_MB = os.getenv('PGAUDIT_FILTER_PART_MB')
+BUFFER_SIZE_MB = os.getenv('BUFFER_SIZE_MB')
+PART_SIZE_MB = os.getenv('PART_SIZE_MB')
+UPLOAD_THREADS = os.getenv('UPLOAD_THREADS')
+DOWNLOAD_THREADS = os.getenv('DOWNLOAD_THREADS')
+DOWNLOAD_BUDGET_MB = os.getenv('DOWNLOAD_BUDGET_MB')
+MAX_DOWNLOAD_MBPS = os.getenv('MAX_DOWNLOAD_MBPS')
+HTTP_POOL_SIZE = os.getenv('HTTP_POOL_SIZE')
+HTTP_CONNECT_TIMEOUT = os.getenv('HTTP_CONNECT_TIMEOUT')
+HTTP_READ_TIMEOUT = os.getenv('HTTP_READ_TIMEOUT')
+HTTP_RETRIES = os.getenv('HTTP_RETRIES')
+INSTANCE_THREADS = os.getenv('INSTANCE_THREADS')
+RDS_API_RATE = os.getenv('RDS_API_RATE')
+RDS_API_RETRIES = os.getenv('RDS_API_RETRIES')
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE')
 
-def get_rds_instance_arn():
+def get_rds_instance_arn(db_instance_identifier=DB_INSTANCE_IDENTIFIER):
     rds_client = boto3.client('rds')
-    resp = rds_client.describe_db_instances(DBInstanceIdentifier=DB_INSTANCE_IDENTIFIER)
+    resp = rds_client.describe_db_instances(DBInstanceIdentifier=db_instance_identifier)
 
     instance = resp['DBInstances'][0]
     return instance['DBInstanceArn']
 
+def get_rds_instance_arns():
+    ''' returns the arns of the instances the lambda archives, or None if it may archive any of them (DB_INSTANCE_TAG) '''
+    if DB_INSTANCE_TAG:
+        return None
+    if DB_INSTANCE_IDENTIFIERS:
+        return [get_rds_instance_arn(identifier.strip()) for identifier in DB_INSTANCE_IDENTIFIERS.split(',') if identifier.strip()]
+    return [get_rds_instance_arn()]
+
 def get_glacier_vault_arn():
+    if ARCHIVE_S3_URI:
+        return None
     glacier_client = boto3.client('glacier')
     resp = glacier_client.list_vaults()
 
     vault = next( vault for vault in resp['VaultList'] if vault['VaultName'] == GLACIER_VAULT_NAME)
     return vault['VaultARN']
 
+def get_archive_objects_arn():
+    ''' returns the arn of the s3 objects archives are uploaded to, if they are uploaded to s3 '''
+    if not ARCHIVE_S3_URI:
+        return None
+    bucket, _, prefix = ARCHIVE_S3_URI[len('s3://'):].partition('/')
+    if not prefix.strip('/'):
+        return 'arn:aws:s3:::%s/*' % bucket
+    return 'arn:aws:s3:::%s/%s/*' % (bucket, prefix.strip('/'))
+
+def get_checkpoint_arns():
+    ''' returns the arns of the s3 checkpoint object and its bucket, if checkpoints are kept in s3 '''
+    if not CHECKPOINT_URI or not CHECKPOINT_URI.startswith('s3://'):
+        return None, None
+    checkpoint_uri = get_instance_checkpoint_uri(CHECKPOINT_URI, '*') if MULTI_INSTANCE else CHECKPOINT_URI
+    bucket, _, key = checkpoint_uri[len('s3://'):].partition('/')
+    return 'arn:aws:s3:::%s/%s' % (bucket, key), 'arn:aws:s3:::%s' % bucket
+
+def get_checkpoint_markers_arn(checkpoint_object_arn):
+    ''' the arn of the markers fan-out workers leave next to the checkpoint, see audit/checkpoint.py '''
+    if checkpoint_object_arn is None:
+        return None
+    return checkpoint_object_arn + MARKERS_SUFFIX + '/*'
+
 def get_template():
     env = Environment(
         loader=FileSystemLoader(PROJECT_DIR)
@@ -42,15 +113,55 @@ def get_template():
     return env.get_template('template.template.yml')
 
 def main():
+    if MULTI_INSTANCE and not os.getenv('STACK_NAME'):
+        sys.exit('Set STACK_NAME to name the stack that archives DB_INSTANCE_IDENTIFIERS or DB_INSTANCE_TAG')
     template = get_template()
 
     template_filename = os.path.join(PROJECT_DIR, 'dist', 'template.yml')
+    checkpoint_object_arn, checkpoint_bucket_arn = get_checkpoint_arns()
 
     rendered = template.stream(
+        STACK_NAME=STACK_NAME,
         DB_INSTANCE_IDENTIFIER=DB_INSTANCE_IDENTIFIER,
-        DBInstanceArn=get_rds_instance_arn(),
+        DB_INSTANCE_IDENTIFIERS=DB_INSTANCE_IDENTIFIERS,
+        DB_INSTANCE_TAG=DB_INSTANCE_TAG,
+        DBInstanceArns=get_rds_instance_arns(),
         GLACIER_VAULT_NAME=GLACIER_VAULT_NAME,
-        VaultInstanceArn=get_glacier_vault_arn()
+        VaultInstanceArn=get_glacier_vault_arn(),
+        ARCHIVE_S3_URI=ARCHIVE_S3_URI,
+        ARCHIVE_STORAGE_CLASS=ARCHIVE_STORAGE_CLASS,
+        ArchiveObjectsArn=get_archive_objects_arn(),
+        CHECKPOINT_URI=CHECKPOINT_URI,
+        CheckpointObjectArn=checkpoint_object_arn,
+        CheckpointBucketArn=checkpoint_bucket_arn,
+        CheckpointMarkersArn=get_checkpoint_markers_arn(checkpoint_object_arn),
+        SCHEDULE=SCHEDULE,
+        FANOUT_SHARD_MB=FANOUT_SHARD_MB,
+        METRICS=METRICS,
+        ARCHIVE_ACTIVE_LOG=ARCHIVE_ACTIVE_LOG,
+        COMPRESSION_CODEC=COMPRESSION_CODEC,
+        COMPRESSION_LEVEL=COMPRESSION_LEVEL,
+        COMPRESSION_THREADS=COMPRESSION_THREADS,
+        ARCHIVE_INDEX=ARCHIVE_INDEX,
+        PGAUDIT_DROP_CLASSES=PGAUDIT_DROP_CLASSES,
+        PGAUDIT_DROP_ROLES=PGAUDIT_DROP_ROLES,
+        PGAUDIT_DICTIONARY=PGAUDIT_DICTIONARY,
+        PGAUDIT_COLUMNS=PGAUDIT_COLUMNS,
+        PGAUDIT_FILTER_PART_MB=PGAUDIT_FILTER_PART_MB,
+        BUFFER_SIZE_MB=BUFFER_SIZE_MB,
+        PART_SIZE_MB=PART_SIZE_MB,
+        UPLOAD_THREADS=UPLOAD_THREADS,
+        DOWNLOAD_THREADS=DOWNLOAD_THREADS,
+        DOWNLOAD_BUDGET_MB=DOWNLOAD_BUDGET_MB,
+        MAX_DOWNLOAD_MBPS=MAX_DOWNLOAD_MBPS,
+        HTTP_POOL_SIZE=HTTP_POOL_SIZE,
+        HTTP_CONNECT_TIMEOUT=HTTP_CONNECT_TIMEOUT,
+        HTTP_READ_TIMEOUT=HTTP_READ_TIMEOUT,
+        HTTP_RETRIES=HTTP_RETRIES,
+        INSTANCE_THREADS=INSTANCE_THREADS,
+        RDS_API_RATE=RDS_API_RATE,
+        RDS_API_RETRIES=RDS_API_RETRIES,
+        METRICS_NAMESPACE=METRICS_NAMESPACE,
     ).dump(template_filename)
 
 if __name__ == "__main__":
@@ -0,0 +1,103 @@
+"""
+Sample PG Audit Logs
+
+Generates synthetic RDS postgres logs with pgaudit session logging turned on, for benchmarks.
+
+Lines use the default RDS log_line_prefix ('%t:%r:%u@%d:[%p]:'), and a statement mix like the
+one `pgaudit.log = 'all'` produces: lots of identical statements from connection poolers and
+health checks, some application reads and writes, and the odd DDL or role statement.
+"""
+import random
+import time
+
+# (weight, user, database, class, command, object type, object name, statement)
+STATEMENT_MIX = [
+    (30, 'healthcheck', 'postgres', 'READ', 'SELECT', '', '', 'SELECT 1'),
+    (10, 'pgbouncer', 'postgres', 'MISC', 'DISCARD ALL', '', '', 'DISCARD ALL'),
+    (25, 'app', 'appdb', 'READ', 'SELECT', 'TABLE', 'public.users',
+     'SELECT id, email, created_at FROM public.users WHERE id = $1'),
+    (10, 'app', 'appdb', 'READ', 'SELECT', 'TABLE', 'public.orders',
+     'SELECT * FROM public.orders WHERE user_id = $1 ORDER BY created_at DESC LIMIT 50'),
+    (10, 'app', 'appdb', 'WRITE', 'INSERT', 'TABLE', 'public.orders',
+     'INSERT INTO public.orders (user_id, total, status) VALUES ($1, $2, $3)'),
+    (8, 'app', 'appdb', 'WRITE', 'UPDATE', 'TABLE', 'public.orders',
+     'UPDATE public.orders SET status = $1 WHERE id = $2'),
+    (4, 'etl', 'appdb', 'READ', 'SELECT', 'TABLE', 'public.events',
+     'SELECT * FROM public.events WHERE created_at > $1'),
+    (2, 'admin', 'appdb', 'DDL', 'CREATE INDEX', 'INDEX', 'public.orders_status_idx',
+     'CREATE INDEX CONCURRENTLY orders_status_idx ON public.orders (status)'),
+    (1, 'admin', 'appdb', 'ROLE', 'GRANT', '', '', 'GRANT SELECT ON public.orders TO reporting'),
+]
+
+AUDIT_CLASSES = ['READ', 'WRITE', 'FUNCTION', 'ROLE', 'DDL', 'MISC']
+
+PARAMETERS = ['42', "'pending'", "'2018-05-16 00:00:00'", '19.99', "'shipped'", '1337']
+
+
+def generate_lines(start_time=None, seed=0, mix=STATEMENT_MIX):
+    """ yields log lines, forever. """
+    rng = random.Random(seed)
+    timestamp = start_time or 1526428800
+    weights = [entry[0] for entry in mix]
+    total_weight = float(sum(weights))
+    statement_id = 0
+    while True:
+        pick = rng.random() * total_weight
+        for entry in mix:
+            pick -= entry[0]
+            if pick <= 0:
+                break
+        weight, user, database, audit_class, command, object_type, object_name, statement = entry
+        statement_id += 1
+        timestamp += rng.random() * 0.05
+        parameters = ','.join(rng.choice(PARAMETERS) for _ in range(statement.count('$'))) or '<none>'
+        yield '%s UTC:10.0.%d.%d(%d):%s@%s:[%d]:LOG:  AUDIT: SESSION,%d,1,%s,%s,%s,%s,"%s",%s\n' % (
+            time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp)),
+            rng.randint(0, 3), rng.randint(2, 250), rng.randint(30000, 60000),
+            user, database, rng.randint(1000, 30000),
+            statement_id, audit_class, command, object_type, object_name, statement, parameters,
+        )
+
+
+def generate_log(size, seed=0, mix=STATEMENT_MIX, start_time=None):
+    """ returns about size bytes of log lines. """
+    lines = []
+    total = 0
+    for line in generate_lines(start_time=start_time, seed=seed, mix=mix):
+        if total >= size:
+            break
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines)
+
+
+def parse_mix(spec, mix=STATEMENT_MIX):
+    """ mix, with the share of each audit class given in spec, e.g. 'READ=50,WRITE=40,DDL=10', spread
+    over its statements as before. classes spec leaves out keep their weights. """
+    shares = {}
+    for item in spec.split(','):
+        audit_class, _, share = item.partition('=')
+        audit_class = audit_class.strip().upper()
+        if audit_class not in AUDIT_CLASSES or not share.strip():
+            raise ValueError('a statement mix looks like READ=50,WRITE=40,DDL=10, got: %s' % spec)
+        shares[audit_class] = float(share)
+    class_weights = {}
+    for entry in mix:
+        class_weights[entry[3]] = class_weights.get(entry[3], 0) + entry[0]
+    missing = [audit_class for audit_class in shares if audit_class not in class_weights]
+    if missing:
+        raise ValueError('there are no sample %s statements' % ', '.join(sorted(missing)))
+    return [
+        (shares[entry[3]] * entry[0] / class_weights[entry[3]] if entry[3] in shares else entry[0],) + entry[1:]
+        for entry in mix
+    ]
+
+
+def generate_logs(files, size, seed=0, mix=STATEMENT_MIX):
+    """ returns files logs of about size bytes each, by RDS log file name, an hour apart. """
+    logs = {}
+    for i in range(files):
+        start_time = 1526428800 + 3600 * i
+        name = 'error/postgresql.log.%s' % time.strftime('%Y-%m-%d-%H', time.gmtime(start_time))
+        logs[name] = generate_log(size, seed=seed + i, mix=mix, start_time=start_time)
+    return logs
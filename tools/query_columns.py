@@ -0,0 +1,115 @@
+"""
+PG Audit Columns Query
+
+Answers an audit question from a columns archive (see audit/pgaudit_columns.py and PGAUDIT_COLUMNS)
+without restoring the logs. Retrieve and download `<archive name>.columns` like any other archive,
+then:
+
+    python tools/query_columns.py --file-name db1-2018-05-16__23-00-00__UTC.columns --user alice \\
+        --class DDL --class ROLE --start 2018-05-16T21:00:00 --end 2018-05-16T23:00:00 > changes.csv
+
+The matching rows are written to stdout as csv. A row matches when it has one of the values given
+for each column filtered on, was logged between --start and --end, and has --statement in its
+statement. Row groups whose min and max values show they can't match are skipped, and of the others
+only the columns filtered on are read, until a row matches.
+"""
+import csv
+import os
+import sys
+
+import arrow
+import click
+
+def get_parent_path(path):
+    return os.path.abspath(os.path.join(path, os.pardir))
+
+SCRIPT_DIR = get_parent_path(os.path.realpath(__file__))
+PROJECT_DIR = get_parent_path(SCRIPT_DIR)
+sys.path.append(os.path.join(PROJECT_DIR, 'audit'))
+
+from pgaudit_columns import COLUMNS, ColumnFile, may_contain
+
+def parse_time(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return arrow.get(value).timestamp
+    except arrow.parser.ParserError:
+        raise click.BadParameter('expected a time like 2018-05-16T22:00:00')
+
+def parse_columns(ctx, param, value):
+    columns = [column.strip() for column in value.split(',') if column.strip()]
+    unknown = [column for column in columns if column not in COLUMNS]
+    if unknown:
+        raise click.BadParameter('unknown columns %s, expected some of: %s' % (', '.join(unknown), ', '.join(COLUMNS)))
+    return columns
+
+def select_row_groups(column_file, filters, start=None, end=None):
+    """ the row groups that can have matching rows, going by their stats """
+    return [
+        row_group for row_group in column_file.row_groups
+        if may_contain(row_group, 'timestamp', start, end)
+        and all(any(may_contain(row_group, name, value, value) for value in values) for name, values in filters)
+    ]
+
+def iter_matches(column_file, row_groups, filters, start=None, end=None, statement=None, columns=COLUMNS):
+    """ yields the columns of each matching row of row_groups.
+    filters is a list of (column, values): a row matches if it has one of the values in each. """
+    for row_group in row_groups:
+        rows = range(row_group['rows'])
+        if start is not None or end is not None:
+            timestamps = column_file.read_column(row_group, 'timestamp')
+            rows = [i for i in rows if (start is None or timestamps[i] >= start) and (end is None or timestamps[i] < end)]
+        for name, values in filters:
+            if not rows:
+                break
+            column = column_file.read_column(row_group, name)
+            values = set(value.encode('utf-8') for value in values)
+            rows = [i for i in rows if column[i] in values]
+        if statement and rows:
+            column = column_file.read_column(row_group, 'statement')
+            rows = [i for i in rows if statement in column[i]]
+        if not rows:
+            continue
+        values = [column_file.read_column(row_group, name) for name in columns]
+        for i in rows:
+            yield [column[i] for column in values]
+
+def format_row(columns, row):
+    return [arrow.get(value).format('YYYY-MM-DD HH:mm:ss') if name == 'timestamp' else value
+            for name, value in zip(columns, row)]
+
+@click.command()
+@click.option('-f', '--file-name', type=click.File('rb'), required=True,
+              help='A downloaded columns archive, <archive name>.columns')
+@click.option('-s', '--start', callback=parse_time, help='Rows logged at or after this time (UTC)')
+@click.option('-e', '--end', callback=parse_time, help='Rows logged before this time (UTC)')
+@click.option('-u', '--user', multiple=True, help='Rows by this user. Can be repeated')
+@click.option('-d', '--database', multiple=True, help='Rows in this database. Can be repeated')
+@click.option('-c', '--class', 'audit_class', multiple=True, help='Rows of this class, e.g. DDL. Can be repeated')
+@click.option('--command', multiple=True, help='Rows of this command, e.g. "CREATE TABLE". Can be repeated')
+@click.option('-o', '--object', 'audit_object', multiple=True,
+              help='Rows on this object, e.g. public.orders. Can be repeated')
+@click.option('--statement', help='Rows whose statement has this in it')
+@click.option('--columns', callback=parse_columns, default=','.join(COLUMNS),
+              help='The columns to output, comma separated (default: all of them)')
+def main(file_name, start, end, user, database, audit_class, command, audit_object, statement, columns):
+    filters = [(name, values) for name, values in [
+        ('user', user), ('database', database), ('class', audit_class), ('command', command),
+        ('object', audit_object),
+    ] if values]
+    column_file = ColumnFile(file_name)
+    row_groups = select_row_groups(column_file, filters, start, end)
+    statement = statement.encode('utf-8') if statement else None
+
+    writer = csv.writer(click.get_binary_stream('stdout'))
+    writer.writerow(columns)
+    count = 0
+    for row in iter_matches(column_file, row_groups, filters, start, end, statement, columns):
+        writer.writerow(format_row(columns, row))
+        count += 1
+    click.echo('%s of %s rows match, from %s of %s row groups' % (
+        count, column_file.footer['rows'], len(row_groups), len(column_file.row_groups)), err=True)
+
+if __name__ == "__main__":
+    main()
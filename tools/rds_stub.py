@@ -0,0 +1,140 @@
+"""
+Local RDS REST Stub
+
+A stand-in for the rds downloadCompleteLogFile REST endpoint, for benchmarking the audit lambda
+without AWS. Signatures are not checked.
+
+    stub = RdsStub({'error/postgresql.log.2018-05-16-22': contents})
+    stub.start()
+    # point downloads at stub.url, e.g. RDS_ENDPOINT_URL=stub.url
+    stub.stop()
+
+It also answers the two rds api calls the lambda makes, DescribeDBInstances and DescribeDBLogFiles,
+so with RDS_ENDPOINT_URL set a whole run can go against it. The logs are listed as last written a
+minute apart, the last one (in name order) when the stub was made.
+
+connect_latency is slept once per new connection, to stand in for the TCP and TLS handshakes
+that a real https endpoint costs. latency is slept once per request, and downloads are sent at most
+bandwidth bytes a second each (0 for no limit). error_rate of the downloads fail with a 500.
+"""
+import BaseHTTPServer
+import SocketServer
+import random
+import threading
+import time
+import urlparse
+from xml.sax.saxutils import escape
+
+CHUNK_SIZE = 64 * 1024
+ACCOUNT_ID = '000000000000'
+REGION = 'us-east-1'
+
+
+class RdsStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.stub.connections += 1
+        time.sleep(self.server.stub.connect_latency)
+
+    def do_GET(self):
+        stub = self.server.stub
+        prefix = '/v13/downloadCompleteLogFile/'
+        path = self.path.split('?', 1)[0]
+        # path is /v13/downloadCompleteLogFile/<instance identifier>/<log file name>
+        filename = path[len(prefix):].split('/', 1)[-1] if path.startswith(prefix) else None
+        contents = stub.logs.get(filename)
+        stub.requests += 1
+        time.sleep(stub.latency)
+
+        if contents is None:
+            return self.send_empty(404)
+        if stub.error_rate and random.random() < stub.error_rate:
+            stub.errors += 1
+            return self.send_empty(500)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(contents)))
+        self.end_headers()
+        for pos in range(0, len(contents), CHUNK_SIZE):
+            chunk = contents[pos:pos + CHUNK_SIZE]
+            if stub.bandwidth:
+                time.sleep(float(len(chunk)) / stub.bandwidth)
+            self.wfile.write(chunk)
+
+    def do_POST(self):
+        # the rds api: an Action, and its parameters, form encoded
+        stub = self.server.stub
+        body = self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+        params = dict(urlparse.parse_qsl(body))
+        stub.requests += 1
+        time.sleep(stub.latency)
+
+        db_instance = params.get('DBInstanceIdentifier', '')
+        if params.get('Action') == 'DescribeDBInstances':
+            result = ('<DBInstances><DBInstance><DBInstanceIdentifier>%s</DBInstanceIdentifier>'
+                      '<DBInstanceArn>arn:aws:rds:%s:%s:db:%s</DBInstanceArn></DBInstance></DBInstances>') % (
+                escape(db_instance), REGION, ACCOUNT_ID, escape(db_instance))
+        elif params.get('Action') == 'DescribeDBLogFiles':
+            since = int(params.get('FileLastWritten') or 0)
+            result = '<DescribeDBLogFiles>%s</DescribeDBLogFiles>' % ''.join(
+                ('<DescribeDBLogFilesDetails><LogFileName>%s</LogFileName><LastWritten>%s</LastWritten>'
+                 '<Size>%s</Size></DescribeDBLogFilesDetails>') % (escape(name), last_written, size)
+                for name, last_written, size in stub.describe_log_files() if last_written > since)
+        else:
+            return self.send_empty(400)
+        self.send_xml('<{0}Response><{0}Result>{1}</{0}Result><ResponseMetadata><RequestId>stub</RequestId>'
+                      '</ResponseMetadata></{0}Response>'.format(params['Action'], result))
+
+    def send_empty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_xml(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class RdsStub(object):
+
+    def __init__(self, logs, connect_latency=0, latency=0, bandwidth=0, error_rate=0):
+        self.logs = logs
+        self.connect_latency = connect_latency
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.connections = 0
+        self.requests = 0
+        self.errors = 0
+        self.started = int(time.time() * 1000)
+        self.server = ThreadedHTTPServer(('127.0.0.1', 0), RdsStubHandler)
+        self.server.stub = self
+        self.url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+
+    def describe_log_files(self):
+        """ (name, last written in ms since epoch, size) of each log """
+        names = sorted(self.logs)
+        return [(name, self.started - 60 * 1000 * (len(names) - 1 - i), len(self.logs[name]))
+                for i, name in enumerate(names)]
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,236 @@
+"""
+Selective Log Restore
+
+Restores some of the logs in an archive, using its index (see audit/archive_index.py), without
+retrieving the whole archive from glacier.
+
+1. Retrieve and download the index, `<archive name>.index.json`, like any other archive.
+2. Pick the logs to restore, and start ranged retrievals of just the bytes they are in:
+
+    python tools/restore_logs.py retrieve --index archive.index.json --start 2018-05-16T21:00:00 \\
+        --end 2018-05-16T23:00:00 --vault-name my-vault
+
+   Without --vault-name, the ranges are only printed. Glacier retrieves ranges that start and end
+   on a megabyte, so each range is widened to one, and ranges that then touch are retrieved together.
+3. Download each job's output (e.g. with glacier-upload's get_job_output), and extract the logs:
+
+    python tools/restore_logs.py extract --index archive.index.json --file-name range.bin \\
+        --byte-range 0-2097151 --start 2018-05-16T21:00:00 --end 2018-05-16T23:00:00
+
+Any logs selected that are in the downloaded range are extracted. Logs that were archived in
+parts (see PGAUDIT_FILTER_PART_MB) are put back together, and logs that were dictionary encoded
+(see PGAUDIT_DICTIONARY) are decoded. `decode` decodes a log extracted some other way, e.g. by tar:
+
+    python tools/restore_logs.py decode postgresql.log.2018-05-16-22 > postgresql.log.2018-05-16-22.decoded
+"""
+import itertools
+import json
+import os
+import re
+import sys
+import tarfile
+
+import arrow
+import boto3
+import click
+
+def get_parent_path(path):
+    return os.path.abspath(os.path.join(path, os.pardir))
+
+SCRIPT_DIR = get_parent_path(os.path.realpath(__file__))
+PROJECT_DIR = get_parent_path(SCRIPT_DIR)
+sys.path.append(os.path.join(PROJECT_DIR, 'audit'))
+
+from archive_index import format_time
+from compression import get_codec, iter_decompress
+from pgaudit_filter import decode_lines
+from streaming import ChunkReader
+
+MB = 1024 * 1024
+READ_SIZE = MB
+PART_SUFFIX = re.compile(r'\.part-\d+$')
+
+def load_index(index_path):
+    with open(index_path) as index_file:
+        return json.load(index_file)
+
+def uses_dictionary(index):
+    return (index.get('pgaudit_filter') or {}).get('dictionary', False)
+
+def select_members(index, log_files, start, end):
+    """ the members of the index with one of log_files' names, and written to between start and end.
+    a dictionary encoded log's statements can be defined in any of its parts, so when one part of
+    it is selected, all of them are. """
+    selected = []
+    for member in index['members']:
+        names = (member['name'], member['log_file'], os.path.basename(member['log_file']))
+        if log_files and not any(name in log_files for name in names):
+            continue
+        if start is not None and member['last_written'] < format_time(start):
+            continue
+        if end is not None and member['first_written'] is not None and member['first_written'] >= format_time(end):
+            continue
+        selected.append(member)
+    if uses_dictionary(index):
+        selected_logs = set(member['log_file'] for member in selected)
+        selected = [member for member in index['members'] if member['log_file'] in selected_logs]
+    return selected
+
+def get_byte_ranges(members, archive_size):
+    """ the megabyte aligned (first, last) byte ranges that members are in, with touching ranges merged. """
+    ranges = []
+    for member in sorted(members, key=lambda member: member['compressed_offset']):
+        first = member['compressed_offset'] // MB * MB
+        last = min(-(-(member['compressed_offset'] + member['compressed_size']) // MB) * MB, archive_size) - 1
+        if ranges and first <= ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], last))
+        else:
+            ranges.append((first, last))
+    return ranges
+
+def iter_file_range(file_name, offset, size):
+    with open(file_name, 'rb') as range_file:
+        range_file.seek(offset)
+        while size > 0:
+            chunk = range_file.read(min(READ_SIZE, size))
+            if not chunk:
+                raise IOError('%s ends before the member does; is it the right byte range?' % file_name)
+            size -= len(chunk)
+            yield chunk
+
+def iter_member(codec, file_name, file_offset, member):
+    """ yields the contents of the member, decompressed from file_name, where it starts file_offset bytes in. """
+    chunks = iter_file_range(file_name, file_offset, member['compressed_size'])
+    tar = tarfile.open(fileobj=ChunkReader(iter_decompress(codec, chunks)), mode='r|')
+    info = tar.next()
+    if info is None or info.name != member['name']:
+        raise IOError('expected %s at byte %s of the archive' % (member['name'], member['compressed_offset']))
+    source = tar.extractfile(info)
+    for data in iter(lambda: source.read(READ_SIZE), b''):
+        yield data
+
+def iter_lines(chunks):
+    rest = b''
+    for chunk in chunks:
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if rest:
+        yield rest
+
+def extract_log(codec, file_name, first, parts, output_dir, dictionary):
+    """ writes the log archived as parts (its members, in order) into output_dir, decoding it if
+    it was dictionary encoded. first is where in the archive file_name starts. """
+    output_path = os.path.join(output_dir, PART_SUFFIX.sub('', os.path.basename(parts[0]['name'])))
+    data = itertools.chain.from_iterable(
+        iter_member(codec, file_name, part['compressed_offset'] - first, part) for part in parts)
+    if dictionary:
+        data = decode_lines(iter_lines(data))
+    with open(output_path, 'wb') as output_file:
+        for chunk in data:
+            output_file.write(chunk)
+    mtime = arrow.get(parts[-1]['last_written']).timestamp
+    os.utime(output_path, (mtime, mtime))
+    return output_path
+
+def parse_time(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return arrow.get(value).datetime
+    except arrow.parser.ParserError:
+        raise click.BadParameter('expected a time like 2018-05-16T22:00:00')
+
+@click.group()
+def cli():
+    pass
+
+selection_options = [
+    click.option('-i', '--index', 'index_path', required=True,
+                 help='The archive index, <archive name>.index.json'),
+    click.option('-l', '--log-file', 'log_files', multiple=True,
+                 help='A log to restore, e.g. postgresql.log.2018-05-16-22. Can be repeated'),
+    click.option('-s', '--start', callback=parse_time,
+                 help='Restore logs written to after this time (UTC)'),
+    click.option('-e', '--end', callback=parse_time,
+                 help='Restore logs written to before this time (UTC)'),
+]
+
+def add_options(options):
+    def decorator(command):
+        for option in reversed(options):
+            command = option(command)
+        return command
+    return decorator
+
+@cli.command()
+@add_options(selection_options)
+@click.option('-v', '--vault-name',
+              help='Start a ranged archive-retrieval of each range from this vault')
+def retrieve(index_path, log_files, start, end, vault_name):
+    """ prints the byte ranges the selected logs are in, and optionally starts their retrievals. """
+    index = load_index(index_path)
+    members = select_members(index, log_files, start, end)
+    if not members:
+        raise click.ClickException('No logs in %s match' % index['archive_name'])
+
+    ranges = get_byte_ranges(members, index['archive_size'])
+    total = sum(last + 1 - first for first, last in ranges)
+    click.echo('%s logs, in %s of the archive\'s %s bytes:' % (len(members), total, index['archive_size']))
+    glacier = boto3.client('glacier') if vault_name else None
+    for first, last in ranges:
+        byte_range = '%s-%s' % (first, last)
+        names = [member['name'] for member in members
+                 if first <= member['compressed_offset'] <= last]
+        click.echo('%s: %s' % (byte_range, ', '.join(names)))
+        if glacier is not None:
+            response = glacier.initiate_job(vaultName=vault_name, jobParameters={
+                'Type': 'archive-retrieval',
+                'ArchiveId': index['archive_id'],
+                'RetrievalByteRange': byte_range,
+                'Description': '%s %s' % (index['archive_name'], byte_range),
+            })
+            click.echo('    Job ID: %s' % response['jobId'])
+
+@cli.command()
+@add_options(selection_options)
+@click.option('-f', '--file-name', required=True,
+              help='The downloaded output of a retrieval of the archive')
+@click.option('-b', '--byte-range',
+              help='The range of the archive that was retrieved, first-last. Defaults to all of it')
+@click.option('-o', '--output-dir', default='.',
+              help='Where to extract the logs to (default: the current directory)')
+def extract(index_path, log_files, start, end, file_name, byte_range, output_dir):
+    """ extracts the selected logs that are in a retrieved range of the archive. """
+    index = load_index(index_path)
+    codec = get_codec(index['codec'])
+    first, last = 0, index['archive_size'] - 1
+    if byte_range:
+        first, last = [int(pos) for pos in byte_range.split('-')]
+
+    dictionary = uses_dictionary(index)
+
+    extracted = 0
+    members = select_members(index, log_files, start, end)
+    for log_file, parts in itertools.groupby(members, key=lambda member: member['log_file']):
+        parts = list(parts)
+        if not all(part['compressed_offset'] >= first
+                   and part['compressed_offset'] + part['compressed_size'] <= last + 1 for part in parts):
+            continue
+        output_path = extract_log(codec, file_name, first, parts, output_dir, dictionary)
+        click.echo('Extracted %s (%s bytes)' % (output_path, os.path.getsize(output_path)))
+        extracted += 1
+    if not extracted:
+        raise click.ClickException('None of the logs selected are in bytes %s-%s' % (first, last))
+
+@cli.command()
+@click.argument('log_file', type=click.File('rb'))
+def decode(log_file):
+    """ decodes a dictionary encoded log (see PGAUDIT_DICTIONARY) to stdout. """
+    stdout = click.get_binary_stream('stdout')
+    for line in decode_lines(iter(log_file.readline, b'')):
+        stdout.write(line)
+
+if __name__ == '__main__':
+    cli()